@@ -0,0 +1,244 @@
+import asyncio
+import functools
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+import metrics
+
+log = logging.getLogger(__name__)
+
+# ============================================================
+# EXECUTOR
+# ============================================================
+
+# Every write (and the short interactive reads) runs on this single worker
+# thread. sqlite3 connections are bound to the thread that created them, so
+# the worker keeps one long-lived connection (see db.get_connection) and
+# handlers never block the event loop on connect / execute / fsync.
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+# Reports, history and other heavy reads run on these threads over
+# read-only WAL connections (db.get_reader), so a long report never sits in
+# front of a mechanic's write on the worker above.
+READERS = 2
+_readers = ThreadPoolExecutor(max_workers=READERS, thread_name_prefix="db-read")
+
+# Calls slower than this (run time on the worker) are logged; bot.py sets
+# it from SLOW_QUERY_MS.
+slow_query = 0.1
+
+# busy_timeout already makes SQLite wait for a lock, but a deferred
+# transaction that has to upgrade to a write lock fails with SQLITE_BUSY
+# at once. Every db.py function is one transaction, so running it again is
+# safe.
+BUSY_RETRIES = 3
+BUSY_BACKOFF = 0.05
+
+
+class _Timing:
+    __slots__ = ("started", "finished", "retries")
+
+    def __init__(self):
+        self.started = self.finished = None
+        self.retries = 0
+
+
+def _is_busy(error):
+    code = getattr(error, "sqlite_errorcode", None)
+    if code is not None:
+        return code & 0xFF in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    return "locked" in str(error)
+
+
+def _call(fn, args, kwargs, timing):
+    # Runs on the worker thread.
+    timing.started = time.perf_counter()
+    try:
+        while True:
+            try:
+                return fn(*args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if not _is_busy(e) or timing.retries >= BUSY_RETRIES:
+                    raise
+                time.sleep(BUSY_BACKOFF * 2 ** timing.retries)
+                timing.retries += 1
+    finally:
+        timing.finished = time.perf_counter()
+
+
+def _row_count(result):
+    if isinstance(result, db.Page):
+        return len(result.rows)
+    if isinstance(result, list):
+        return len(result)
+    if isinstance(result, sqlite3.Row):
+        return 1
+    if result is None:
+        return 0
+    return None
+
+
+def _record(name, queued, timing, rows):
+    if timing.started is None:
+        return
+    took = timing.finished - timing.started
+    metrics.db_wait_seconds.observe(timing.started - queued, name)
+    metrics.db_seconds.observe(took, name)
+    if timing.retries:
+        metrics.db_busy_retries.inc(name, timing.retries)
+    if rows is not None:
+        metrics.db_rows.observe(rows, name)
+    if took >= slow_query:
+        metrics.db_slow.inc(name)
+        log.warning(
+            "slow query %s: %.1f ms (queued %.1f ms, rows %s, busy retries %s)",
+            name, took * 1e3, (timing.started - queued) * 1e3, rows, timing.retries,
+        )
+
+
+async def _submit(executor, fn, args, kwargs):
+    loop = asyncio.get_running_loop()
+    name = getattr(fn, "__name__", "call")
+    timing = _Timing()
+    queued = time.perf_counter()
+    try:
+        result = await loop.run_in_executor(
+            executor, _call, fn, args, kwargs, timing
+        )
+    except Exception:
+        metrics.db_errors.inc(name)
+        _record(name, queued, timing, None)
+        raise
+    _record(name, queued, timing, _row_count(result))
+    return result
+
+
+async def run(fn, *args, **kwargs):
+    return await _submit(_executor, fn, args, kwargs)
+
+
+async def read(fn, *args, **kwargs):
+    # fn must only read (db.get_reader connections are query_only).
+    return await _submit(_readers, fn, args, kwargs)
+
+
+def _wrap(fn):
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        return await run(fn, *args, **kwargs)
+    return wrapper
+
+
+def _wrap_read(fn):
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        return await read(fn, *args, **kwargs)
+    return wrapper
+
+
+async def close(path: str):
+    # Running reads finish first; then their connections are closed from
+    # here (reader connections allow that, see db.close_readers). The writer
+    # is closed, with PRAGMA optimize, whatever happens to the readers.
+    try:
+        await asyncio.to_thread(_readers.shutdown, wait=True)
+        db.close_readers(path)
+    finally:
+        await run(db.close_connection, path)
+        _executor.shutdown(wait=True)
+
+
+# ============================================================
+# INIT DATABASE
+# ============================================================
+
+init_db = _wrap(db.init_db)
+
+# ============================================================
+# USERS
+# ============================================================
+
+add_user = _wrap(db.add_user)
+set_user_role = _wrap(db.set_user_role)
+
+
+metrics.Gauge(
+    "bot_role_cache", "Role cache size and hit / miss / eviction counts.",
+    db.role_cache.stats, "stat",
+)
+
+
+async def get_user_role(path, tg_id):
+    # Cache hits are answered inline, without a round trip to the worker.
+    role = db.role_cache.get((path, tg_id))
+    if role is not db.ROLE_CACHE_MISS:
+        return role
+    return await run(db.load_user_role, path, tg_id)
+
+
+list_users_by_role = _wrap_read(db.list_users_by_role)
+
+# ============================================================
+# CARS
+# ============================================================
+
+list_cars = _wrap(db.list_cars)
+find_car_by_identifier = _wrap(db.find_car_by_identifier)
+search_cars = _wrap(db.search_cars)
+add_car = _wrap(db.add_car)
+upsert_cars = _wrap(db.upsert_cars)
+
+# ============================================================
+# SERVICES
+# ============================================================
+
+create_service = _wrap(db.create_service)
+assign_mechanic = _wrap(db.assign_mechanic)
+get_service_desired_ts = _wrap_read(db.get_service_desired_ts)
+load_workload = _wrap(db.load_workload)
+admin_approve_service = _wrap(db.admin_approve_service)
+admin_reject_service = _wrap(db.admin_reject_service)
+approve_services = _wrap(db.approve_services)
+reject_services = _wrap(db.reject_services)
+assign_services = _wrap(db.assign_services)
+list_desired_ts = _wrap_read(db.list_desired_ts)
+list_pending_services = _wrap_read(db.list_pending_services)
+get_services_for_mechanic = _wrap(db.get_services_for_mechanic)
+set_service_result = _wrap(db.set_service_result)
+list_service_history = _wrap_read(db.list_service_history)
+sum_service_cost = _wrap_read(db.sum_service_cost)
+
+search_services = _wrap_read(db.search_services)
+service_calendar = _wrap_read(db.service_calendar)
+
+# ============================================================
+# ARCHIVE
+# ============================================================
+
+archive_services = _wrap(db.archive_services)
+
+# ============================================================
+# FSM STATE
+# ============================================================
+
+load_fsm_record = _wrap(db.load_fsm_record)
+save_fsm_records = _wrap(db.save_fsm_records)
+delete_expired_fsm = _wrap(db.delete_expired_fsm)
+
+# ============================================================
+# NOTIFICATIONS
+# ============================================================
+
+add_notifications = _wrap(db.add_notifications)
+list_notifications = _wrap(db.list_notifications)
+delete_notifications = _wrap(db.delete_notifications)
+
+# ============================================================
+# REPORTS
+# ============================================================
+
+rebuild_service_stats = _wrap(db.rebuild_service_stats)
+service_stats = _wrap_read(db.service_stats)
@@ -0,0 +1,76 @@
+import argparse
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+
+import adb
+import db
+
+log = logging.getLogger(__name__)
+
+# Moves completed services older than ARCHIVE_AFTER_DAYS from services into
+# the archive file (see db.archive_services), one batch per transaction.
+# The bot runs it once a day; it can also be run by hand:
+#
+#   python archive.py fleet.db --days 365
+
+# ================= SETTINGS =================
+ARCHIVE_AFTER_DAYS = 365
+INTERVAL = 24 * 3600
+
+
+def cutoff(days):
+    return (datetime.now() - timedelta(days=days)).isoformat()
+
+
+def archive(path, days=ARCHIVE_AFTER_DAYS, batch=db.ARCHIVE_BATCH):
+    before = cutoff(days)
+    moved = 0
+    while True:
+        count = db.archive_services(path, before, batch)
+        if not count:
+            return moved
+        moved += count
+
+
+async def archive_async(path, days=ARCHIVE_AFTER_DAYS, batch=db.ARCHIVE_BATCH):
+    # Every batch is its own job on the DB worker, so handlers' writes
+    # interleave with a large first run instead of waiting for all of it.
+    before = cutoff(days)
+    moved = 0
+    while True:
+        count = await adb.archive_services(path, before, batch)
+        if not count:
+            return moved
+        moved += count
+
+
+async def run_daily(path, days=ARCHIVE_AFTER_DAYS, interval=INTERVAL):
+    while True:
+        try:
+            started = time.perf_counter()
+            moved = await archive_async(path, days)
+            if moved:
+                log.info("archived %s services in %.1fs",
+                         moved, time.perf_counter() - started)
+        except Exception:
+            log.exception("archiving failed")
+        await asyncio.sleep(interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="archive old completed services")
+    parser.add_argument("db")
+    parser.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS)
+    parser.add_argument("--batch", type=int, default=db.ARCHIVE_BATCH)
+    args = parser.parse_args()
+
+    db.init_db(args.db)
+    started = time.perf_counter()
+    moved = archive(args.db, args.days, args.batch)
+    stats = db.archive_stats(args.db)
+    db.close_connection(args.db)
+    print(f"moved {moved} services to {db.archive_path(args.db)} "
+          f"({time.perf_counter() - started:.1f}s); "
+          f"completed in hot table: {stats['hot']}, archived: {stats['archived']}")
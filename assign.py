@@ -0,0 +1,123 @@
+import heapq
+import itertools
+from collections import Counter
+
+import adb
+
+# Picks a mechanic for a new service: the one with the fewest open
+# (approved) services who has nothing else booked in the same hour. If
+# everyone is booked then, it picks the least loaded mechanic overall.
+#
+# Workload lives in memory and is updated as services are assigned,
+# reassigned and completed. It is read from the database once, at start.
+# A heap ordered by (open services, last change) finds the least loaded
+# mechanic in O(log n). Among equally loaded mechanics, the one who got
+# work longest ago goes first. Only mechanics booked in the requested hour
+# are popped and pushed back.
+#
+# It assumes one bot process owns the database: services changed by
+# another process are not seen until the next start.
+
+# ================= SETTINGS =================
+SLOT_CHARS = len("YYYY-MM-DD HH")     # desired_ts prefix that names a slot
+
+
+def slot_of(desired_ts):
+    return desired_ts[:SLOT_CHARS] if desired_ts else None
+
+
+class Assigner:
+    def __init__(self, path):
+        self.path = path
+        self._seq = itertools.count(1)
+        self._load = {}           # tg_id -> (open services, seq of last change)
+        self._slots = {}          # tg_id -> Counter(slot -> services)
+        self._open = {}           # service id -> (tg_id, slot)
+        self._heap = []           # (open services, seq, tg_id); stale entries skipped
+
+    async def start(self):
+        self.reset(await adb.load_workload(self.path))
+
+    def reset(self, rows):
+        # rows: (mechanic tg_id, service id or None, desired_ts or None),
+        # as returned by db.load_workload.
+        self._load.clear()
+        self._slots.clear()
+        self._open.clear()
+        self._heap.clear()
+        for tg_id, service_id, desired_ts in rows:
+            load = self._load.get(tg_id, (0, 0))[0]
+            self._slots.setdefault(tg_id, Counter())
+            if service_id is not None:
+                self._take(service_id, tg_id, slot_of(desired_ts))
+                load += 1
+            self._load[tg_id] = (load, 0)
+        self._heap = [(load, seq, tg_id) for tg_id, (load, seq) in self._load.items()]
+        heapq.heapify(self._heap)
+
+    def add_mechanic(self, tg_id):
+        if tg_id not in self._load:
+            self._slots[tg_id] = Counter()
+            self._set(tg_id, 0)
+
+    def remove_mechanic(self, tg_id):
+        # Their open services stay theirs; they just get no new ones.
+        self._load.pop(tg_id, None)
+        self._slots.pop(tg_id, None)
+        for service_id in [s for s, (m, _) in self._open.items() if m == tg_id]:
+            del self._open[service_id]
+
+    def load(self, tg_id):
+        state = self._load.get(tg_id)
+        return state[0] if state else 0
+
+    def pick(self, desired_ts=None):
+        # Least loaded mechanic free in desired_ts's hour, else least loaded;
+        # None when there are no mechanics. Does not assign anything.
+        slot = slot_of(desired_ts)
+        busy = []
+        chosen = None
+        while self._heap:
+            load, seq, tg_id = self._heap[0]
+            if self._load.get(tg_id) != (load, seq):
+                heapq.heappop(self._heap)
+                continue
+            if not self._slots[tg_id][slot]:
+                chosen = tg_id
+                break
+            busy.append(heapq.heappop(self._heap))
+        for entry in busy:
+            heapq.heappush(self._heap, entry)
+        if chosen is None and busy:
+            chosen = busy[0][2]
+        return chosen
+
+    def assign(self, service_id, tg_id, desired_ts=None):
+        # tg_id None: the service was left without a mechanic.
+        self.release(service_id)
+        if tg_id in self._load:
+            self._take(service_id, tg_id, slot_of(desired_ts))
+            self._set(tg_id, self._load[tg_id][0] + 1)
+
+    def release(self, service_id):
+        # The service was completed, rejected or reassigned.
+        tg_id, slot = self._open.pop(service_id, (None, None))
+        if tg_id in self._load:
+            self._slots[tg_id][slot] -= 1
+            if not self._slots[tg_id][slot]:
+                del self._slots[tg_id][slot]
+            self._set(tg_id, self._load[tg_id][0] - 1)
+
+    def _take(self, service_id, tg_id, slot):
+        self._open[service_id] = (tg_id, slot)
+        self._slots[tg_id][slot] += 1
+
+    def _set(self, tg_id, load):
+        state = (load, next(self._seq))
+        self._load[tg_id] = state
+        heapq.heappush(self._heap, state + (tg_id,))
+        # Every change leaves a stale entry behind; rebuild before they
+        # outnumber the live ones.
+        if len(self._heap) > 2 * len(self._load) + 64:
+            self._heap = [s + (m,) for m, s in self._load.items()]
+            heapq.heapify(self._heap)
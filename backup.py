@@ -0,0 +1,154 @@
+import argparse
+import asyncio
+import logging
+import os
+import pathlib
+import sqlite3
+import time
+from datetime import datetime
+
+import db
+import metrics
+
+log = logging.getLogger(__name__)
+
+# Online snapshots of the database (and its archive file) with the sqlite3
+# backup API, taken while the bot keeps running:
+#   - the copy reads through its own read-only connection that holds one
+#     read transaction for the whole run, so it is a consistent WAL snapshot
+#     and writers never wait for it (and never force it to restart);
+#   - pages are copied STEP_PAGES at a time with a pause in between, on a
+#     helper thread, so the event loop and the DB worker keep going;
+#   - each snapshot is checked with PRAGMA integrity_check before it
+#     replaces anything, and only the newest KEEP are kept.
+#
+#   python backup.py fleet.db backups/
+
+# ================= SETTINGS =================
+INTERVAL = 24 * 3600
+KEEP = 7
+STEP_PAGES = 1024         # pages per backup step (4 MiB with 4 KiB pages)
+STEP_SLEEP = 0.005        # pause between steps
+
+backup_seconds = metrics.Histogram(
+    "bot_backup_seconds", "Time to take and check one database snapshot.")
+backup_failures = metrics.Counter(
+    "bot_backup_failures_total", "Snapshots that failed or did not pass the check.")
+_last_success = 0.0
+metrics.Gauge("bot_backup_last_success_timestamp",
+              "Unix time of the last good snapshot.", lambda: _last_success)
+
+
+def _copy(path, targets, step_pages, step_sleep):
+    # targets: [(schema, file)]. One read-only connection with the archive
+    # attached, so both files come from the same moment even while a batch
+    # is being archived.
+    src = sqlite3.connect(pathlib.Path(path).absolute().as_uri() + "?mode=ro", uri=True)
+    try:
+        for schema, _ in targets[1:]:
+            src.execute(f"ATTACH DATABASE ? AS {schema}", (
+                pathlib.Path(db.archive_path(path)).absolute().as_uri() + "?mode=ro",
+            ))
+        # Pin one snapshot for all steps: without an open read transaction
+        # every step sees the latest commit and a write restarts the copy.
+        src.execute("BEGIN")
+        for schema, _ in targets:
+            src.execute(f"SELECT COUNT(*) FROM {schema}.sqlite_master").fetchone()
+        for schema, file in targets:
+            dst = sqlite3.connect(file)
+            try:
+                # sleep= only applies when a step hits BUSY/LOCKED; the
+                # pause between ordinary steps comes from the callback.
+                src.backup(dst, pages=step_pages, name=schema,
+                           progress=lambda status, remaining, total: time.sleep(step_sleep))
+                # The copy inherits WAL mode; make it one self-contained file.
+                dst.execute("PRAGMA journal_mode=DELETE")
+                result = dst.execute("PRAGMA integrity_check").fetchone()[0]
+            finally:
+                dst.close()
+            if result != "ok":
+                raise sqlite3.DatabaseError(f"integrity check of {file}: {result}")
+        src.rollback()
+    finally:
+        src.close()
+    # The pinned snapshot kept the WAL from being checkpointed. Do it here
+    # so that, unless a commit gets there first, the DB worker does not pay
+    # for it.
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+    finally:
+        conn.close()
+
+
+def _sources(path):
+    archive = db.archive_path(path)
+    return [("main", path)] + ([("archive", archive)] if os.path.exists(archive) else [])
+
+
+def snapshot(path, directory, keep=KEEP, step_pages=STEP_PAGES, step_sleep=STEP_SLEEP):
+    # Writes <name>-YYYYmmdd-HHMMSS.db per database file into directory and
+    # returns their paths. Runs synchronously; the bot calls it in a thread.
+    os.makedirs(directory, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    sources = _sources(path)
+    targets = []
+    for schema, file in sources:
+        name = pathlib.Path(file)
+        targets.append((schema, os.path.join(directory, f"{name.stem}-{stamp}{name.suffix}")))
+    try:
+        # Written as .tmp and renamed only once every file passed the check.
+        _copy(path, [(schema, file + ".tmp") for schema, file in targets],
+              step_pages, step_sleep)
+        for _, file in targets:
+            os.replace(file + ".tmp", file)
+    finally:
+        for _, file in targets:
+            if os.path.exists(file + ".tmp"):
+                os.remove(file + ".tmp")
+    for _, file in sources:
+        _rotate(directory, pathlib.Path(file), keep)
+    return [file for _, file in targets]
+
+
+def _rotate(directory, name, keep):
+    # Stamps sort by time, so the oldest come first.
+    snapshots = sorted(pathlib.Path(directory).glob(f"{name.stem}-[0-9]*{name.suffix}"))
+    for old in snapshots[:-keep] if keep else []:
+        old.unlink()
+
+
+async def backup(path, directory, keep=KEEP):
+    global _last_success
+    started = time.perf_counter()
+    try:
+        files = await asyncio.to_thread(snapshot, path, directory, keep)
+    except Exception:
+        backup_failures.inc()
+        raise
+    backup_seconds.observe(time.perf_counter() - started)
+    _last_success = time.time()
+    return files
+
+
+async def run_periodically(path, directory, interval=INTERVAL, keep=KEEP):
+    while True:
+        try:
+            files = await backup(path, directory, keep)
+            log.info("backup: %s", ", ".join(files))
+        except Exception:
+            log.exception("backup failed")
+        await asyncio.sleep(interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="online snapshot of fleet.db")
+    parser.add_argument("db")
+    parser.add_argument("directory")
+    parser.add_argument("--keep", type=int, default=KEEP)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    for file in snapshot(args.db, args.directory, args.keep):
+        print(f"{file} ({os.path.getsize(file) / 2**20:.1f} MiB)")
+    print(f"{time.perf_counter() - started:.1f}s")
@@ -0,0 +1,709 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+from datetime import datetime
+
+import adb
+import archive
+import assign
+import backup
+import db
+import fleetgen
+
+# ============================================================
+# HELPERS
+# ============================================================
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    idx = min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def timeit(fn, n):
+    samples = []
+    for i in range(n):
+        t0 = time.perf_counter()
+        fn(i)
+        samples.append(time.perf_counter() - t0)
+    return samples
+
+
+def fmt_us(seconds):
+    return f"{seconds * 1e6:9.1f}us"
+
+
+def report(name, samples):
+    print(
+        f"{name:<32} p50 {fmt_us(percentile(samples, 50))}"
+        f"  p99 {fmt_us(percentile(samples, 99))}"
+        f"  n={len(samples)}"
+    )
+
+
+# ============================================================
+# CONNECTIONS: connect-per-call vs pooled
+# ============================================================
+
+# What every db.py function did before the pool: fresh connection, default
+# rollback journal, commit, close.
+def _legacy_read(path, tg_id):
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    cur = conn.cursor()
+    cur.execute("SELECT role FROM users WHERE tg_id = ?", (tg_id,))
+    row = cur.fetchone()
+    conn.close()
+    return row["role"] if row else None
+
+
+def _legacy_write(path, tg_id, role):
+    conn = sqlite3.connect(path)
+    cur = conn.cursor()
+    cur.execute("UPDATE users SET role = ? WHERE tg_id = ?", (role, tg_id))
+    conn.commit()
+    conn.close()
+
+
+def _seed_users(path, n):
+    with db.transaction(path) as conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO users (tg_id, full_name) VALUES (?, ?)",
+            [(i, f"user {i}") for i in range(n)],
+        )
+
+
+def bench_connections(n, users=1000):
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy = os.path.join(tmp, "legacy.db")
+        pooled = os.path.join(tmp, "pooled.db")
+
+        for path in (legacy, pooled):
+            db.init_db(path)
+            _seed_users(path, users)
+
+        # journal_mode=WAL is persistent, put the legacy file back into the
+        # default rollback journal mode.
+        db.close_connection(legacy)
+        conn = sqlite3.connect(legacy)
+        conn.execute("PRAGMA journal_mode=DELETE")
+        conn.close()
+
+        roles = ("user", "mechanic")
+        report("load_user_role connect-per-call",
+               timeit(lambda i: _legacy_read(legacy, i % users), n))
+        # load_user_role: get_user_role would answer from RoleCache after
+        # the first lap and time a dict lookup instead of the connection.
+        report("load_user_role pooled",
+               timeit(lambda i: db.load_user_role(pooled, i % users), n))
+        report("set_user_role  connect-per-call",
+               timeit(lambda i: _legacy_write(legacy, i % users, roles[i % 2]), n))
+        report("set_user_role  pooled",
+               timeit(lambda i: db.set_user_role(pooled, i % users, roles[i % 2]), n))
+
+        db.close_connection(pooled)
+
+
+# ============================================================
+# QUERY PLANS
+# ============================================================
+
+# Hot read paths, called through the real db.py functions. The SQL they
+# issue is captured with a trace callback and fed to EXPLAIN QUERY PLAN, so
+# the check cannot drift from the queries that actually run.
+HOT_QUERIES = (
+    ("list_pending_services", lambda p: db.list_pending_services(p)),
+    ("get_services_for_mechanic", lambda p: db.get_services_for_mechanic(p, 1)),
+    ("list_service_history", lambda p: db.list_service_history(p)),
+    ("list_service_history(mechanic)", lambda p: db.list_service_history(p, 1)),
+    ("sum_service_cost", lambda p: db.sum_service_cost(
+        p, "2024-01-01", "2024-12-31T23:59:59")),
+    ("find_car_by_identifier", lambda p: db.find_car_by_identifier(p, "WA 12345")),
+    ("search_cars", lambda p: db.search_cars(p, "WVWZZZ1KZ0001")),
+    ("search_services", lambda p: db.search_services(p, "тормозные колодки")),
+    ("search_services(car)", lambda p: db.search_services(p, "колодки", car_id=1)),
+    ("service_calendar", lambda p: db.service_calendar(p, "2024-06-03", 7)),
+    ("service_calendar(mechanic)", lambda p: db.service_calendar(p, "2024-06-03", 7, 1)),
+)
+
+
+def capture_sql(path, fn):
+    conns = (db.get_connection(path), db.get_reader(path))
+    statements = []
+    for conn in conns:
+        conn.set_trace_callback(statements.append)
+    try:
+        fn(path)
+    finally:
+        for conn in conns:
+            conn.set_trace_callback(None)
+    return [s for s in statements if s.lstrip().upper().startswith("SELECT")]
+
+
+# "SCAN s USING INDEX ..." walks an index in order and FTS lookups show up
+# as "SCAN f VIRTUAL TABLE INDEX ..."; a bare "SCAN s" / "SCAN cars" is a
+# full table scan. "SCAN CONSTANT ROW" and "SCAN (subquery-N)" (reading a
+# UNION ALL of the hot and archived services) are not, and neither is FTS5
+# reading its one-row config table when a connection first uses an index.
+def table_scans(path, sql):
+    conn = db.get_connection(path)
+    plan = conn.execute("EXPLAIN QUERY PLAN " + sql).fetchall()
+    return [
+        r["detail"] for r in plan
+        if r["detail"].startswith("SCAN ")
+        and " USING " not in r["detail"]
+        and " VIRTUAL TABLE " not in r["detail"]
+        and r["detail"] != "SCAN CONSTANT ROW"
+        and not r["detail"].startswith("SCAN (subquery")
+        and not r["detail"].endswith("_fts_config")
+    ]
+
+
+def check_plans(path=None):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = path or os.path.join(tmp, "plans.db")
+        db.init_db(path)
+        failed = False
+        for name, fn in HOT_QUERIES:
+            scans = []
+            for sql in capture_sql(path, fn):
+                scans += table_scans(path, sql)
+            status = "SCAN " + "; ".join(scans) if scans else "ok"
+            print(f"{name:<32} {status}")
+            failed = failed or bool(scans)
+        db.close_connection(path)
+    return not failed
+
+
+# ============================================================
+# SUITE: public db.py functions on a synthetic fleet vs baseline
+# ============================================================
+
+BASELINE = "bench_baseline.json"
+TOLERANCE = 1.5         # allowed p50 growth; p99 gets twice as much slack
+NOISE_FLOOR = 50e-6     # differences below this are timer noise, not regressions
+WARMUP = 20
+REPEAT = 3              # suite runs per check; each result is the median of them
+SUITE_NOW = datetime(2025, 6, 1)    # generated fleets end here, whatever today is
+FIXTURE_SEED = 1
+
+
+def _fixtures(path):
+    # Real ids / keys from the database, cycled through by the benchmarks so
+    # every call does a fresh lookup instead of hitting one hot page. Picked
+    # with a seeded RNG, so every run of the same fleet uses the same ones.
+    conn = db.get_connection(path)
+    rng = random.Random(FIXTURE_SEED)
+
+    def column(sql, *params):
+        return [r[0] for r in conn.execute(sql, params).fetchall()]
+
+    cars = conn.execute("SELECT * FROM cars ORDER BY id").fetchall()
+    cars = rng.sample(cars, min(500, len(cars)))
+    approved = column("SELECT id FROM services WHERE status = 'approved' ORDER BY id")
+    rng.shuffle(approved)
+    pending = column("SELECT id FROM services WHERE status = 'pending_admin' ORDER BY id")
+    rng.shuffle(pending)
+    months = column(
+        "SELECT DISTINCT bucket FROM service_stats WHERE period = 'month' ORDER BY 1"
+    )
+    return {
+        "car_ids": [str(r["id"]) for r in cars],
+        "vins": [r["vin"] for r in cars],
+        "plates": [r["plate"] for r in cars],
+        # Middle of the VIN, so only the trigram index can find it.
+        "fragments": [r["vin"][4:12] for r in cars],
+        "mechanics": column("SELECT tg_id FROM users WHERE role = 'mechanic'"),
+        "pending_cursor": db.list_pending_services(path).next_cursor,
+        "history_cursor": db.list_service_history(path).next_cursor,
+        "approved": approved,
+        "pending": pending,
+        # The sampled cars as importer.validate leaves them.
+        "import_rows": [
+            (n, {
+                "vin": db.normalize_ident(r["vin"]), "mileage": 200_000 + n,
+                "year": r["year"], "owner_company": r["owner_company"],
+                "model": r["model"], "plate": db.normalize_ident(r["plate"]) or None,
+                "fuel_type": r["fuel_type"],
+            })
+            for n, r in enumerate(cars, start=2)
+        ],
+        "months": months[-12:],
+        "days": column(
+            "SELECT DISTINCT substr(desired_ts, 1, 10) FROM services"
+            " WHERE status = 'approved' ORDER BY 1 DESC LIMIT 30"
+        ),
+        "user": fleetgen.USER_BASE,
+        "admin": fleetgen.ADMIN_BASE,
+    }
+
+
+def _pick(items, i):
+    return items[i % len(items)]
+
+
+# (name, fn(path, fixtures, i)). Read paths first; writes last so they do
+# not change what the reads see.
+SUITE = (
+    ("find_car_by_identifier(id)",
+     lambda p, f, i: db.find_car_by_identifier(p, _pick(f["car_ids"], i))),
+    ("find_car_by_identifier(vin)",
+     lambda p, f, i: db.find_car_by_identifier(p, _pick(f["vins"], i))),
+    ("find_car_by_identifier(plate)",
+     lambda p, f, i: db.find_car_by_identifier(p, _pick(f["plates"], i))),
+    ("search_cars",
+     lambda p, f, i: db.search_cars(p, _pick(f["fragments"], i))),
+    ("search_services",
+     lambda p, f, i: db.search_services(p, _pick(fleetgen.WORKS, i))),
+    ("search_services(car)",
+     lambda p, f, i: db.search_services(
+         p, _pick(fleetgen.WORKS, i), car_id=int(_pick(f["car_ids"], i)))),
+    ("service_calendar(week)",
+     lambda p, f, i: db.service_calendar(p, _pick(f["days"], i), 7)),
+    ("service_calendar(mechanic)",
+     lambda p, f, i: db.service_calendar(
+         p, _pick(f["days"], i), 7, _pick(f["mechanics"], i))),
+    ("list_pending_services",
+     lambda p, f, i: db.list_pending_services(p)),
+    ("list_pending_services(page 2)",
+     lambda p, f, i: db.list_pending_services(p, f["pending_cursor"])),
+    ("get_services_for_mechanic",
+     lambda p, f, i: db.get_services_for_mechanic(p, _pick(f["mechanics"], i))),
+    ("list_service_history",
+     lambda p, f, i: db.list_service_history(p)),
+    ("list_service_history(page 2)",
+     lambda p, f, i: db.list_service_history(p, cursor=f["history_cursor"])),
+    ("list_service_history(mechanic)",
+     lambda p, f, i: db.list_service_history(p, _pick(f["mechanics"], i))),
+    ("sum_service_cost(month)",
+     lambda p, f, i: db.sum_service_cost(
+         p, _pick(f["months"], i), _pick(f["months"], i) + "-31T23:59:59")),
+    ("service_stats(month)",
+     lambda p, f, i: db.service_stats(
+         p, "month", _pick(f["months"], i), _pick(f["months"], i), "owner_company")),
+    ("get_user_role",
+     lambda p, f, i: db.get_user_role(p, f["user"] + i % 100)),
+    ("load_user_role",
+     lambda p, f, i: db.load_user_role(p, f["user"] + i % 100)),
+    ("list_users_by_role",
+     lambda p, f, i: db.list_users_by_role(p, "mechanic")),
+    ("list_cars",
+     lambda p, f, i: db.list_cars(p)),
+    ("set_service_result",
+     lambda p, f, i: db.set_service_result(
+         p, _pick(f["approved"], i), 150_000 + i, 420.0, "bench")),
+    ("create_service",
+     lambda p, f, i: db.create_service(
+         p, int(_pick(f["car_ids"], i)), f["user"], "user", "bench", "01.01 10:00")),
+    ("assign_mechanic",
+     lambda p, f, i: db.assign_mechanic(
+         p, _pick(f["approved"], i), _pick(f["mechanics"], i))),
+    ("admin_approve_service",
+     lambda p, f, i: db.admin_approve_service(p, _pick(f["pending"], 2 * i), f["admin"])),
+    ("admin_reject_service",
+     lambda p, f, i: db.admin_reject_service(p, _pick(f["pending"], 2 * i + 1), f["admin"])),
+    ("add_user",
+     lambda p, f, i: db.add_user(p, f["user"] + 1_000_000 + i, "bench")),
+    ("set_user_role",
+     lambda p, f, i: db.set_user_role(p, f["user"] + i % 100, "user")),
+    ("add_car",
+     lambda p, f, i: db.add_car(
+         p, f"BENCH{i:012d}", 1000, 2020, "bench", "bench", None, "diesel")),
+    ("upsert_cars(100 rows)",
+     lambda p, f, i: db.upsert_cars(
+         p, f["import_rows"][i * 100 % len(f["import_rows"]):][:100])),
+)
+
+# Calls per run for benchmarks too slow for the full -n: list_cars returns
+# the whole table (tens of ms on the default fleet).
+MAX_SAMPLES = {"list_cars": 50}
+
+
+def _copy_db(src, dst):
+    # The suite writes; run it on a copy so a stored fleet stays reusable.
+    source = sqlite3.connect(src)
+    target = sqlite3.connect(dst)
+    with target:
+        source.backup(target)
+    source.close()
+    target.close()
+
+
+def run_suite(n, cars, source=None, repeat=REPEAT):
+    # Runs the suite `repeat` times, each on a fresh copy of the same fleet
+    # (it writes), and keeps the median p50 / p99 of every benchmark, so one
+    # noisy run does not fail the check.
+    with tempfile.TemporaryDirectory() as tmp:
+        fleet = os.path.join(tmp, "fleet.db")
+        if source:
+            _copy_db(source, fleet)
+            db.init_db(fleet)
+        else:
+            fleetgen.generate(fleet, cars, now=SUITE_NOW)
+        cars = db.get_connection(fleet).execute("SELECT COUNT(*) FROM cars").fetchone()[0]
+        db.close_connection(fleet)
+        runs = []
+        for r in range(repeat):
+            path = os.path.join(tmp, f"suite{r}.db")
+            _copy_db(fleet, path)
+            fixtures = _fixtures(path)
+            results = {}
+            for name, fn in SUITE:
+                timeit(lambda i: fn(path, fixtures, i), WARMUP)
+                samples = timeit(
+                    lambda i: fn(path, fixtures, i + WARMUP),
+                    min(n, MAX_SAMPLES.get(name, n))
+                )
+                results[name] = {
+                    "p50": percentile(samples, 50),
+                    "p99": percentile(samples, 99),
+                }
+            db.close_connection(path)
+            runs.append(results)
+    results = {
+        name: {q: statistics.median(run[name][q] for run in runs) for q in ("p50", "p99")}
+        for name, _ in SUITE
+    }
+    return {"cars": cars, "n": n, "repeat": repeat, "results": results}
+
+
+def compare(run, baseline, tolerance=TOLERANCE):
+    # Prints one line per benchmark and returns the names that regressed.
+    if baseline and baseline["cars"] != run["cars"]:
+        print(f"warning: baseline was taken on {baseline['cars']} cars, "
+              f"this run has {run['cars']}")
+    base = baseline["results"] if baseline else {}
+    missing = [name for name in run["results"] if baseline and name not in base]
+    if missing:
+        print(f"warning: not in the baseline, not compared: {', '.join(missing)}")
+    regressed = []
+    for name, now in run["results"].items():
+        line = f"{name:<32} p50 {fmt_us(now['p50'])}  p99 {fmt_us(now['p99'])}"
+        was = base.get(name)
+        if was:
+            bad = (
+                now["p50"] > was["p50"] * tolerance
+                and now["p50"] - was["p50"] > NOISE_FLOOR
+            ) or (
+                now["p99"] > was["p99"] * tolerance * 2
+                and now["p99"] - was["p99"] > NOISE_FLOOR
+            )
+            line += f"  x{now['p50'] / was['p50']:.2f} p50"
+            if bad:
+                line += "  REGRESSION"
+                regressed.append(name)
+        print(line)
+    return regressed
+
+
+def load_baseline(file):
+    if not os.path.exists(file):
+        return None
+    with open(file, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_baseline(file, run):
+    with open(file, "w", encoding="utf-8") as f:
+        json.dump(run, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+# ============================================================
+# READ / WRITE SPLIT: mechanic writes during a long report
+# ============================================================
+
+def _full_history(path):
+    return sum(1 for _ in db.iter_service_history(path))
+
+
+async def _writes_during_report(path, service_ids, submit, min_writes=20):
+    report = asyncio.create_task(submit(_full_history, path))
+    await asyncio.sleep(0.005)
+    samples = []
+    while not report.done() or len(samples) < min_writes:
+        t0 = time.perf_counter()
+        await adb.set_service_result(path, service_ids[len(samples)], 100_000, 500.0, "bench")
+        samples.append(time.perf_counter() - t0)
+    await report
+    return samples
+
+
+async def _bench_split(path):
+    conn = db.get_connection(path)
+    ids = [r[0] for r in conn.execute(
+        "SELECT id FROM services WHERE status = 'approved'"
+    ).fetchall()]
+    db.close_connection(path)
+    half = len(ids) // 2
+    report("set_service_result  report on worker",
+           await _writes_during_report(path, ids[:half], adb.run))
+    report("set_service_result  report on reader",
+           await _writes_during_report(path, ids[half:], adb.read))
+    await adb.close(path)
+
+
+def bench_split(cars):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "split.db")
+        fleetgen.generate(path, cars)
+        db.close_connection(path)
+        asyncio.run(_bench_split(path))
+
+
+# ============================================================
+# BACKUP: handler-side DB latency while a snapshot is taken
+# ============================================================
+
+async def _latency(path, service_ids, until=None, min_calls=50):
+    # Alternates a worker write and a reader page, like handlers do.
+    writes, reads = [], []
+    while (until is not None and not until.done()) or len(writes) < min_calls:
+        t0 = time.perf_counter()
+        await adb.set_service_result(path, service_ids[len(writes)], 100_000, 500.0, "bench")
+        t1 = time.perf_counter()
+        await adb.list_pending_services(path)
+        writes.append(t1 - t0)
+        reads.append(time.perf_counter() - t1)
+    return writes, reads
+
+
+async def _bench_backup(path, directory):
+    conn = db.get_connection(path)
+    ids = [r[0] for r in conn.execute(
+        "SELECT id FROM services WHERE status = 'approved'"
+    ).fetchall()]
+    db.close_connection(path)
+    writes, reads = await _latency(path, ids, min_calls=1000)
+    report("set_service_result  idle", writes)
+    report("list_pending_services  idle", reads)
+
+    started = time.perf_counter()
+    job = asyncio.create_task(backup.backup(path, directory))
+    writes, reads = await _latency(path, ids[len(writes):], job)
+    files = await job
+    report("set_service_result  backup", writes)
+    report("list_pending_services  backup", reads)
+    size = sum(os.path.getsize(f) for f in files) / 2**20
+    print(f"snapshot {size:.1f} MiB in {time.perf_counter() - started:.1f}s, "
+          f"integrity ok")
+    await adb.close(path)
+
+
+def bench_backup(cars):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "backup.db")
+        fleetgen.generate(path, cars)
+        db.close_connection(path)
+        asyncio.run(_bench_backup(path, os.path.join(tmp, "backups")))
+
+
+# ============================================================
+# ARCHIVE: history reads before / after moving old services out
+# ============================================================
+
+ARCHIVE_QUERIES = (
+    ("list_service_history", lambda p, m: db.list_service_history(p)),
+    ("list_service_history(mechanic)",
+     lambda p, m: db.list_service_history(p, fleetgen.MECHANIC_BASE)),
+    ("sum_service_cost(last month)",
+     lambda p, m: db.sum_service_cost(p, m, m + "-31T23:59:59")),
+    ("sum_service_cost(all)",
+     lambda p, m: db.sum_service_cost(p, "0000", "9999")),
+)
+
+
+def bench_archive(cars, days, n):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "archive.db")
+        fleetgen.generate(path, cars)
+        month = time.strftime("%Y-%m")
+        for label in ("hot only", f"archived > {days} days"):
+            if label != "hot only":
+                started = time.perf_counter()
+                moved = archive.archive(path, days)
+                print(f"moved {moved} services in {time.perf_counter() - started:.1f}s")
+            print(f"-- {label}: {db.archive_stats(path)}")
+            for name, fn in ARCHIVE_QUERIES:
+                timeit(lambda i: fn(path, month), WARMUP)
+                report(name, timeit(lambda i: fn(path, month), n))
+        db.close_connection(path)
+
+
+# ============================================================
+# ASSIGN: one automatic mechanic assignment vs number of mechanics
+# ============================================================
+
+def _desired_ts(rng):
+    return f"2024-06-{rng.randint(1, 28):02d} {rng.randint(8, 17):02d}:00:00"
+
+
+def _scan_pick(assigner, desired_ts):
+    # What Assigner.pick must return, by looking at every mechanic.
+    slot = assign.slot_of(desired_ts)
+    ranked = sorted((state, tg_id) for tg_id, state in assigner._load.items())
+    free = [tg_id for _, tg_id in ranked if not assigner._slots[tg_id][slot]]
+    return (free or [ranked[0][1]])[0]
+
+
+def bench_assign(cars, n):
+    rng = random.Random(1)
+    for size in (10, 100, 1_000, 10_000):
+        assigner = assign.Assigner(None)
+        assigner.reset([(tg_id, None, None) for tg_id in range(size)])
+        service_ids = itertools.count()
+        open_ids = []
+
+        # Steady state: about 5 open services per mechanic, a random one is
+        # completed for every new one.
+        def decide(i):
+            desired_ts = _desired_ts(rng)
+            service_id = next(service_ids)
+            assigner.assign(service_id, assigner.pick(desired_ts), desired_ts)
+            open_ids.append(service_id)
+            if len(open_ids) > 5 * size:
+                j = rng.randrange(len(open_ids))
+                open_ids[j], open_ids[-1] = open_ids[-1], open_ids[j]
+                assigner.release(open_ids.pop())
+
+        timeit(decide, 6 * size)
+        report(f"pick+assign ({size} mechanics)", timeit(decide, n))
+        for _ in range(100):
+            desired_ts = _desired_ts(rng)
+            assert assigner.pick(desired_ts) == _scan_pick(assigner, desired_ts)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "assign.db")
+        fleetgen.generate(path, cars)
+        assigner = assign.Assigner(path)
+        started = time.perf_counter()
+        assigner.reset(db.load_workload(path))
+        seconds = time.perf_counter() - started
+        open_by_mechanic = dict(db.get_connection(path).execute("""
+            SELECT mechanic_tg_id, COUNT(*) FROM services
+            WHERE status = 'approved' AND mechanic_tg_id IS NOT NULL
+            GROUP BY 1
+        """).fetchall())
+        assert all(assigner.load(m) == c for m, c in open_by_mechanic.items())
+        print(f"load from {cars} cars: {sum(open_by_mechanic.values())} open services, "
+              f"{len(assigner._load)} mechanics in {seconds * 1000:.1f}ms")
+        db.close_connection(path)
+
+
+# ============================================================
+# BULK: clearing the pending queue one service at a time vs in one batch
+# ============================================================
+
+BULK_SIZE = 50
+
+
+def bench_bulk(cars, rounds):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bulk.db")
+        fleetgen.generate(path, cars)
+        pending = [r[0] for r in db.get_connection(path).execute(
+            "SELECT id FROM services WHERE status = 'pending_admin' LIMIT ?",
+            (2 * BULK_SIZE * rounds,)
+        ).fetchall()]
+        batches = [pending[i:i + BULK_SIZE] for i in range(0, len(pending), BULK_SIZE)]
+        admin = fleetgen.ADMIN_BASE
+        singles, bulk = [], []
+        for i in range(rounds):
+            ids = batches[2 * i]
+            t0 = time.perf_counter()
+            for sid in ids:
+                db.admin_approve_service(path, sid, admin)
+            singles.append(time.perf_counter() - t0)
+            t0 = time.perf_counter()
+            db.approve_services(path, batches[2 * i + 1], admin)
+            bulk.append(time.perf_counter() - t0)
+        report(f"{BULK_SIZE} x admin_approve_service", singles)
+        report(f"approve_services({BULK_SIZE})", bulk)
+        db.close_connection(path)
+
+
+# ============================================================
+# CLI
+# ============================================================
+
+def main():
+    parser = argparse.ArgumentParser(description="db.py benchmarks")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("connections", help="connect-per-call vs pooled connections")
+    p.add_argument("-n", type=int, default=2000)
+
+    p = sub.add_parser("plans", help="fail if a hot query does a full table scan")
+    p.add_argument("--db", help="check an existing database instead of a fresh one")
+
+    p = sub.add_parser("split", help="write latency while a long report runs")
+    p.add_argument("--cars", type=int, default=50_000)
+
+    p = sub.add_parser("backup", help="DB latency while a snapshot is taken")
+    p.add_argument("--cars", type=int, default=50_000)
+
+    p = sub.add_parser("archive", help="history reads before / after archiving")
+    p.add_argument("--cars", type=int, default=50_000)
+    p.add_argument("--days", type=int, default=archive.ARCHIVE_AFTER_DAYS)
+    p.add_argument("-n", type=int, default=200)
+
+    p = sub.add_parser("assign", help="automatic mechanic assignment vs fleet size")
+    p.add_argument("--cars", type=int, default=50_000)
+    p.add_argument("-n", type=int, default=5000)
+
+    p = sub.add_parser("bulk", help="approve a queue of services one by one vs in one batch")
+    p.add_argument("--cars", type=int, default=50_000)
+    p.add_argument("-n", type=int, default=20)
+
+    p = sub.add_parser("suite", help="p50/p99 of db.py functions vs a stored baseline")
+    p.add_argument("-n", type=int, default=500)
+    p.add_argument("--cars", type=int, default=20_000,
+                   help="size of the generated fleet (ignored with --db)")
+    p.add_argument("--db", help="run on a copy of this database (e.g. from fleetgen.py)")
+    p.add_argument("--repeat", type=int, default=REPEAT,
+                   help="runs per check; results are their medians")
+    p.add_argument("--baseline", default=BASELINE)
+    p.add_argument("--tolerance", type=float, default=TOLERANCE)
+    p.add_argument("--save", action="store_true", help="store this run as the baseline")
+
+    args = parser.parse_args()
+    if args.cmd == "suite":
+        run = run_suite(args.n, args.cars, args.db, args.repeat)
+        baseline = load_baseline(args.baseline)
+        regressed = compare(run, baseline, args.tolerance)
+        if args.save:
+            save_baseline(args.baseline, run)
+            print(f"baseline saved to {args.baseline}")
+        elif baseline is None:
+            # Nothing was compared; passing here would hide that.
+            raise SystemExit(
+                f"no baseline at {args.baseline}: nothing compared, "
+                f"run with --save to store one"
+            )
+        elif regressed:
+            raise SystemExit(f"{len(regressed)} regression(s): {', '.join(regressed)}")
+    elif args.cmd == "backup":
+        bench_backup(args.cars)
+    elif args.cmd == "assign":
+        bench_assign(args.cars, args.n)
+    elif args.cmd == "bulk":
+        bench_bulk(args.cars, args.n)
+    elif args.cmd == "archive":
+        bench_archive(args.cars, args.days, args.n)
+    elif args.cmd == "split":
+        bench_split(args.cars)
+    elif args.cmd == "connections":
+        bench_connections(args.n)
+    elif args.cmd == "plans":
+        raise SystemExit(0 if check_plans(args.db) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,15 @@
 import os
+import re
+import shlex
+import sqlite3
 import asyncio
-from datetime import datetime
+import tempfile
+from datetime import date, datetime
 
 from aiogram import Bot, Dispatcher, F
-from aiogram.filters import CommandStart
+from aiogram.filters import Command, CommandObject, CommandStart
 from aiogram.types import (
+    FSInputFile,
     Message,
     CallbackQuery,
     InlineKeyboardMarkup,
@@ -14,16 +19,52 @@ from aiogram.types import (
 )
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.memory import MemoryStorage
 
 from dotenv import load_dotenv
-import db
+import adb
+import archive
+from assign import Assigner
+import backup
+from concurrency import ChatScheduler
+from db import DuplicateCarError
+from digest import Notifier, list_refs
+import export
+import importer
+import metrics
+import reports
+import webhook
+from outbox import Outbox, NOTIFICATION
+from storage import SQLiteStorage
 
 # ================= ENV =================
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 DB_PATH = os.getenv("DB_PATH", "fleet.db")
 
+# polling | webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")          # public base URL, e.g. https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+
+# Prometheus text endpoint (GET /metrics), off unless METRICS_PORT is set
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+
+# Admin notifications are collected this long into one digest (0 = off)
+NOTIFY_DIGEST_SECONDS = float(os.getenv("NOTIFY_DIGEST_SECONDS", "300"))
+
+# Completed services older than this move to the archive file (0 = off)
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "365"))
+
+# Online snapshots into BACKUP_DIR every BACKUP_INTERVAL_HOURS (off if unset)
+BACKUP_DIR = os.getenv("BACKUP_DIR")
+BACKUP_INTERVAL_HOURS = float(os.getenv("BACKUP_INTERVAL_HOURS", "24"))
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+
 # ================= ROOT ADMINS =================
 ADMIN_IDS = {5643220428}
 
@@ -38,6 +79,10 @@ class AddCarStates(StatesGroup):
     fuel_type = State()
 
 
+class ImportCarsStates(StatesGroup):
+    file = State()
+
+
 class NewServiceStates(StatesGroup):
     car_identifier = State()
     description = State()
@@ -63,17 +108,17 @@ BTN_MY_SERVICES = "🛠 Мои сервисы"
 
 # ================= HELPERS =================
 async def ensure_user(tg_id: int, full_name: str):
-    db.add_user(DB_PATH, tg_id, full_name)
+    await adb.add_user(DB_PATH, tg_id, full_name)
     if tg_id in ADMIN_IDS:
-        db.set_user_role(DB_PATH, tg_id, "admin")
+        await adb.set_user_role(DB_PATH, tg_id, "admin")
 
 
-def get_role(tg_id: int) -> str:
-    return db.get_user_role(DB_PATH, tg_id) or "user"
+async def get_role(tg_id: int) -> str:
+    return await adb.get_user_role(DB_PATH, tg_id) or "user"
 
 
-def is_admin(tg_id: int) -> bool:
-    return tg_id in ADMIN_IDS or get_role(tg_id) == "admin"
+async def is_admin(tg_id: int) -> bool:
+    return tg_id in ADMIN_IDS or await get_role(tg_id) == "admin"
 
 
 # ================= KEYBOARDS =================
@@ -98,6 +143,7 @@ def cars_kb():
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="➕ Добавить авто", callback_data="car:add")],
         [InlineKeyboardButton(text="📄 Список авто", callback_data="car:list")],
+        [InlineKeyboardButton(text="📥 Импорт CSV / XLSX", callback_data="car:import")],
     ])
 
 
@@ -116,19 +162,39 @@ def admin_kb():
     ])
 
 
-def mechanics_kb(mechanics, service_id):
+def car_candidates_kb(cars):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(
+            text=f"{c['plate'] or '—'} | {c['vin']} | {c['model'] or ''}",
+            callback_data=f"car:pick:{c['id']}"
+        )]
+        for c in cars
+    ])
+
+
+def mechanic_name(m):
+    return m["full_name"] or str(m["tg_id"])
+
+
+def mechanics_kb(mechanics, prefix, load, auto_text=None):
+    # Buttons send <prefix>:<tg_id>, <prefix>:auto and <prefix>:none;
+    # load(tg_id) -> open services.
     rows = []
+    if auto_text:
+        rows.append([
+            InlineKeyboardButton(text=auto_text, callback_data=f"{prefix}:auto")
+        ])
     for m in mechanics:
         rows.append([
             InlineKeyboardButton(
-                text=m["full_name"] or str(m["tg_id"]),
-                callback_data=f"service:assign:{service_id}:{m['tg_id']}"
+                text=f"{mechanic_name(m)} · {load(m['tg_id'])}",
+                callback_data=f"{prefix}:{m['tg_id']}"
             )
         ])
     rows.append([
         InlineKeyboardButton(
             text="Без механика",
-            callback_data=f"service:assign:{service_id}:none"
+            callback_data=f"{prefix}:none"
         )
     ])
     return InlineKeyboardMarkup(inline_keyboard=rows)
@@ -136,14 +202,27 @@ def mechanics_kb(mechanics, service_id):
 
 # ================= BOT =================
 bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+outbox = Outbox(bot)
+notifier = Notifier(outbox, DB_PATH, NOTIFY_DIGEST_SECONDS)
+assigner = Assigner(DB_PATH)
+dp = Dispatcher(storage=SQLiteStorage(DB_PATH))
+scheduler = ChatScheduler()
+scheduler.install(dp)
+metrics.instrument(dp)
+metrics.Gauge("bot_outbox_pending", "Messages waiting in the outbox.", outbox.pending)
+metrics.Gauge(
+    "bot_outbox_messages", "Outbox deliveries by outcome.",
+    lambda: {"sent": outbox.sent, "retried": outbox.retried, "failed": outbox.failed},
+    "outcome",
+)
 
 # ================= START =================
 @dp.message(CommandStart())
 async def start(message: Message):
     await ensure_user(message.from_user.id, message.from_user.full_name or "")
-    role = get_role(message.from_user.id)
-    await message.answer(
+    role = await get_role(message.from_user.id)
+    outbox.send(
+        message.chat.id,
         f"Здравствуйте, {message.from_user.full_name}\nРоль: {role}",
         reply_markup=main_kb(role)
     )
@@ -151,30 +230,30 @@ async def start(message: Message):
 # ================= MAIN MENUS =================
 @dp.message(F.text == BTN_CARS)
 async def cars_menu(message: Message):
-    await message.answer("🚗 Автомобили:", reply_markup=cars_kb())
+    outbox.send(message.chat.id, "🚗 Автомобили:", reply_markup=cars_kb())
 
 
 @dp.message(F.text == BTN_SERVICES)
 async def services_menu(message: Message):
-    await message.answer("🔧 Сервисы:", reply_markup=services_kb())
+    outbox.send(message.chat.id, "🔧 Сервисы:", reply_markup=services_kb())
 
 
 @dp.message(F.text == BTN_ADMIN)
 async def admin_menu(message: Message):
-    if not is_admin(message.from_user.id):
+    if not await is_admin(message.from_user.id):
         return
-    await message.answer("⚙️ Админка:", reply_markup=admin_kb())
+    outbox.send(message.chat.id, "⚙️ Админка:", reply_markup=admin_kb())
 
 # ================= ADMIN =================
 @dp.callback_query(F.data.startswith("admin:add"))
 async def add_role(call: CallbackQuery, state: FSMContext):
     await call.answer()
-    if not is_admin(call.from_user.id):
+    if not await is_admin(call.from_user.id):
         return
     role = "admin" if "admin" in call.data else "mechanic"
     await state.set_state(AddRoleStates.tg_id)
     await state.update_data(role=role)
-    await call.message.answer(f"Введите TG ID для роли {role}")
+    outbox.send(call.message.chat.id, f"Введите TG ID для роли {role}")
 
 
 @dp.message(AddRoleStates.tg_id)
@@ -183,191 +262,754 @@ async def save_role(message: Message, state: FSMContext):
     try:
         tg_id = int(message.text)
     except ValueError:
-        await message.answer("Некорректный TG ID")
+        outbox.send(message.chat.id, "Некорректный TG ID")
         return
-    db.add_user(DB_PATH, tg_id, "")
-    db.set_user_role(DB_PATH, tg_id, data["role"])
+    await adb.add_user(DB_PATH, tg_id, "")
+    await adb.set_user_role(DB_PATH, tg_id, data["role"])
+    if data["role"] == "mechanic":
+        assigner.add_mechanic(tg_id)
+    else:
+        assigner.remove_mechanic(tg_id)
     await state.clear()
-    await message.answer("Готово")
+    outbox.send(message.chat.id, "Готово")
 
 # ================= CARS =================
 @dp.callback_query(F.data == "car:add")
 async def add_car_start(call: CallbackQuery, state: FSMContext):
-    if not is_admin(call.from_user.id):
+    if not await is_admin(call.from_user.id):
         return
     await state.set_state(AddCarStates.vin)
-    await call.message.answer("VIN:")
+    outbox.send(call.message.chat.id, "VIN:")
 
 
 @dp.message(AddCarStates.vin)
 async def add_car_vin(message: Message, state: FSMContext):
     await state.update_data(vin=message.text.upper())
     await state.set_state(AddCarStates.mileage)
-    await message.answer("Пробег:")
+    outbox.send(message.chat.id, "Пробег:")
 
 
 @dp.message(AddCarStates.mileage)
 async def add_car_mileage(message: Message, state: FSMContext):
     await state.update_data(mileage=int(message.text))
     await state.set_state(AddCarStates.year)
-    await message.answer("Год:")
+    outbox.send(message.chat.id, "Год:")
 
 
 @dp.message(AddCarStates.year)
 async def add_car_year(message: Message, state: FSMContext):
     await state.update_data(year=int(message.text))
     await state.set_state(AddCarStates.owner_company)
-    await message.answer("Владелец:")
+    outbox.send(message.chat.id, "Владелец:")
 
 
 @dp.message(AddCarStates.owner_company)
 async def add_car_owner(message: Message, state: FSMContext):
     await state.update_data(owner_company=message.text)
     await state.set_state(AddCarStates.model)
-    await message.answer("Модель:")
+    outbox.send(message.chat.id, "Модель:")
 
 
 @dp.message(AddCarStates.model)
 async def add_car_model(message: Message, state: FSMContext):
     await state.update_data(model=message.text)
     await state.set_state(AddCarStates.plate)
-    await message.answer("Номер:")
+    outbox.send(message.chat.id, "Номер:")
 
 
 @dp.message(AddCarStates.plate)
 async def add_car_plate(message: Message, state: FSMContext):
     await state.update_data(plate=message.text.upper())
     await state.set_state(AddCarStates.fuel_type)
-    await message.answer("Топливо:")
+    outbox.send(message.chat.id, "Топливо:")
 
 
 @dp.message(AddCarStates.fuel_type)
 async def add_car_finish(message: Message, state: FSMContext):
     data = await state.get_data()
-    car_id = db.add_car(DB_PATH, **data, fuel_type=message.text)
     await state.clear()
-    await message.answer(f"Авто добавлено. ID {car_id}")
+    try:
+        car_id = await adb.add_car(DB_PATH, **data, fuel_type=message.text)
+    except DuplicateCarError as e:
+        # One car per normalized VIN / plate.
+        if e.field == "plate":
+            text = f"Номер {data['plate']} уже у авто ID {e.car_id}, ничего не добавлено"
+        else:
+            text = f"Авто с VIN {data['vin']} уже есть (ID {e.car_id}), ничего не добавлено"
+        outbox.send(message.chat.id, text)
+        return
+    except sqlite3.IntegrityError:
+        # cars.vin / cars.plate are UNIQUE as well.
+        outbox.send(message.chat.id, "Такое авто уже есть, ничего не добавлено")
+        return
+    outbox.send(message.chat.id, f"Авто добавлено. ID {car_id}")
+
+# ================= CARS IMPORT =================
+@dp.callback_query(F.data == "car:import")
+async def import_cars_start(call: CallbackQuery, state: FSMContext):
+    await call.answer()
+    if not await is_admin(call.from_user.id):
+        return
+    await state.set_state(ImportCarsStates.file)
+    outbox.send(
+        call.message.chat.id,
+        "Пришлите файл CSV или XLSX с колонками:\n"
+        "VIN, пробег, год, владелец, модель, номер, топливо"
+    )
+
+
+@dp.message(ImportCarsStates.file, F.document)
+async def import_cars_file(message: Message, state: FSMContext):
+    if not await is_admin(message.from_user.id):
+        return
+    await state.clear()
+    name = message.document.file_name or "cars.csv"
+    outbox.send(message.chat.id, "Импортирую…")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        local = os.path.join(tmp, os.path.basename(name))
+        await bot.download(message.document, destination=local)
+        try:
+            with open(local, "rb") as f:
+                result = await importer.import_file_async(DB_PATH, name, f)
+        except ValueError as e:
+            # Unsupported format. Unreadable or broken files end up in
+            # result.failed, and rejected rows in result.errors.
+            outbox.send(message.chat.id, f"Ошибка импорта: {e}")
+            return
+
+    outbox.send(message.chat.id, result.summary())
+
+
+@dp.message(ImportCarsStates.file)
+async def import_cars_not_file(message: Message):
+    outbox.send(message.chat.id, "Нужен файл CSV или XLSX")
 
 # ================= SERVICES =================
 @dp.callback_query(F.data == "service:new")
 async def new_service(call: CallbackQuery, state: FSMContext):
     await state.set_state(NewServiceStates.car_identifier)
-    await call.message.answer("VIN / номер / ID авто:")
+    outbox.send(call.message.chat.id, "VIN / номер / ID авто:")
 
 
 @dp.message(NewServiceStates.car_identifier)
 async def service_car(message: Message, state: FSMContext):
-    car = db.find_car_by_identifier(DB_PATH, message.text)
-    if not car:
-        await message.answer("Авто не найдено")
+    car = await adb.find_car_by_identifier(DB_PATH, message.text)
+    if car:
+        await state.update_data(car_id=car["id"])
+        await state.set_state(NewServiceStates.description)
+        outbox.send(message.chat.id, "Описание работ:")
         return
-    await state.update_data(car_id=car["id"])
+
+    candidates = await adb.search_cars(DB_PATH, message.text)
+    if not candidates:
+        outbox.send(message.chat.id, "Авто не найдено")
+        return
+    outbox.send(
+        message.chat.id,
+        "Точного совпадения нет. Возможно, вы имели в виду:",
+        reply_markup=car_candidates_kb(candidates)
+    )
+
+
+@dp.callback_query(NewServiceStates.car_identifier, F.data.startswith("car:pick:"))
+async def service_car_pick(call: CallbackQuery, state: FSMContext):
+    await call.answer()
+    await state.update_data(car_id=int(call.data.split(":")[2]))
     await state.set_state(NewServiceStates.description)
-    await message.answer("Описание работ:")
+    outbox.send(call.message.chat.id, "Описание работ:")
 
 
 @dp.message(NewServiceStates.description)
 async def service_desc(message: Message, state: FSMContext):
     await state.update_data(description=message.text)
     await state.set_state(NewServiceStates.desired_at)
-    await message.answer("Дата / время:")
+    outbox.send(message.chat.id, "Дата / время (например: завтра 10:00, 21.10 14:30):")
+
+
+# Marked urgent in the description -> admins are pinged at once, not in
+# the next digest.
+URGENT_RE = re.compile(r"срочн|pilne|urgent", re.IGNORECASE)
 
 
 @dp.message(NewServiceStates.desired_at)
 async def service_finish(message: Message, state: FSMContext):
     data = await state.get_data()
-    sid = db.create_service(
+    sid = await adb.create_service(
         DB_PATH,
         car_id=data["car_id"],
         creator_tg_id=message.from_user.id,
-        creator_role=get_role(message.from_user.id),
+        creator_role=await get_role(message.from_user.id),
         description=data["description"],
         desired_at=message.text
     )
     await state.clear()
 
-    if is_admin(message.from_user.id):
-        mechanics = db.list_users_by_role(DB_PATH, "mechanic")
+    if await is_admin(message.from_user.id):
+        mechanics = await adb.list_users_by_role(DB_PATH, "mechanic")
         if mechanics:
-            await message.answer("Выберите механика:", reply_markup=mechanics_kb(mechanics, sid))
+            suggested = assigner.pick(await adb.get_service_desired_ts(DB_PATH, sid))
+            auto_text = next((
+                f"🤖 Авто: {mechanic_name(m)} ({assigner.load(suggested)} в работе)"
+                for m in mechanics if m["tg_id"] == suggested
+            ), None)
+            outbox.send(message.chat.id, "Выберите механика:", reply_markup=mechanics_kb(
+                mechanics, f"service:assign:{sid}", assigner.load, auto_text
+            ))
             return
 
-    for admin_id in ADMIN_IDS:
-        await bot.send_message(admin_id, f"🆕 Создан сервис #{sid}, ожидает подтверждения")
+    await notifier.notify(
+        ADMIN_IDS, "created", f"#{sid}",
+        urgent=bool(URGENT_RE.search(data["description"]))
+    )
+
+    outbox.send(message.chat.id, f"Сервис #{sid} создан")
+
+# ================= PAGES =================
+# Every list view is one message per page (db.PAGE_SIZE rows) with ⬅️ / ➡️
+# buttons that edit it in place, so a view costs one API call however big
+# the table is.
+def short(text, limit=200):
+    text = text or ""
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+def page_kb(view, page, rows=()):
+    rows = list(rows)
+    nav = []
+    if page.prev_cursor is not None:
+        nav.append(InlineKeyboardButton(
+            text="⬅️", callback_data=f"page:{view}:prev:{page.prev_cursor}"
+        ))
+    if page.next_cursor is not None:
+        nav.append(InlineKeyboardButton(
+            text="➡️", callback_data=f"page:{view}:next:{page.next_cursor}"
+        ))
+    if nav:
+        rows.append(nav)
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+# The pending page is a multi-select: ⬜ / ☑️ buttons mark services (the
+# selection is kept in FSM data across pages) and the actions below apply
+# to all of them at once.
+TOGGLES_PER_ROW = 5
 
-    await message.answer(f"Сервис #{sid} создан")
+
+def selection_rows(ids, selected):
+    rows = [
+        [
+            InlineKeyboardButton(
+                text=f"{'☑️' if sid in selected else '⬜'} #{sid}",
+                callback_data=f"bulk:toggle:{sid}"
+            )
+            for sid in ids[i:i + TOGGLES_PER_ROW]
+        ]
+        for i in range(0, len(ids), TOGGLES_PER_ROW)
+    ]
+    n = len(selected)
+    rows.append([
+        InlineKeyboardButton(text=f"✅ Подтвердить ({n})", callback_data="bulk:approve"),
+        InlineKeyboardButton(text=f"❌ Отклонить ({n})", callback_data="bulk:reject"),
+    ])
+    rows.append([
+        InlineKeyboardButton(text=f"👷 Назначить ({n})", callback_data="bulk:assign"),
+        InlineKeyboardButton(text="☑️ Вся страница", callback_data="bulk:page"),
+    ])
+    return rows
+
+
+def reselect_kb(markup, selected):
+    # The same pending page keyboard with new marks: the page's ids and
+    # ⬅️ / ➡️ cursors are taken from the message, not read again.
+    ids = [
+        int(b.callback_data.split(":")[2])
+        for row in markup.inline_keyboard for b in row
+        if b.callback_data.startswith("bulk:toggle:")
+    ]
+    nav = [row for row in markup.inline_keyboard if row[0].callback_data.startswith("page:")]
+    return ids, InlineKeyboardMarkup(inline_keyboard=selection_rows(ids, selected) + nav)
+
+
+async def pending_page(tg_id, cursor=None, backward=False, selected=()):
+    page = await adb.list_pending_services(DB_PATH, cursor=cursor, backward=backward)
+    if not page.rows:
+        return None, None
+    text = "\n\n".join(
+        f"#{s.id} | {s.plate} | {s.desired_at}\n{short(s.description)}"
+        for s in page.rows
+    )
+    rows = selection_rows([s.id for s in page.rows], set(selected))
+    return text, page_kb("pending", page, rows)
+
+
+async def history_page(tg_id, cursor=None, backward=False):
+    mechanic_id = None if await get_role(tg_id) == "admin" else tg_id
+    page = await adb.list_service_history(
+        DB_PATH, mechanic_id, cursor=cursor, backward=backward
+    )
+    if not page.rows:
+        return None, None
+    text = "\n\n".join(
+        f"#{s.id} | {s.plate}\n"
+        f"{short(s.comments)}\n"
+        f"Стоимость: {s.cost_net}"
+        for s in page.rows
+    )
+    return text, page_kb("history", page)
+
+
+async def my_services_page(tg_id, cursor=None, backward=False):
+    page = await adb.get_services_for_mechanic(
+        DB_PATH, tg_id, cursor=cursor, backward=backward
+    )
+    if not page.rows:
+        return None, None
+    text = "\n\n".join(
+        f"#{s.id} | {s.plate} | {s.desired_at}\n{short(s.description)}"
+        for s in page.rows
+    )
+    rows = [
+        [InlineKeyboardButton(text=f"Завершить #{s.id}", callback_data=f"service:finish:{s.id}")]
+        for s in page.rows
+    ]
+    return text, page_kb("my", page, rows)
+
+
+PAGE_VIEWS = {
+    "pending": pending_page,
+    "history": history_page,
+    "my": my_services_page,
+}
+
+
+@dp.callback_query(F.data.startswith("page:"))
+async def page_nav(call: CallbackQuery, state: FSMContext):
+    await call.answer()
+    _, view, direction, cursor = call.data.split(":")
+    if view in ("pending", "search") and not await is_admin(call.from_user.id):
+        return
+    if view == "search":
+        # Offset pages of the query stored by /search.
+        data = await state.get_data()
+        if "search_query" not in data:
+            return
+        text, kb = await search_page(data["search_query"], data["search_car"], int(cursor))
+    else:
+        extra = {}
+        if view == "pending":
+            extra["selected"] = (await state.get_data()).get("bulk_selected", ())
+        text, kb = await PAGE_VIEWS[view](
+            call.from_user.id, int(cursor), backward=direction == "prev", **extra
+        )
+    if text is None:
+        return
+    outbox.edit(call.message.chat.id, call.message.message_id, text, reply_markup=kb)
 
 # ================= PENDING / HISTORY =================
 @dp.callback_query(F.data == "service:pending")
-async def services_pending(call: CallbackQuery):
+async def services_pending(call: CallbackQuery, state: FSMContext):
     await call.answer()
-    if not is_admin(call.from_user.id):
+    if not await is_admin(call.from_user.id):
         return
 
-    services = db.list_pending_services(DB_PATH)
-    if not services:
-        await call.message.answer("Нет ожидающих сервисов")
+    await state.update_data(bulk_selected=[])
+    text, kb = await pending_page(call.from_user.id)
+    if text is None:
+        outbox.send(call.message.chat.id, "Нет ожидающих сервисов")
         return
-
-    for s in services:
-        kb = InlineKeyboardMarkup(inline_keyboard=[
-            [
-                InlineKeyboardButton(text="✅ Подтвердить", callback_data=f"service:admin_approve:{s['id']}"),
-                InlineKeyboardButton(text="❌ Отклонить", callback_data=f"service:admin_reject:{s['id']}")
-            ]
-        ])
-        await call.message.answer(
-            f"#{s['id']} | {s['plate']} | {s['desired_at']}\n{s['description']}",
-            reply_markup=kb
-        )
+    outbox.send(call.message.chat.id, text, reply_markup=kb)
 
 
 @dp.callback_query(F.data == "service:history")
 async def services_history(call: CallbackQuery):
-    role = get_role(call.from_user.id)
-    services = (
-        db.list_service_history(DB_PATH)
-        if role == "admin"
-        else db.list_service_history(DB_PATH, call.from_user.id)
+    text, kb = await history_page(call.from_user.id)
+    if text is None:
+        outbox.send(call.message.chat.id, "История пуста")
+        return
+    outbox.send(call.message.chat.id, text, reply_markup=kb)
+
+# ================= BULK ACTIONS =================
+def refs(ids):
+    return list_refs(f"#{i}" for i in sorted(ids))
+
+
+def bulk_summary(lines, selected, done):
+    skipped = len(selected) - len(done)
+    if skipped:
+        lines.append(f"Пропущено (уже не ожидают): {skipped}")
+    return "\n".join(lines)
+
+
+async def get_selected(state: FSMContext):
+    return (await state.get_data()).get("bulk_selected", [])
+
+
+@dp.callback_query((F.data == "bulk:page") | F.data.startswith("bulk:toggle:"))
+async def bulk_toggle(call: CallbackQuery, state: FSMContext):
+    await call.answer()
+    if not await is_admin(call.from_user.id) or not call.message.reply_markup:
+        return
+    selected = await get_selected(state)
+    ids, _ = reselect_kb(call.message.reply_markup, selected)
+    if call.data == "bulk:page":
+        # Selects the whole page; a second tap clears it again.
+        if all(sid in selected for sid in ids):
+            selected = [sid for sid in selected if sid not in ids]
+        else:
+            selected += [sid for sid in ids if sid not in selected]
+    else:
+        sid = int(call.data.split(":")[2])
+        selected = [s for s in selected if s != sid] if sid in selected else selected + [sid]
+    await state.update_data(bulk_selected=selected)
+    _, kb = reselect_kb(call.message.reply_markup, set(selected))
+    outbox.edit(call.message.chat.id, call.message.message_id, call.message.text, reply_markup=kb)
+
+
+@dp.callback_query(F.data.in_({"bulk:approve", "bulk:reject"}))
+async def bulk_decide(call: CallbackQuery, state: FSMContext):
+    if not await is_admin(call.from_user.id):
+        await call.answer()
+        return
+    selected = await get_selected(state)
+    if not selected:
+        await call.answer("Ничего не выбрано")
+        return
+    await call.answer()
+    if call.data == "bulk:approve":
+        rows = await adb.approve_services(DB_PATH, selected, call.from_user.id)
+        for sid, mech_id, desired_ts in rows:
+            if mech_id:
+                assigner.assign(sid, mech_id, desired_ts)
+        verb = "Подтверждено"
+    else:
+        rows = await adb.reject_services(DB_PATH, selected, call.from_user.id)
+        for sid, _, _ in rows:
+            assigner.release(sid)
+        verb = "Отклонено"
+    await state.update_data(bulk_selected=[])
+    done = [sid for sid, _, _ in rows]
+    outbox.send(call.message.chat.id, bulk_summary([f"{verb}: {len(done)} ({refs(done)})"], selected, done))
+    text, kb = await pending_page(call.from_user.id)
+    outbox.edit(call.message.chat.id, call.message.message_id,
+                text or "Нет ожидающих сервисов", reply_markup=kb)
+
+
+@dp.callback_query(F.data == "bulk:assign")
+async def bulk_assign_pick(call: CallbackQuery, state: FSMContext):
+    if not await is_admin(call.from_user.id):
+        await call.answer()
+        return
+    selected = await get_selected(state)
+    if not selected:
+        await call.answer("Ничего не выбрано")
+        return
+    await call.answer()
+    mechanics = await adb.list_users_by_role(DB_PATH, "mechanic")
+    if not mechanics:
+        outbox.send(call.message.chat.id, "Нет механиков")
+        return
+    # The pending page to re-render once the mechanic is picked.
+    await state.update_data(bulk_page_message=call.message.message_id)
+    outbox.send(
+        call.message.chat.id, f"Назначить выбранные ({len(selected)}):",
+        reply_markup=mechanics_kb(mechanics, "bulk:assign", assigner.load,
+                                  "🤖 Авто: распределить по загрузке"),
     )
 
-    if not services:
-        await call.message.answer("История пуста")
+
+@dp.callback_query(F.data.startswith("bulk:assign:"))
+async def bulk_assign(call: CallbackQuery, state: FSMContext):
+    await call.answer()
+    if not await is_admin(call.from_user.id):
+        return
+    selected = await get_selected(state)
+    if not selected:
+        return
+    mech = call.data.split(":")[2]
+    if mech == "auto":
+        # One pick per service, each seeing the ones before it.
+        desired = await adb.list_desired_ts(DB_PATH, selected)
+        assignments = []
+        for sid in selected:
+            if sid in desired:
+                mech_id = assigner.pick(desired[sid])
+                assigner.assign(sid, mech_id, desired[sid])
+                assignments.append((sid, mech_id))
+    else:
+        mech_id = None if mech == "none" else int(mech)
+        assignments = [(sid, mech_id) for sid in selected]
+    rows = await adb.assign_services(DB_PATH, assignments)
+    done = {sid for sid, _, _ in rows}
+    for sid, mech_id, desired_ts in rows:
+        assigner.assign(sid, mech_id, desired_ts)
+    for sid, _ in assignments:
+        if sid not in done:
+            assigner.release(sid)
+    page_message = (await state.get_data()).get("bulk_page_message")
+    await state.update_data(bulk_selected=[], bulk_page_message=None)
+
+    by_mechanic = {}
+    for sid, mech_id, _ in rows:
+        by_mechanic.setdefault(mech_id, []).append(sid)
+    names = {m["tg_id"]: mechanic_name(m) for m in await adb.list_users_by_role(DB_PATH, "mechanic")}
+    lines = [f"Назначено: {len(done)}"]
+    for mech_id, sids in by_mechanic.items():
+        lines.append(f"{names.get(mech_id, mech_id) if mech_id else 'Без механика'}: {refs(sids)}")
+        if mech_id:
+            text = (f"Вам назначен сервис #{sids[0]}" if len(sids) == 1
+                    else f"Вам назначены сервисы ({len(sids)}): {refs(sids)}")
+            outbox.send(mech_id, text, priority=NOTIFICATION)
+    outbox.edit(call.message.chat.id, call.message.message_id, bulk_summary(lines, selected, done))
+    if page_message:
+        # As after bulk_decide: redraw the page without the checkmarks.
+        text, kb = await pending_page(call.from_user.id)
+        outbox.edit(call.message.chat.id, page_message,
+                    text or "Нет ожидающих сервисов", reply_markup=kb)
+
+# ================= REPORTS =================
+MONTH_RE = re.compile(r"^\d{4}-\d{2}$")
+
+
+@dp.message(Command("report"))
+async def report_month(message: Message, command: CommandObject):
+    # /report [YYYY-MM]
+    if not await is_admin(message.from_user.id):
+        return
+    month = (command.args or "").strip() or reports.current_month()
+    if not MONTH_RE.match(month):
+        outbox.send(message.chat.id, "Формат: /report 2024-05")
+        return
+    text = await adb.read(reports.month_report, DB_PATH, month)
+    outbox.send(message.chat.id, text)
+
+
+@dp.message(Command("invoice"))
+async def report_invoice(message: Message, command: CommandObject):
+    # /invoice <компания> [YYYY-MM]
+    if not await is_admin(message.from_user.id):
         return
+    parts = (command.args or "").split()
+    month = reports.current_month()
+    if parts and MONTH_RE.match(parts[-1]):
+        month = parts.pop()
+    if not parts:
+        outbox.send(message.chat.id, "Формат: /invoice <компания> [2024-05]")
+        return
+    text = await adb.read(reports.invoice_report, DB_PATH, " ".join(parts), month)
+    outbox.send(message.chat.id, text)
+
+# ================= EXPORT =================
+DAY_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+EXPORT_USAGE = (
+    "Формат: /export [csv|xlsx] [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД] "
+    "[company=\"Компания\"] [car=номер/VIN] [mechanic=TG ID]"
+)
 
-    for s in services:
-        await call.message.answer(
-            f"#{s['id']} | {s['plate']}\n"
-            f"{s['comments']}\n"
-            f"Стоимость: {s['cost_net']}"
+
+@dp.message(Command("export"))
+async def export_history(message: Message, command: CommandObject):
+    # History as one CSV / XLSX document. Admins may filter freely,
+    # everyone else only gets their own jobs.
+    try:
+        args = shlex.split(command.args or "")
+    except ValueError:
+        outbox.send(message.chat.id, EXPORT_USAGE)
+        return
+
+    fmt = "csv"
+    filters = {}
+    days = []
+    for arg in args:
+        key, _, value = arg.partition("=")
+        if arg.lower() in export.FORMATS:
+            fmt = arg.lower()
+        elif DAY_RE.match(arg):
+            days.append(arg)
+        elif key == "company" and value:
+            filters["owner_company"] = value
+        elif key == "car" and value:
+            car = await adb.find_car_by_identifier(DB_PATH, value)
+            if not car:
+                outbox.send(message.chat.id, f"Авто {value} не найдено")
+                return
+            filters["car_id"] = car["id"]
+        elif key == "mechanic" and value.isdigit():
+            filters["mechanic_tg_id"] = int(value)
+        else:
+            outbox.send(message.chat.id, EXPORT_USAGE)
+            return
+    if len(days) > 2:
+        outbox.send(message.chat.id, EXPORT_USAGE)
+        return
+    filters.update(zip(("date_from", "date_to"), days))
+    if not await is_admin(message.from_user.id):
+        filters["mechanic_tg_id"] = message.from_user.id
+
+    outbox.send(message.chat.id, "Готовлю файл…")
+    with tempfile.TemporaryDirectory() as tmp:
+        out_path = os.path.join(tmp, f"history_{datetime.now():%Y%m%d_%H%M}.{fmt}")
+        count = await adb.read(
+            export.export_history, DB_PATH, fmt, out_path, **filters
+        )
+        if not count:
+            outbox.send(message.chat.id, "История пуста")
+            return
+        # Wait for delivery: the file lives only as long as tmp.
+        await outbox.submit(
+            message.chat.id,
+            lambda: bot.send_document(
+                message.chat.id, FSInputFile(out_path),
+                caption=f"Сервисов: {count}"
+            )
         )
 
+# ================= CALENDAR =================
+CALENDAR_USAGE = "Формат: /calendar [week] [ГГГГ-ММ-ДД] [mechanic=TG ID]"
+WEEKDAYS = ("Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс")
+MESSAGE_LIMIT = 3500
+
+
+def render_calendar(items):
+    if not items:
+        return "Ничего не запланировано"
+    lines = []
+    day = None
+    for n, s in enumerate(items):
+        if s.desired_ts[:10] != day:
+            day = s.desired_ts[:10]
+            d = date.fromisoformat(day)
+            lines.append(f"\n📅 {WEEKDAYS[d.weekday()]} {d:%d.%m}")
+        status = "" if s.status == "approved" else f" ({STATUS_LABELS[s.status]})"
+        lines.append(f"{s.desired_ts[11:16]} #{s.id} {s.plate} — {short(s.description, 60)}{status}")
+        if sum(map(len, lines)) > MESSAGE_LIMIT and n + 1 < len(items):
+            lines.append(f"… и ещё {len(items) - n - 1}")
+            break
+    return "\n".join(lines).strip()
+
+
+@dp.message(Command("calendar"))
+async def calendar(message: Message, command: CommandObject):
+    # /calendar [week] [YYYY-MM-DD] [mechanic=ID]: admins see the fleet
+    # (or one mechanic), mechanics their own jobs.
+    role = await get_role(message.from_user.id)
+    if role not in ("admin", "mechanic"):
+        return
+    days = 1
+    day_from = date.today().isoformat()
+    mechanic_id = None if role == "admin" else message.from_user.id
+    for arg in (command.args or "").split():
+        key, _, value = arg.partition("=")
+        if arg.lower() in ("week", "неделя"):
+            days = 7
+        elif DAY_RE.match(arg):
+            day_from = arg
+        elif key == "mechanic" and value.isdigit() and role == "admin":
+            mechanic_id = int(value)
+        else:
+            outbox.send(message.chat.id, CALENDAR_USAGE)
+            return
+    try:
+        items = await adb.service_calendar(DB_PATH, day_from, days, mechanic_id)
+    except ValueError:
+        outbox.send(message.chat.id, CALENDAR_USAGE)
+        return
+    outbox.send(message.chat.id, render_calendar(items))
+
+
+# ================= SEARCH =================
+SEARCH_USAGE = 'Формат: /search тормозные колодки [car="WA 12345"]'
+STATUS_LABELS = {
+    "pending_admin": "ждёт подтверждения",
+    "approved": "в работе",
+    "completed": "завершён",
+    "rejected": "отклонён",
+}
+
+
+async def search_page(query, car_id=None, offset=0):
+    page = await adb.search_services(DB_PATH, query, car_id, offset)
+    if not page.rows:
+        return None, None
+    text = "\n\n".join(
+        f"#{s.id} | {s.plate} | {s.vin}\n"
+        f"{(s.completed_at or '')[:10] or STATUS_LABELS.get(s.status, s.status)}: "
+        f"{short(s.description)}"
+        + (f"\n{short(s.comments)}" if s.comments else "")
+        for s in page.rows
+    )
+    return text, page_kb("search", page)
+
+
+@dp.message(Command("search"))
+async def search_command(message: Message, command: CommandObject, state: FSMContext):
+    # /search <слова> [car=номер/VIN]; the query is kept in FSM data for
+    # the page buttons.
+    if not await is_admin(message.from_user.id):
+        return
+    try:
+        args = shlex.split(command.args or "")
+    except ValueError:
+        outbox.send(message.chat.id, SEARCH_USAGE)
+        return
+    words = []
+    car_id = None
+    for arg in args:
+        key, _, value = arg.partition("=")
+        if key == "car" and value:
+            car = await adb.find_car_by_identifier(DB_PATH, value)
+            if not car:
+                outbox.send(message.chat.id, f"Авто {value} не найдено")
+                return
+            car_id = car["id"]
+        else:
+            words.append(arg)
+    query = " ".join(words)
+    if not query:
+        outbox.send(message.chat.id, SEARCH_USAGE)
+        return
+
+    await state.update_data(search_query=query, search_car=car_id)
+    text, kb = await search_page(query, car_id)
+    if text is None:
+        outbox.send(message.chat.id, "Ничего не найдено")
+        return
+    outbox.send(message.chat.id, text, reply_markup=kb)
+
 # ================= ASSIGN / FINISH =================
 @dp.callback_query(F.data.startswith("service:assign"))
 async def assign_mechanic(call: CallbackQuery):
     _, _, sid, mech = call.data.split(":")
-    mech_id = None if mech == "none" else int(mech)
-    db.assign_mechanic(DB_PATH, int(sid), mech_id)
+    sid = int(sid)
+    if mech == "auto":
+        # Picked at tap time, not when the keyboard was sent, and booked
+        # before the write so a second tap meanwhile sees this one.
+        desired_ts = await adb.get_service_desired_ts(DB_PATH, sid)
+        mech_id = assigner.pick(desired_ts)
+        if desired_ts is None or mech_id is None:
+            outbox.send(call.message.chat.id, "Некому назначить")
+            return
+        assigner.assign(sid, mech_id, desired_ts)
+        await adb.assign_mechanic(DB_PATH, sid, mech_id)
+    else:
+        mech_id = None if mech == "none" else int(mech)
+        assigner.assign(sid, mech_id, await adb.assign_mechanic(DB_PATH, sid, mech_id))
     if mech_id:
-        await bot.send_message(mech_id, f"Вам назначен сервис #{sid}")
-    await call.message.answer("Назначено")
+        outbox.send(mech_id, f"Вам назначен сервис #{sid}", priority=NOTIFICATION)
+    if mech == "auto":
+        names = {m["tg_id"]: m["full_name"] for m in await adb.list_users_by_role(DB_PATH, "mechanic")}
+        outbox.send(call.message.chat.id, f"Назначено: {names.get(mech_id) or mech_id}")
+        return
+    outbox.send(call.message.chat.id, "Назначено")
 
 
 @dp.message(F.text == BTN_MY_SERVICES)
 async def my_services(message: Message):
-    services = db.get_services_for_mechanic(DB_PATH, message.from_user.id)
-    if not services:
-        await message.answer("Нет сервисов")
-        return
-
-    for s in services:
-        kb = InlineKeyboardMarkup(inline_keyboard=[[
-            InlineKeyboardButton(text="Завершить", callback_data=f"service:finish:{s['id']}")
-        ]])
-        await message.answer(
-            f"#{s['id']} | {s['plate']} | {s['desired_at']}\n{s['description']}",
-            reply_markup=kb
-        )
+    text, kb = await my_services_page(message.from_user.id)
+    if text is None:
+        outbox.send(message.chat.id, "Нет сервисов")
+        return
+    outbox.send(message.chat.id, text, reply_markup=kb)
 
 
 @dp.callback_query(F.data.startswith("service:finish"))
@@ -375,44 +1017,90 @@ async def finish_service(call: CallbackQuery, state: FSMContext):
     sid = int(call.data.split(":")[2])
     await state.set_state(FinishServiceStates.mileage)
     await state.update_data(service_id=sid)
-    await call.message.answer("Финальный пробег:")
+    outbox.send(call.message.chat.id, "Финальный пробег:")
 
 
 @dp.message(FinishServiceStates.mileage)
 async def finish_mileage(message: Message, state: FSMContext):
     await state.update_data(mileage=int(message.text))
     await state.set_state(FinishServiceStates.cost)
-    await message.answer("Стоимость NETTO:")
+    outbox.send(message.chat.id, "Стоимость NETTO:")
 
 
 @dp.message(FinishServiceStates.cost)
 async def finish_cost(message: Message, state: FSMContext):
     await state.update_data(cost=float(message.text))
     await state.set_state(FinishServiceStates.comment)
-    await message.answer("Комментарий:")
+    outbox.send(message.chat.id, "Комментарий:")
 
 
 @dp.message(FinishServiceStates.comment)
 async def finish_comment(message: Message, state: FSMContext):
     data = await state.get_data()
-    db.set_service_result(
+    await adb.set_service_result(
         DB_PATH,
         data["service_id"],
         data["mileage"],
         data["cost"],
         message.text
     )
+    assigner.release(data["service_id"])
     await state.clear()
 
-    for admin_id in ADMIN_IDS:
-        await bot.send_message(admin_id, f"✅ Сервис #{data['service_id']} завершён")
+    await notifier.notify(ADMIN_IDS, "completed", f"#{data['service_id']}")
 
-    await message.answer("Сервис завершён")
+    outbox.send(message.chat.id, "Сервис завершён")
 
 # ================= START BOT =================
+async def on_shutdown():
+    # aiogram closes the FSM storage first; flush it again once the
+    # scheduler and the outbox are done, since they may still write.
+    # Undelivered digests stay in the database for the next start.
+    await scheduler.close()
+    await notifier.close()
+    await outbox.close()
+    await dp.storage.close()
+
+
 async def main():
-    db.init_db(DB_PATH)
-    await dp.start_polling(bot)
+    adb.slow_query = SLOW_QUERY_MS / 1000
+    await adb.init_db(DB_PATH)
+    metrics_runner = None
+    if METRICS_PORT:
+        metrics_runner = await metrics.serve(METRICS_HOST, METRICS_PORT)
+    outbox.start()
+    await notifier.start()
+    await assigner.start()
+    jobs = []
+    if ARCHIVE_AFTER_DAYS:
+        jobs.append(asyncio.create_task(archive.run_daily(DB_PATH, ARCHIVE_AFTER_DAYS)))
+    if BACKUP_DIR:
+        jobs.append(asyncio.create_task(backup.run_periodically(
+            DB_PATH, BACKUP_DIR, BACKUP_INTERVAL_HOURS * 3600, BACKUP_KEEP
+        )))
+    # Drain pending updates and queued messages on dispatcher shutdown,
+    # before the bot session is closed (both polling and webhook close it
+    # right after).
+    dp.shutdown.register(on_shutdown)
+    try:
+        if BOT_MODE == "webhook":
+            await webhook.serve(
+                dp, bot,
+                host=WEBAPP_HOST, port=WEBAPP_PORT, path=WEBHOOK_PATH,
+                secret=WEBHOOK_SECRET, url=WEBHOOK_URL, background=False,
+            )
+        else:
+            await bot.delete_webhook()
+            # One update at a time into the scheduler, so a full queue
+            # stops getUpdates instead of piling up tasks.
+            await dp.start_polling(bot, handle_as_tasks=False)
+    finally:
+        for job in jobs:
+            job.cancel()
+        await outbox.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await adb.close(DB_PATH)
 
 if __name__ == "__main__":
     asyncio.run(main())
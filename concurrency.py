@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.middlewares.user_context import UserContextMiddleware
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+# ================= SETTINGS =================
+MAX_CONCURRENT = 32       # updates processed at the same time
+MAX_PENDING = 1000        # accepted but unfinished updates before intake blocks
+DRAIN_TIMEOUT = 30
+
+update_wait_seconds = metrics.Histogram(
+    "bot_update_wait_seconds", "Time an update waited for its chat and a free slot.")
+
+
+# Outermost update middleware that takes updates off the dispatcher and
+# runs them itself:
+#   - updates of one chat run strictly one after another, in arrival order
+#     (a per-chat queue drained by one worker), so FSM flows like
+#     AddCarStates never see two steps at once;
+#   - different chats run in parallel, at most MAX_CONCURRENT at a time;
+#   - once MAX_PENDING updates are waiting, intake blocks. The dispatcher
+#     must feed updates one by one for that to push back: polling with
+#     handle_as_tasks=False stops calling getUpdates, webhook without
+#     background handling delays the HTTP answer, and Telegram holds the
+#     rest on its side.
+# It has to sit in front of aiogram's own outer middlewares (install()):
+# the FSM middleware reads the chat's state when the update passes it, so
+# it must only see an update once the previous one of the chat is done.
+class ChatScheduler(BaseMiddleware):
+    def __init__(self, max_concurrent=MAX_CONCURRENT, max_pending=MAX_PENDING):
+        self.max_pending = max_pending
+        self.pending = 0
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._queues = {}
+        self._workers = set()
+        self._room = asyncio.Event()
+        self._room.set()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        metrics.Gauge("bot_updates_pending", "Updates accepted but not finished.",
+                      lambda: self.pending)
+
+    def install(self, dp):
+        manager = dp.update.outer_middleware
+        builtin = list(manager)
+        for middleware in builtin:
+            manager.unregister(middleware)
+        manager.register(self)
+        for middleware in builtin:
+            manager.register(middleware)
+
+    async def __call__(self, handler, event, data):
+        while self.pending >= self.max_pending:
+            self._room.clear()
+            await self._room.wait()
+
+        context = UserContextMiddleware.resolve_event_context(event)
+        if context.chat is not None:
+            key = context.chat.id
+        elif context.user is not None:
+            key = context.user.id
+        else:
+            key = object()
+
+        self.pending += 1
+        self._idle.clear()
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+            worker = asyncio.create_task(self._drain(key, queue))
+            self._workers.add(worker)
+            worker.add_done_callback(self._workers.discard)
+        queue.append((handler, event, data, time.perf_counter()))
+
+    async def _drain(self, key, queue):
+        while queue:
+            handler, event, data, queued = queue[0]
+            try:
+                async with self._slots:
+                    update_wait_seconds.observe(time.perf_counter() - queued)
+                    await handler(event, data)
+            except Exception:
+                # aiogram's errors middleware runs inside; this is what it
+                # re-raises when no error handler took it.
+                log.exception("update %s failed", event.update_id)
+            finally:
+                queue.popleft()
+                self._done()
+        del self._queues[key]
+
+    def _done(self):
+        self.pending -= 1
+        if self.pending < self.max_pending:
+            self._room.set()
+        if not self.pending:
+            self._idle.set()
+
+    async def close(self, timeout=DRAIN_TIMEOUT):
+        # Wait for everything accepted so far.
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            log.warning("shutdown: %s updates still pending after %ss",
+                        self.pending, timeout)
@@ -1,110 +1,751 @@
+import json
+import pathlib
+import re
 import sqlite3
-from datetime import datetime
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
 
 # ============================================================
-# CONNECTION
+# CONNECTION POOL
 # ============================================================
 
+# Applied once to every new connection. WAL lets readers run alongside the
+# writer and, with synchronous=NORMAL, commits no longer fsync the main
+# database file -- only the WAL at checkpoint time.
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA cache_size=-32000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA temp_store=MEMORY",
+)
+
+# Per-connection prepared statement cache (sqlite3 keys it by SQL text).
+# All queries below are constant strings, so every call after the first one
+# reuses an already compiled statement.
+STATEMENT_CACHE_SIZE = 256
+
+
+# Read-only connections for report-style queries. In WAL mode a reader
+# works on a snapshot and never blocks the writer's commits, and
+# query_only makes sure a "read" path cannot write by accident.
+READ_PRAGMAS = (
+    "PRAGMA query_only=1",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA cache_size=-32000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA temp_store=MEMORY",
+)
+
+
+# Completed services older than the archiving cutoff live in a second file
+# next to the database (fleet.db -> fleet-archive.db), attached to every
+# connection as schema "archive". Its services table has the same columns
+# and indexes as the hot one, so history queries run unchanged against it.
+def archive_path(path):
+    p = pathlib.Path(path)
+    return str(p.with_name(f"{p.stem}-archive{p.suffix}"))
+
+
+# sqlite3 connections are bound to the thread that created them, so the pool
+# keeps exactly one connection per (thread, path, mode) and reuses it for
+# the lifetime of the thread. adb.py writes from a single worker thread and
+# reads reports on a few reader threads, each with its own read-only
+# connection. Read-only connections are still only used by their thread,
+# but may be closed from another one once that thread has stopped (see
+# release_readers).
+class ConnectionPool:
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._all = {}
+
+    def get(self, path, readonly=False):
+        conns = getattr(self._local, "conns", None)
+        if conns is None:
+            conns = self._local.conns = {}
+        conn = conns.get((path, readonly))
+        if conn is None:
+            conn = self._open(path, readonly)
+            conns[(path, readonly)] = conn
+            with self._lock:
+                self._all[(threading.get_ident(), path, readonly)] = conn
+        return conn
+
+    def release(self, path):
+        # Closes this thread's connections to path.
+        conns = getattr(self._local, "conns", {})
+        for readonly in (True, False):
+            conn = conns.pop((path, readonly), None)
+            if conn is None:
+                continue
+            with self._lock:
+                self._all.pop((threading.get_ident(), path, readonly), None)
+            if not readonly:
+                conn.execute("PRAGMA optimize")
+            conn.close()
+
+    def release_readers(self, path):
+        # Closes every thread's read-only connection to path. Only call it
+        # when the threads that opened them no longer run queries.
+        with self._lock:
+            keys = [key for key in self._all if key[1] == path and key[2]]
+            conns = [self._all.pop(key) for key in keys]
+        for conn in conns:
+            conn.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "connections": len(self._all),
+                "readers": sum(1 for key in self._all if key[2]),
+            }
+
+    @staticmethod
+    def _open(path, readonly=False):
+        archive = archive_path(path)
+        if readonly:
+            uri = pathlib.Path(path).absolute().as_uri() + "?mode=ro"
+            conn = sqlite3.connect(
+                uri, uri=True, cached_statements=STATEMENT_CACHE_SIZE,
+                check_same_thread=False,
+            )
+            pragmas = READ_PRAGMAS
+            # A reader cannot create the archive; without one there is
+            # nothing archived to read (see _archive_span).
+            if pathlib.Path(archive).exists():
+                conn.execute("ATTACH DATABASE ? AS archive", (
+                    pathlib.Path(archive).absolute().as_uri() + "?mode=ro",
+                ))
+        else:
+            conn = sqlite3.connect(path, cached_statements=STATEMENT_CACHE_SIZE)
+            pragmas = PRAGMAS
+            conn.execute("ATTACH DATABASE ? AS archive", (archive,))
+            conn.execute("PRAGMA archive.journal_mode=WAL")
+            conn.execute("PRAGMA archive.synchronous=NORMAL")
+        conn.row_factory = sqlite3.Row
+        for pragma in pragmas:
+            conn.execute(pragma)
+        return conn
+
+
+_pool = ConnectionPool()
+
+
 def get_connection(path: str):
-    conn = sqlite3.connect(path)
-    conn.row_factory = sqlite3.Row
-    return conn
+    return _pool.get(path)
+
+
+def get_reader(path: str):
+    return _pool.get(path, readonly=True)
+
+
+def close_connection(path: str):
+    _pool.release(path)
+
+
+def close_readers(path: str):
+    _pool.release_readers(path)
+
+
+@contextmanager
+def transaction(path: str):
+    conn = get_connection(path)
+    with conn:
+        yield conn
 
 
 # ============================================================
 # INIT DATABASE
 # ============================================================
 
+# Oldest SQLite library the queries run on: RETURNING (assign_mechanic,
+# the bulk service updates) and MATERIALIZED CTEs (search_services) need
+# 3.35; UPDATE ... FROM needs 3.33, the trigram tokenizer 3.34. FTS5 and
+# JSON1 must be compiled in (JSON1 always is from 3.38).
+MIN_SQLITE = (3, 35, 0)
+
+
+def check_sqlite():
+    # Fails at startup with what is missing, instead of with a syntax
+    # error the first time some handler runs the query that needs it.
+    version = ".".join(map(str, MIN_SQLITE))
+    if sqlite3.sqlite_version_info < MIN_SQLITE:
+        raise RuntimeError(
+            f"SQLite {version}+ is required, Python's sqlite3 uses {sqlite3.sqlite_version}"
+        )
+    conn = sqlite3.connect(":memory:")
+    try:
+        for feature, sql in (
+            ("FTS5 with the trigram tokenizer",
+             "CREATE VIRTUAL TABLE probe USING fts5(x, tokenize='trigram')"),
+            ("JSON1", "SELECT json_extract('[1]', '$[0]')"),
+        ):
+            try:
+                conn.execute(sql)
+            except sqlite3.OperationalError as e:
+                raise RuntimeError(
+                    f"SQLite {sqlite3.sqlite_version} is built without {feature} ({e})"
+                ) from None
+    finally:
+        conn.close()
+
+
 def init_db(path: str):
-    conn = get_connection(path)
-    cur = conn.cursor()
+    check_sqlite()
+    with transaction(path) as conn:
+        cur = conn.cursor()
 
-    # ---------- USERS ----------
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            tg_id INTEGER PRIMARY KEY,
-            full_name TEXT,
-            role TEXT NOT NULL DEFAULT 'user'
+        # ---------- USERS ----------
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                tg_id INTEGER PRIMARY KEY,
+                full_name TEXT,
+                role TEXT NOT NULL DEFAULT 'user'
+            )
+        """)
+
+        # ---------- CARS ----------
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS cars (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                vin TEXT UNIQUE NOT NULL,
+                mileage INTEGER NOT NULL,
+                year INTEGER,
+                owner_company TEXT,
+                model TEXT,
+                plate TEXT UNIQUE,
+                fuel_type TEXT
+            )
+        """)
+
+        # ---------- SERVICES ----------
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS services (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                car_id INTEGER NOT NULL,
+                mechanic_tg_id INTEGER,
+                admin_tg_id INTEGER,
+                created_by_tg_id INTEGER NOT NULL,
+                created_by_role TEXT NOT NULL,
+                description TEXT NOT NULL,
+                desired_at TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending_admin',
+                final_mileage INTEGER,
+                cost_net REAL,
+                comments TEXT,
+                created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                completed_at TEXT,
+                FOREIGN KEY (car_id) REFERENCES cars(id)
+            )
+        """)
+
+        # ---------- ARCHIVE ----------
+        # Same columns as services (archive_services adds any that later
+        # migrations put on services). Only completed jobs end up here; the
+        # indexes mirror the hot history indexes.
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS archive.services (
+                id INTEGER PRIMARY KEY,
+                car_id INTEGER NOT NULL,
+                mechanic_tg_id INTEGER,
+                admin_tg_id INTEGER,
+                created_by_tg_id INTEGER,
+                created_by_role TEXT,
+                description TEXT NOT NULL,
+                desired_at TEXT NOT NULL,
+                status TEXT NOT NULL,
+                final_mileage INTEGER,
+                cost_net REAL,
+                comments TEXT,
+                created_at TEXT NOT NULL,
+                completed_at TEXT
+            )
+        """)
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS archive.idx_archive_status_completed
+            ON services (status, completed_at)
+        """)
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS archive.idx_archive_status_completed_cost
+            ON services (status, completed_at, cost_net)
+        """)
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS archive.idx_archive_mechanic_status_completed
+            ON services (mechanic_tg_id, status, completed_at)
+        """)
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS archive.idx_archive_car
+            ON services (car_id)
+        """)
+
+    migrate(path)
+
+
+# ============================================================
+# MIGRATIONS
+# ============================================================
+
+# Ordered list of (version, name, fn). Each fn gets a connection inside an
+# open transaction; the version row is written in the same transaction, so a
+# migration is either fully applied or not at all. Never edit or reorder an
+# applied migration -- append a new one.
+
+def _add_missing_columns(conn, table, columns):
+    existing = {r["name"] for r in conn.execute(f"PRAGMA table_info({table})")}
+    for name, decl in columns:
+        if name not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+
+
+def _m001_legacy_services_columns(conn):
+    # fleet.db files created by the first version of the bot have no
+    # creator / completion columns, and CREATE TABLE IF NOT EXISTS never
+    # adds them.
+    _add_missing_columns(conn, "services", (
+        ("created_by_tg_id", "INTEGER"),
+        ("created_by_role", "TEXT"),
+        ("completed_at", "TEXT"),
+    ))
+
+
+def _m002_services_indexes(conn):
+    # list_pending_services: status IN (...) ORDER BY created_at.
+    # Partial index -> only open jobs are indexed and rows come out already
+    # ordered, no temp b-tree.
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_services_open_created
+        ON services (created_at)
+        WHERE status IN ('pending_admin', 'approved')
+    """)
+    # get_services_for_mechanic: mechanic_tg_id = ? AND status = ?
+    # ORDER BY desired_at
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_services_mechanic_status_desired
+        ON services (mechanic_tg_id, status, desired_at)
+    """)
+    # list_service_history (mechanic filter): mechanic_tg_id = ? AND
+    # status = 'completed' ORDER BY completed_at DESC
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_services_mechanic_status_completed
+        ON services (mechanic_tg_id, status, completed_at)
+    """)
+    # list_service_history (all) and sum_service_cost: status = 'completed'
+    # ORDER BY / BETWEEN completed_at. cost_net makes it covering for the sum.
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_services_status_completed_cost
+        ON services (status, completed_at, cost_net)
+    """)
+    # Without stats the planner prefers the status index plus a sort over
+    # the partial index for the pending list.
+    conn.execute("ANALYZE services")
+
+
+def _m003_history_keyset_index(conn):
+    # Keyset pages of the full history order by (completed_at, id). In
+    # idx_services_status_completed_cost the implicit rowid comes after
+    # cost_net, which leaves a sort for ties on completed_at.
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_services_status_completed
+        ON services (status, completed_at)
+    """)
+
+
+def _m004_fsm_state(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS fsm_state (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            updated_at REAL NOT NULL
         )
     """)
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_fsm_state_updated
+        ON fsm_state (updated_at)
+    """)
 
-    # ---------- CARS ----------
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS cars (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            vin TEXT UNIQUE NOT NULL,
-            mileage INTEGER NOT NULL,
-            year INTEGER,
-            owner_company TEXT,
-            model TEXT,
-            plate TEXT UNIQUE,
-            fuel_type TEXT
+
+def _m005_car_lookup_keys(conn):
+    _add_missing_columns(conn, "cars", (
+        ("vin_key", "TEXT"),
+        ("plate_key", "TEXT"),
+    ))
+    rows = conn.execute("SELECT id, vin, plate FROM cars").fetchall()
+    conn.executemany(
+        "UPDATE cars SET vin_key = ?, plate_key = ? WHERE id = ?",
+        [(normalize_ident(r["vin"]), normalize_ident(r["plate"]) or None, r["id"])
+         for r in rows]
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_cars_vin_key ON cars (vin_key)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_cars_plate_key ON cars (plate_key)")
+
+    # Trigram index over both keys for partial / fuzzy search. External
+    # content table: the text lives in cars, triggers keep the index in sync.
+    conn.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS cars_fts USING fts5(
+            vin_key, plate_key,
+            content='cars', content_rowid='id', tokenize='trigram'
         )
     """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS cars_fts_ai AFTER INSERT ON cars BEGIN
+            INSERT INTO cars_fts (rowid, vin_key, plate_key)
+            VALUES (new.id, new.vin_key, new.plate_key);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS cars_fts_ad AFTER DELETE ON cars BEGIN
+            INSERT INTO cars_fts (cars_fts, rowid, vin_key, plate_key)
+            VALUES ('delete', old.id, old.vin_key, old.plate_key);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS cars_fts_au
+        AFTER UPDATE OF vin_key, plate_key ON cars BEGIN
+            INSERT INTO cars_fts (cars_fts, rowid, vin_key, plate_key)
+            VALUES ('delete', old.id, old.vin_key, old.plate_key);
+            INSERT INTO cars_fts (rowid, vin_key, plate_key)
+            VALUES (new.id, new.vin_key, new.plate_key);
+        END
+    """)
+    conn.execute("INSERT INTO cars_fts (cars_fts) VALUES ('rebuild')")
 
-    # ---------- SERVICES ----------
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS services (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+
+def _m006_service_stats(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS service_stats (
+            period TEXT NOT NULL,
+            bucket TEXT NOT NULL,
             car_id INTEGER NOT NULL,
-            mechanic_tg_id INTEGER,
-            admin_tg_id INTEGER,
-            created_by_tg_id INTEGER NOT NULL,
-            created_by_role TEXT NOT NULL,
-            description TEXT NOT NULL,
-            desired_at TEXT NOT NULL,
-            status TEXT NOT NULL DEFAULT 'pending_admin',
-            final_mileage INTEGER,
-            cost_net REAL,
-            comments TEXT,
-            created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
-            completed_at TEXT,
-            FOREIGN KEY (car_id) REFERENCES cars(id)
+            owner_company TEXT NOT NULL,
+            mechanic_tg_id INTEGER NOT NULL,
+            services INTEGER NOT NULL,
+            cost_net REAL NOT NULL,
+            max_mileage INTEGER,
+            PRIMARY KEY (period, bucket, car_id, owner_company, mechanic_tg_id)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_service_stats_company
+        ON service_stats (period, owner_company, bucket)
+    """)
+    _rebuild_service_stats(conn)
+
+
+def _m007_notifications(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS notifications (
+            id INTEGER PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            text TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+    """)
+
+
+def _m008_services_fts(conn):
+    # Word index over what was done to a car. Contentless: the text stays
+    # in services (or archive.services), the index keeps only postings, so
+    # archiving a service leaves it searchable. Hence no delete trigger --
+    # services are only ever deleted by archive_services.
+    conn.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS services_fts USING fts5(
+            description, comments,
+            content='', tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3 4 5 6'
         )
     """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS services_fts_ai AFTER INSERT ON services BEGIN
+            INSERT INTO services_fts (rowid, description, comments)
+            VALUES (new.id, new.description, new.comments);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS services_fts_au
+        AFTER UPDATE OF description, comments ON services BEGIN
+            INSERT INTO services_fts (services_fts, rowid, description, comments)
+            VALUES ('delete', old.id, old.description, old.comments);
+            INSERT INTO services_fts (rowid, description, comments)
+            VALUES (new.id, new.description, new.comments);
+        END
+    """)
+    conn.execute("""
+        INSERT INTO services_fts (rowid, description, comments)
+        SELECT id, description, comments FROM main.services
+        UNION ALL
+        SELECT id, description, comments FROM archive.services
+    """)
+    # search_services with a car: the car's services by car_id.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_services_car ON services (car_id)")
+
+
+def _m009_desired_ts(conn):
+    _add_missing_columns(conn, "services", (("desired_ts", "TEXT"),))
+    rows = conn.execute(
+        "SELECT id, desired_at, created_at FROM services WHERE desired_ts IS NULL"
+    ).fetchall()
+    now = datetime.now()
+    updates = []
+    for r in rows:
+        # Legacy rows can have no (or a malformed) created_at: read their
+        # dates relative to today.
+        try:
+            created = datetime.fromisoformat(r["created_at"])
+        except (TypeError, ValueError):
+            created = now
+        updates.append((parse_desired_at(r["desired_at"], created)
+                        or created.strftime(DESIRED_TS_FORMAT), r["id"]))
+    conn.executemany("UPDATE services SET desired_ts = ? WHERE id = ?", updates)
+    # get_services_for_mechanic and the per-mechanic calendar now order by
+    # desired_ts; the fleet calendar is a range scan over all of it.
+    conn.execute("DROP INDEX IF EXISTS idx_services_mechanic_status_desired")
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_services_mechanic_status_desired_ts
+        ON services (mechanic_tg_id, status, desired_ts)
+    """)
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_services_desired_ts
+        ON services (desired_ts)
+    """)
+
+
+def _m010_unique_car_keys(conn):
+    # Until now the key indexes were plain, so 'WVW-ZZZ...' / 'WA12345'
+    # could be added next to 'WVWZZZ...' / 'WA 12345' and lookups found only
+    # one of them. One normalized VIN is one car: its duplicates are merged
+    # into the oldest row, their services (hot and archived) move over. A
+    # plate key held by several cars stays with the newest one; the others
+    # keep their plate text but are no longer found by it.
+    merged = conn.execute("""
+        SELECT c.id, k.keep
+        FROM cars c
+        JOIN (
+            SELECT vin_key, MIN(id) AS keep FROM cars
+            WHERE vin_key IS NOT NULL
+            GROUP BY vin_key HAVING COUNT(*) > 1
+        ) k ON k.vin_key = c.vin_key
+        WHERE c.id != k.keep
+    """).fetchall()
+    for car_id, keep in merged:
+        conn.execute("UPDATE main.services SET car_id = ? WHERE car_id = ?", (keep, car_id))
+        conn.execute("UPDATE archive.services SET car_id = ? WHERE car_id = ?", (keep, car_id))
+        conn.execute("DELETE FROM cars WHERE id = ?", (car_id,))
+    conn.execute("""
+        UPDATE cars SET plate_key = NULL
+        WHERE plate_key IS NOT NULL
+          AND id < (SELECT MAX(id) FROM cars c2 WHERE c2.plate_key = cars.plate_key)
+    """)
+    if merged:
+        _rebuild_service_stats(conn)
+    conn.execute("DROP INDEX IF EXISTS idx_cars_vin_key")
+    conn.execute("DROP INDEX IF EXISTS idx_cars_plate_key")
+    conn.execute("CREATE UNIQUE INDEX idx_cars_vin_key ON cars (vin_key)")
+    conn.execute("""
+        CREATE UNIQUE INDEX idx_cars_plate_key ON cars (plate_key)
+        WHERE plate_key IS NOT NULL
+    """)
+
+
+def _m011_cars_fts_unchanged_keys(conn):
+    # Re-importing a car file updates every row with the keys it already
+    # has; the trigger re-indexed each of them anyway.
+    conn.execute("DROP TRIGGER IF EXISTS cars_fts_au")
+    conn.execute("""
+        CREATE TRIGGER cars_fts_au
+        AFTER UPDATE OF vin_key, plate_key ON cars
+        WHEN old.vin_key IS NOT new.vin_key OR old.plate_key IS NOT new.plate_key
+        BEGIN
+            INSERT INTO cars_fts (cars_fts, rowid, vin_key, plate_key)
+            VALUES ('delete', old.id, old.vin_key, old.plate_key);
+            INSERT INTO cars_fts (rowid, vin_key, plate_key)
+            VALUES (new.id, new.vin_key, new.plate_key);
+        END
+    """)
+
+
+def _m012_services_fts_rank(conn):
+    # search_services orders by rank; words found in the description weigh
+    # twice as much as words found in the comments.
+    conn.execute(
+        "INSERT INTO services_fts (services_fts, rank) VALUES ('rank', 'bm25(2.0, 1.0)')"
+    )
+
+
+MIGRATIONS = (
+    (1, "legacy services columns", _m001_legacy_services_columns),
+    (2, "services hot query indexes", _m002_services_indexes),
+    (3, "history keyset index", _m003_history_keyset_index),
+    (4, "fsm state", _m004_fsm_state),
+    (5, "car lookup keys and trigram search", _m005_car_lookup_keys),
+    (6, "service stats", _m006_service_stats),
+    (7, "notification digests", _m007_notifications),
+    (8, "service full-text search", _m008_services_fts),
+    (9, "normalized desired_at", _m009_desired_ts),
+    (10, "unique car lookup keys", _m010_unique_car_keys),
+    (11, "skip unchanged keys in car search", _m011_cars_fts_unchanged_keys),
+    (12, "rank service search by bm25", _m012_services_fts_rank),
+)
+
+
+def get_schema_version(path):
+    conn = get_connection(path)
+    row = conn.execute(
+        "SELECT COALESCE(MAX(version), 0) AS v FROM schema_version"
+    ).fetchone()
+    return row["v"]
 
-    conn.commit()
-    conn.close()
+
+def migrate(path):
+    with transaction(path) as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+    current = get_schema_version(path)
+    applied = []
+    for version, name, fn in MIGRATIONS:
+        if version <= current:
+            continue
+        with transaction(path) as conn:
+            # DDL does not open an implicit transaction in sqlite3.
+            conn.execute("BEGIN")
+            fn(conn)
+            conn.execute(
+                "INSERT INTO schema_version (version, name) VALUES (?, ?)",
+                (version, name)
+            )
+        applied.append(version)
+    return applied
 
 
 # ============================================================
 # USERS
 # ============================================================
 
+# Roles are read on almost every update and change a few times a month, so
+# get_user_role is served from a bounded LRU cache with a TTL. Writers below
+# update / invalidate it synchronously after their transaction commits.
+ROLE_CACHE_SIZE = 4096
+ROLE_CACHE_TTL = 300
+
+ROLE_CACHE_MISS = object()
+
+
+class RoleCache:
+    def __init__(self, maxsize=ROLE_CACHE_SIZE, ttl=ROLE_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped on every invalidation. A reader that started before a write
+        # must not put its (possibly stale) result back into the cache.
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[1] < now:
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return ROLE_CACHE_MISS
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def generation(self):
+        with self._lock:
+            return self._generation
+
+    def put(self, key, role, generation=None):
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._data[key] = (role, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key=None):
+        with self._lock:
+            self._generation += 1
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+role_cache = RoleCache()
+
+
 def add_user(path, tg_id, full_name):
-    conn = get_connection(path)
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT OR IGNORE INTO users (tg_id, full_name) VALUES (?, ?)",
-        (tg_id, full_name)
-    )
-    conn.commit()
-    conn.close()
+    with transaction(path) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "INSERT OR IGNORE INTO users (tg_id, full_name) VALUES (?, ?)",
+            (tg_id, full_name)
+        )
+    if cur.rowcount:
+        role_cache.invalidate((path, tg_id))
 
 
 def set_user_role(path, tg_id, role):
-    conn = get_connection(path)
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET role = ? WHERE tg_id = ?", (role, tg_id))
-    conn.commit()
-    conn.close()
+    with transaction(path) as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE users SET role = ? WHERE tg_id = ?", (role, tg_id))
+    role_cache.invalidate((path, tg_id))
+    if cur.rowcount:
+        role_cache.put((path, tg_id), role)
 
 
 def get_user_role(path, tg_id):
+    role = role_cache.get((path, tg_id))
+    if role is not ROLE_CACHE_MISS:
+        return role
+    return load_user_role(path, tg_id)
+
+
+def load_user_role(path, tg_id):
+    generation = role_cache.generation()
     conn = get_connection(path)
     cur = conn.cursor()
     cur.execute("SELECT role FROM users WHERE tg_id = ?", (tg_id,))
     row = cur.fetchone()
-    conn.close()
-    return row["role"] if row else None
+    role = row["role"] if row else None
+    role_cache.put((path, tg_id), role, generation)
+    return role
 
 
 def list_users_by_role(path, role):
-    conn = get_connection(path)
+    conn = get_reader(path)
     cur = conn.cursor()
     cur.execute("SELECT tg_id, full_name FROM users WHERE role = ?", (role,))
     rows = cur.fetchall()
-    conn.close()
     return rows
 
 
@@ -117,12 +758,22 @@ def list_cars(path):
     cur = conn.cursor()
     cur.execute("SELECT * FROM cars ORDER BY id DESC")
     rows = cur.fetchall()
-    conn.close()
     return rows
 
 
+# VIN / plate as typed by people: any case, spaces, dashes, and Cyrillic
+# letters that look like Latin ones on Russian plates. Stored next to the
+# raw value at write time and indexed, so lookups are plain index seeks.
+_LOOKALIKES = str.maketrans("АВЕКМНОРСТУХ", "ABEKMHOPCTYX")
+_NOT_ALNUM = re.compile(r"[^0-9A-ZА-ЯЁ]")
+
+
+def normalize_ident(value):
+    return _NOT_ALNUM.sub("", str(value or "").upper().translate(_LOOKALIKES))
+
+
 def find_car_by_identifier(path, identifier):
-    ident = identifier.strip().upper()
+    ident = identifier.strip()
     conn = get_connection(path)
     cur = conn.cursor()
 
@@ -130,160 +781,1005 @@ def find_car_by_identifier(path, identifier):
         cur.execute("SELECT * FROM cars WHERE id = ?", (int(ident),))
         car = cur.fetchone()
         if car:
-            conn.close()
             return car
 
+    key = normalize_ident(ident)
+    if not key:
+        return None
     cur.execute(
-        "SELECT * FROM cars WHERE UPPER(vin)=? OR UPPER(plate)=?",
-        (ident, ident)
+        "SELECT * FROM cars WHERE vin_key = ? OR plate_key = ?",
+        (key, key)
     )
     car = cur.fetchone()
-    conn.close()
     return car
 
 
+SEARCH_LIMIT = 8
+SEARCH_CANDIDATES = 20
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _similarity(grams, car):
+    # Shared trigrams with the closer of the two keys (Jaccard).
+    best = 0.0
+    for column in ("plate_key", "vin_key"):
+        other = _trigrams(car[column] or "")
+        if other:
+            best = max(best, len(grams & other) / len(grams | other))
+    return best
+
+
+def search_cars(path, query, limit=SEARCH_LIMIT):
+    # Candidates for a VIN / plate that did not match exactly, cheapest
+    # first, every step bounded by LIMIT:
+    #   1. key prefix -- index range scans on vin_key / plate_key;
+    #   2. substring  -- trigram FTS phrase match;
+    #   3. one typo   -- a substitution leaves one half of the key intact,
+    #      so phrase-match each half.
+    # Steps 2-3 never ORDER BY bm25 (that walks every posting of common
+    # trigrams such as a shared VIN prefix); the few candidates are ranked
+    # here by similarity to the query instead.
+    key = normalize_ident(query)
+    if len(key) < 2:
+        return []
+    conn = get_connection(path)
+
+    prefix = {}
+    for column in ("plate_key", "vin_key"):
+        for row in conn.execute(
+            f"SELECT * FROM cars WHERE {column} >= ? AND {column} < ? "
+            f"ORDER BY {column} LIMIT ?",
+            (key, key + "\uffff", limit)
+        ):
+            prefix.setdefault(row["id"], row)
+    if len(prefix) >= limit or len(key) < 3:
+        return list(prefix.values())[:limit]
+
+    phrases = [key]
+    if len(key) >= 6:
+        half = len(key) // 2
+        phrases += [key[:half], key[half:]]
+
+    others = {}
+    for phrase in phrases:
+        for row in conn.execute("""
+            SELECT c.*
+            FROM cars_fts f
+            JOIN cars c ON c.id = f.rowid
+            WHERE cars_fts MATCH ?
+            LIMIT ?
+        """, (f'"{phrase}"', SEARCH_CANDIDATES)):
+            if row["id"] not in prefix:
+                others.setdefault(row["id"], row)
+
+    grams = _trigrams(key)
+    ranked = sorted(others.values(), key=lambda r: -_similarity(grams, r))
+    return (list(prefix.values()) + ranked)[:limit]
+
+
+CAR_FIELDS = ("vin", "mileage", "year", "owner_company", "model", "plate", "fuel_type")
+
+
+class DuplicateCarError(ValueError):
+    # field: "vin" or "plate"; car_id: the car that already has it.
+    def __init__(self, field, car_id):
+        super().__init__(f"{field} already belongs to car {car_id}")
+        self.field = field
+        self.car_id = car_id
+
+
+def add_car(path, vin, mileage, year, owner_company, model, plate, fuel_type):
+    # Raises DuplicateCarError when another car has the same VIN or plate
+    # once normalized ('WA12345' is 'WA 12345').
+    vin_key, plate_key = normalize_ident(vin), normalize_ident(plate) or None
+    with transaction(path) as conn:
+        cur = conn.cursor()
+        for field, key in (("vin", vin_key), ("plate", plate_key)):
+            row = key and conn.execute(
+                f"SELECT id FROM cars WHERE {field}_key = ?", (key,)
+            ).fetchone()
+            if row:
+                raise DuplicateCarError(field, row[0])
+        cur.execute("""
+            INSERT INTO cars (
+                vin, mileage, year, owner_company, model, plate, fuel_type,
+                vin_key, plate_key
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (vin, mileage, year, owner_company, model, plate, fuel_type,
+              vin_key, plate_key))
+    return cur.lastrowid
+
+
+# The import rows as a table: one statement writes a whole chunk. Besides
+# fewer round trips this matters for cars_fts: FTS5 flushes its pending
+# index data at the end of every statement, so row-by-row writes built one
+# tiny index segment per car and made the triggers most of the import time.
+_CAR_ROWS = """
+    SELECT json_extract(value, '$.vin') AS vin,
+           json_extract(value, '$.mileage') AS mileage,
+           json_extract(value, '$.year') AS year,
+           json_extract(value, '$.owner_company') AS owner_company,
+           json_extract(value, '$.model') AS model,
+           json_extract(value, '$.plate') AS plate,
+           json_extract(value, '$.fuel_type') AS fuel_type
+    FROM json_each(?)
+"""
+
+
+def _write_cars(conn, sql, rows, rejected):
+    # rows: [(line, car)]. A failed statement changes nothing, so if one row
+    # still breaks a constraint the chunk is replayed row by row and only
+    # that row is rejected. Returns the number of rows written.
+    if not rows:
+        return 0
+    try:
+        conn.execute(sql, (json.dumps([car for _, car in rows]),))
+        return len(rows)
+    except sqlite3.IntegrityError:
+        pass
+    written = 0
+    for line, car in rows:
+        try:
+            conn.execute(sql, (json.dumps([car]),))
+        except sqlite3.IntegrityError as e:
+            rejected.append((line, f"конфликт с существующим авто ({e})"))
+        else:
+            written += 1
+    return written
+
+
+def upsert_cars(path, cars):
+    # Bulk insert-or-update keyed on VIN, one transaction per call.
+    # cars: list of (line, {CAR_FIELDS}) with vin / plate already passed
+    # through normalize_ident, so they double as the lookup keys.
+    # A row is rejected when its plate already belongs to another VIN (in
+    # the table or earlier in the same batch), or when writing it breaks a
+    # constraint anyway. Returns (inserted, updated, [(line, reason), ...]).
+    rejected = []
+    by_vin = {}
+    for line, car in cars:
+        by_vin[car["vin"]] = (line, car)     # last row for a VIN wins
+
+    with transaction(path) as conn:
+        vins = json.dumps(list(by_vin))
+        plates = json.dumps([c["plate"] for _, c in by_vin.values() if c["plate"]])
+        existing = {
+            r["vin_key"]: r["plate_key"] for r in conn.execute(
+                "SELECT vin_key, plate_key FROM cars "
+                "WHERE vin_key IN (SELECT value FROM json_each(?))",
+                (vins,)
+            )
+        }
+        plate_owner = {
+            r["plate_key"]: r["vin_key"] for r in conn.execute(
+                "SELECT vin_key, plate_key FROM cars "
+                "WHERE plate_key IN (SELECT value FROM json_each(?))",
+                (plates,)
+            )
+        }
+
+        inserts, updates = [], []
+        for vin, (line, car) in by_vin.items():
+            plate = car["plate"]
+            owner = plate_owner.get(plate) if plate else None
+            if owner is not None and owner != vin:
+                rejected.append((line, f"номер {plate} уже у VIN {owner}"))
+                continue
+            if plate:
+                plate_owner[plate] = vin
+            if vin in existing:
+                old_plate = existing[vin]
+                if old_plate and old_plate != plate:
+                    plate_owner.pop(old_plate, None)
+                updates.append((line, car))
+            else:
+                inserts.append((line, car))
+
+        # Updates first: they may free plates that new rows take over.
+        updated = _write_cars(conn, f"""
+            UPDATE cars
+            SET mileage = r.mileage,
+                year = r.year,
+                owner_company = r.owner_company,
+                model = r.model,
+                plate = r.plate,
+                fuel_type = r.fuel_type,
+                plate_key = r.plate
+            FROM ({_CAR_ROWS}) AS r
+            WHERE cars.vin_key = r.vin
+        """, updates, rejected)
+        inserted = _write_cars(conn, f"""
+            INSERT INTO cars (
+                vin, mileage, year, owner_company, model, plate, fuel_type,
+                vin_key, plate_key
+            )
+            SELECT vin, mileage, year, owner_company, model, plate, fuel_type,
+                   vin, plate
+            FROM ({_CAR_ROWS})
+        """, inserts, rejected)
+
+    return inserted, updated, rejected
+
+
+# ============================================================
+# PAGINATION
+# ============================================================
+
+# List views are keyset-paginated on (sort column, services.id): a page costs
+# one index range scan of `limit` rows no matter how deep into the table it
+# is. The cursor handed to the bot is just a service id (short enough for
+# callback_data); its sort key is looked up by primary key.
+PAGE_SIZE = 10
+
+Page = namedtuple("Page", "rows prev_cursor next_cursor")
+
+# Page rows: each view selects just the columns it shows (plus its sort
+# column) into a plain tuple type instead of s.*, c.* as sqlite3.Row.
+ServiceItem = namedtuple("ServiceItem", "id plate desired_at description created_at")
+HistoryItem = namedtuple("HistoryItem", "id plate comments cost_net completed_at")
+
+
+def _fetch(conn, sql, params, row_type):
+    cur = conn.cursor()
+    cur.row_factory = None
+    return list(map(row_type._make, cur.execute(sql, params).fetchall()))
+
+
+def _keyset_page(conn, sql, params, column, cursor, backward, limit,
+                 row_type, descending=False, archive_sql=None):
+    # sql selects the fields of row_type, in order, from services s.
+    # archive_sql: the same query over archive.services. It only runs when
+    # the archive can hold rows of this page (see _archive_reaches); its
+    # rows are merged with the hot ones by (column, id).
+    forward_op, forward_dir = ("<", "DESC") if descending else (">", "ASC")
+    reverse_op, reverse_dir = (">", "ASC") if descending else ("<", "DESC")
+    op, direction = (reverse_op, reverse_dir) if backward else (forward_op, forward_dir)
+
+    params = list(params)
+    key = None
+    where = ""
+    if cursor is not None:
+        key = _sort_key(conn, column, cursor, archive_sql is not None)
+        if key is None:
+            return Page([], None, None)
+        where = f" AND (s.{column}, s.id) {op} (?, ?)"
+        params += [key[0], cursor]
+    order = f" ORDER BY s.{column} {direction}, s.id {direction} LIMIT ?"
+    params.append(limit + 1)
+
+    rows = _fetch(conn, sql + where + order, params, row_type)
+    if archive_sql is not None and _archive_reaches(
+            conn, column, key and key[0], rows, limit, direction):
+        rows += _fetch(conn, archive_sql + where + order, params, row_type)
+        rows.sort(key=lambda r: (getattr(r, column) is not None,
+                                 getattr(r, column) or "", r.id),
+                  reverse=direction == "DESC")
+        del rows[limit + 1:]
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if not rows:
+        return Page([], None, None)
+
+    if backward:
+        rows.reverse()
+        return Page(rows, rows[0].id if more else None, rows[-1].id)
+    return Page(
+        rows,
+        rows[0].id if cursor is not None else None,
+        rows[-1].id if more else None,
+    )
+
+
+def _sort_key(conn, column, cursor, archived):
+    key = conn.execute(
+        f"SELECT {column} FROM services WHERE id = ?", (cursor,)
+    ).fetchone()
+    if key is None and archived and _archive_span(conn, column) is not None:
+        key = conn.execute(
+            f"SELECT {column} FROM archive.services WHERE id = ?", (cursor,)
+        ).fetchone()
+    return key
+
+
+def _archive_reaches(conn, column, key, rows, limit, direction):
+    # True if archived rows can sort between the cursor key (None: no
+    # cursor) and the last hot row of the page, or past it when the hot rows
+    # ran out. Recent pages stop at the hot table.
+    span = _archive_span(conn, column)
+    if span is None:
+        return False
+    lo, hi = span
+    last = (getattr(rows[-1], column) or "") if len(rows) > limit else None
+    if direction == "DESC":
+        return (not key or lo <= key) and (last is None or hi >= last)
+    return (not key or hi >= key) and (last is None or lo <= last)
+
+
 # ============================================================
 # SERVICES
 # ============================================================
 
+# desired_at is whatever the user typed; desired_ts is it parsed into
+# "YYYY-MM-DD HH:MM:SS" so schedules sort and range-scan by time. Accepted:
+# "сегодня" / "завтра" / "послезавтра", DD.MM, DD.MM.YY(YY), YYYY-MM-DD,
+# each optionally followed by HH:MM, or just HH:MM (today). Without a year the date is taken in
+# the year of `now`, or the next one if it would be over a month ago
+# ("05.01" typed in December).
+_DESIRED_RE = re.compile(
+    r"^\s*(?:(?P<word>сегодня|завтра|послезавтра)"
+    r"|(?P<iso>\d{4}-\d{2}-\d{2})"
+    r"|(?P<d>\d{1,2})[./](?P<m>\d{1,2})(?:[./](?P<y>\d{2}|\d{4}))?)?"
+    r"(?:[\s,T]*(?:в\s*)?(?P<H>\d{1,2})[:.](?P<M>\d{2}))?\s*$",
+    re.IGNORECASE,
+)
+_DESIRED_WORDS = {"сегодня": 0, "завтра": 1, "послезавтра": 2}
+DESIRED_TS_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def parse_desired_at(text, now=None):
+    # Returns desired_ts, or None if the text is not a date.
+    now = now or datetime.now()
+    m = _DESIRED_RE.match(text or "")
+    if m is None or not (m["word"] or m["iso"] or m["d"] or m["H"]):
+        return None
+    try:
+        if m["word"]:
+            day = now.date() + timedelta(days=_DESIRED_WORDS[m["word"].lower()])
+        elif m["iso"]:
+            day = date.fromisoformat(m["iso"])
+        elif not m["d"]:
+            day = now.date()
+        else:
+            year = int(m["y"]) if m["y"] else now.year
+            day = date(year + 2000 if year < 100 else year, int(m["m"]), int(m["d"]))
+            if not m["y"] and day < now.date() - timedelta(days=31):
+                day = day.replace(year=day.year + 1)
+        at = datetime(day.year, day.month, day.day, int(m["H"] or 0), int(m["M"] or 0))
+    except ValueError:
+        return None
+    return at.strftime(DESIRED_TS_FORMAT)
+
+
 def create_service(path, car_id, creator_tg_id, creator_role,
                    description, desired_at, mechanic_tg_id=None):
-    conn = get_connection(path)
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO services (
-            car_id, mechanic_tg_id,
-            created_by_tg_id, created_by_role,
-            description, desired_at
-        ) VALUES (?, ?, ?, ?, ?, ?)
-    """, (car_id, mechanic_tg_id, creator_tg_id, creator_role,
-          description, desired_at))
-    conn.commit()
+    # Text that is not a date is scheduled "as soon as possible": at the
+    # time it was entered.
+    now = datetime.now()
+    desired_ts = parse_desired_at(desired_at, now) or now.strftime(DESIRED_TS_FORMAT)
+    with transaction(path) as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO services (
+                car_id, mechanic_tg_id,
+                created_by_tg_id, created_by_role,
+                description, desired_at, desired_ts
+            ) VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (car_id, mechanic_tg_id, creator_tg_id, creator_role,
+              description, desired_at, desired_ts))
     sid = cur.lastrowid
-    conn.close()
     return sid
 
 
 def assign_mechanic(path, service_id, mechanic_tg_id):
+    # Returns the service's desired_ts, None if there is no such service.
+    with transaction(path) as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE services
+            SET mechanic_tg_id = ?, status='approved'
+            WHERE id = ?
+            RETURNING desired_ts
+        """, (mechanic_tg_id, service_id))
+        row = cur.fetchone()
+    return row[0] if row else None
+
+
+def get_service_desired_ts(path, service_id):
+    row = get_reader(path).execute(
+        "SELECT desired_ts FROM services WHERE id = ?", (service_id,)
+    ).fetchone()
+    return row[0] if row else None
+
+
+def load_workload(path):
+    # (mechanic tg_id, open service id, desired_ts) for assign.Assigner;
+    # mechanics without open services come with None, None. One lookup in
+    # idx_services_mechanic_status_desired_ts per mechanic.
     conn = get_connection(path)
     cur = conn.cursor()
+    cur.row_factory = None
     cur.execute("""
-        UPDATE services
-        SET mechanic_tg_id = ?, status='approved'
-        WHERE id = ?
-    """, (mechanic_tg_id, service_id))
-    conn.commit()
-    conn.close()
+        SELECT u.tg_id, s.id, s.desired_ts
+        FROM users u
+        LEFT JOIN services s
+          ON s.mechanic_tg_id = u.tg_id AND s.status = 'approved'
+        WHERE u.role = 'mechanic'
+    """)
+    return cur.fetchall()
 
 
 def admin_approve_service(path, service_id, admin_tg_id):
-    conn = get_connection(path)
-    cur = conn.cursor()
-    cur.execute("""
+    with transaction(path) as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE services
+            SET status='approved', admin_tg_id=?
+            WHERE id = ?
+        """, (admin_tg_id, service_id))
+
+
+def admin_reject_service(path, service_id, admin_tg_id):
+    with transaction(path) as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE services
+            SET status='rejected', admin_tg_id=?
+            WHERE id = ?
+        """, (admin_tg_id, service_id))
+
+
+# Bulk versions for the pending queue: one statement and one commit for
+# the whole selection. Only services still open are touched (a selection
+# can be stale by the time it is applied); each returns the changed
+# services as (id, mechanic_tg_id, desired_ts) rows.
+def approve_services(path, service_ids, admin_tg_id):
+    return _update_open_services(path, """
         UPDATE services
         SET status='approved', admin_tg_id=?
-        WHERE id = ?
-    """, (admin_tg_id, service_id))
-    conn.commit()
-    conn.close()
+        WHERE id IN (SELECT value FROM json_each(?))
+          AND status = 'pending_admin'
+        RETURNING id, mechanic_tg_id, desired_ts
+    """, (admin_tg_id, json.dumps(list(service_ids))))
 
 
-def admin_reject_service(path, service_id, admin_tg_id):
-    conn = get_connection(path)
-    cur = conn.cursor()
-    cur.execute("""
+def reject_services(path, service_ids, admin_tg_id):
+    return _update_open_services(path, """
         UPDATE services
         SET status='rejected', admin_tg_id=?
-        WHERE id = ?
-    """, (admin_tg_id, service_id))
-    conn.commit()
-    conn.close()
+        WHERE id IN (SELECT value FROM json_each(?))
+          AND status IN ('pending_admin', 'approved')
+        RETURNING id, mechanic_tg_id, desired_ts
+    """, (admin_tg_id, json.dumps(list(service_ids))))
 
 
-def list_pending_services(path):
-    conn = get_connection(path)
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT s.*, c.*
-        FROM services s
-        JOIN cars c ON c.id = s.car_id
-        WHERE s.status IN ('pending_admin', 'approved')
-        ORDER BY s.created_at
-    """)
-    rows = cur.fetchall()
-    conn.close()
-    return rows
+def assign_services(path, assignments):
+    # assignments: [(service_id, mechanic_tg_id or None)], so one batch can
+    # spread services over several mechanics.
+    return _update_open_services(path, """
+        UPDATE services
+        SET mechanic_tg_id = a.mechanic, status='approved'
+        FROM (
+            SELECT json_extract(value, '$[0]') AS id,
+                   json_extract(value, '$[1]') AS mechanic
+            FROM json_each(?)
+        ) AS a
+        WHERE services.id = a.id
+          AND services.status IN ('pending_admin', 'approved')
+        RETURNING services.id, services.mechanic_tg_id, services.desired_ts
+    """, (json.dumps([list(a) for a in assignments]),))
 
 
-def get_services_for_mechanic(path, mechanic_tg_id):
-    conn = get_connection(path)
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT s.*, c.*
-        FROM services s
-        JOIN cars c ON c.id = s.car_id
-        WHERE s.mechanic_tg_id = ?
-          AND s.status = 'approved'
-        ORDER BY s.desired_at
-    """, (mechanic_tg_id,))
-    rows = cur.fetchall()
-    conn.close()
+def _update_open_services(path, sql, params):
+    with transaction(path) as conn:
+        cur = conn.cursor()
+        cur.row_factory = None
+        cur.execute(sql, params)
+        rows = cur.fetchall()
     return rows
 
 
-def set_service_result(path, svc_id, final_mileage, cost_net, comments):
-    conn = get_connection(path)
-    cur = conn.cursor()
-    cur.execute("""
-        UPDATE services
-        SET final_mileage = ?,
-            cost_net = ?,
-            comments = ?,
-            status = 'completed',
-            completed_at = ?
-        WHERE id = ?
-    """, (final_mileage, cost_net, comments,
-          datetime.now().isoformat(), svc_id))
-    conn.commit()
-    conn.close()
-
-
-def list_service_history(path, mechanic_tg_id=None):
-    conn = get_connection(path)
-    cur = conn.cursor()
+def list_desired_ts(path, service_ids):
+    # {service id: desired_ts}
+    return dict(get_reader(path).execute(
+        "SELECT id, desired_ts FROM services WHERE id IN (SELECT value FROM json_each(?))",
+        (json.dumps(list(service_ids)),)
+    ).fetchall())
 
-    if mechanic_tg_id:
-        cur.execute("""
-            SELECT s.*, c.*
+
+def list_pending_services(path, cursor=None, backward=False, limit=PAGE_SIZE):
+    return _keyset_page(
+        get_reader(path), """
+            SELECT s.id, c.plate, s.desired_at, s.description, s.created_at
             FROM services s
             JOIN cars c ON c.id = s.car_id
-            WHERE s.mechanic_tg_id = ?
-              AND s.status = 'completed'
-            ORDER BY s.completed_at DESC
-        """, (mechanic_tg_id,))
-    else:
-        cur.execute("""
-            SELECT s.*, c.*
+            WHERE s.status IN ('pending_admin', 'approved')
+        """, (), "created_at", cursor, backward, limit, ServiceItem
+    )
+
+
+def get_services_for_mechanic(path, mechanic_tg_id, cursor=None,
+                              backward=False, limit=PAGE_SIZE):
+    return _keyset_page(
+        get_connection(path), """
+            SELECT s.id, c.plate, s.desired_at, s.description, s.created_at
             FROM services s
             JOIN cars c ON c.id = s.car_id
-            WHERE s.status = 'completed'
-            ORDER BY s.completed_at DESC
-        """)
+            WHERE s.mechanic_tg_id = ?
+              AND s.status = 'approved'
+        """, (mechanic_tg_id,), "desired_ts", cursor, backward, limit, ServiceItem
+    )
 
-    rows = cur.fetchall()
-    conn.close()
-    return rows
+
+def set_service_result(path, svc_id, final_mileage, cost_net, comments):
+    with transaction(path) as conn:
+        cur = conn.cursor()
+        # Finishing an already completed service again replaces its numbers
+        # in the stats instead of counting it twice.
+        _bump_service_stats(conn, svc_id, -1)
+        cur.execute("""
+            UPDATE services
+            SET final_mileage = ?,
+                cost_net = ?,
+                comments = ?,
+                status = 'completed',
+                completed_at = ?
+            WHERE id = ?
+        """, (final_mileage, cost_net, comments,
+              datetime.now().isoformat(), svc_id))
+        _bump_service_stats(conn, svc_id, +1)
+
+
+def list_service_history(path, mechanic_tg_id=None, cursor=None,
+                         backward=False, limit=PAGE_SIZE):
+    conn = get_reader(path)
+    sql = """
+        SELECT s.id, c.plate, s.comments, s.cost_net, s.completed_at
+        FROM {} s
+        JOIN cars c ON c.id = s.car_id
+        WHERE s.status = 'completed'
+    """
+    params = ()
+    if mechanic_tg_id:
+        sql += " AND s.mechanic_tg_id = ?"
+        params = (mechanic_tg_id,)
+
+    return _keyset_page(
+        conn, sql.format("services"), params, "completed_at", cursor, backward,
+        limit, HistoryItem, descending=True, archive_sql=sql.format("archive.services"),
+    )
+
+
+EXPORT_BATCH = 1000
+
+
+def iter_service_history(path, date_from=None, date_to=None, owner_company=None,
+                         car_id=None, mechanic_tg_id=None, batch=EXPORT_BATCH):
+    # Completed services oldest first, as a generator: rows are pulled from
+    # SQLite `batch` at a time, so a year of history never sits in memory.
+    # date_from / date_to are inclusive days (YYYY-MM-DD). Must be consumed
+    # on the thread that called it (sqlite3 connections are per thread).
+    conn = get_reader(path)
+    sql = """
+        SELECT s.id, s.completed_at, c.plate, c.vin, c.model, c.owner_company,
+               s.mechanic_tg_id, s.description, s.final_mileage, s.cost_net,
+               s.comments
+        FROM {} s
+        JOIN cars c ON c.id = s.car_id
+        WHERE s.status = 'completed'
+    """
+    params = []
+    if date_from:
+        sql += " AND s.completed_at >= ?"
+        params.append(date_from)
+    if date_to:
+        sql += " AND s.completed_at < date(?, '+1 day')"
+        params.append(date_to)
+    if owner_company is not None:
+        sql += " AND c.owner_company = ?"
+        params.append(owner_company)
+    if car_id is not None:
+        sql += " AND s.car_id = ?"
+        params.append(car_id)
+    if mechanic_tg_id is not None:
+        sql += " AND s.mechanic_tg_id = ?"
+        params.append(mechanic_tg_id)
+
+    if _archive_overlaps(conn, date_from, date_to):
+        # Both sides come out of their indexes in order and are merged.
+        sql = f"{sql.format('services')} UNION ALL {sql.format('archive.services')}"
+        params += params
+        sql += " ORDER BY 2, 1"
+    else:
+        sql = sql.format("services") + " ORDER BY s.completed_at, s.id"
+
+    cur = conn.execute(sql, params)
+    try:
+        while True:
+            rows = cur.fetchmany(batch)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        cur.close()
 
 
 def sum_service_cost(path, date_from, date_to):
-    conn = get_connection(path)
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT COALESCE(SUM(cost_net),0) as total
-        FROM services
+    conn = get_reader(path)
+    sql = """
+        SELECT cost_net FROM {}
         WHERE status='completed'
           AND completed_at BETWEEN ? AND ?
-    """, (date_from, date_to))
+    """
+    params = [date_from, date_to]
+    if _archive_overlaps(conn, date_from, date_to):
+        sql = f"{sql.format('services')} UNION ALL {sql.format('archive.services')}"
+        params += params
+    else:
+        sql = sql.format("services")
+    cur = conn.cursor()
+    cur.execute(f"SELECT COALESCE(SUM(cost_net),0) as total FROM ({sql})", params)
     total = cur.fetchone()["total"]
-    conn.close()
     return total
+
+
+# ============================================================
+# ARCHIVE
+# ============================================================
+
+# Completed services whose completed_at is older than the cutoff move to
+# archive.services, ARCHIVE_BATCH rows per transaction, so the hot table
+# and its indexes only hold open and recent jobs. History readers add the
+# archive (UNION ALL) only when the requested range reaches into it.
+# In WAL mode a transaction over both files is not atomic: each file
+# commits on its own, so a crash between the two commits could lose or
+# duplicate a batch. The copy into the archive is therefore committed
+# first and the rows are deleted from main in a second transaction. A
+# crash in between leaves the batch in both; the next run copies it again
+# (INSERT OR REPLACE) and deletes it. Until then history may list that
+# batch twice, but nothing is lost.
+ARCHIVE_BATCH = 1000
+
+
+def _archive_span(conn, column="completed_at"):
+    # (oldest, newest) `column` of archived services; None if the archive
+    # is empty or not attached.
+    try:
+        row = conn.execute(f"""
+            SELECT (SELECT MIN({column}) FROM archive.services
+                    WHERE status = 'completed'),
+                   (SELECT MAX({column}) FROM archive.services
+                    WHERE status = 'completed')
+        """).fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return None if row[0] is None else (row[0], row[1])
+
+
+def _archive_overlaps(conn, date_from, date_to):
+    # Whether [date_from, date_to] (either may be None, either a day or a
+    # full timestamp) meets the archived completed_at range.
+    span = _archive_span(conn)
+    if span is None:
+        return False
+    lo, hi = span
+    return ((not date_from or date_from <= hi)
+            and (not date_to or date_to >= lo[:len(date_to)]))
+
+
+def archive_services(path, before, batch=ARCHIVE_BATCH):
+    # Moves one batch of services completed before `before` (ISO text, as
+    # in completed_at). Returns how many moved; 0 means done.
+    with transaction(path) as conn:
+        columns = conn.execute("PRAGMA main.table_info(services)").fetchall()
+        archived = {r["name"] for r in conn.execute("PRAGMA archive.table_info(services)")}
+        for column in columns:
+            if column["name"] not in archived:
+                conn.execute(
+                    f"ALTER TABLE archive.services ADD COLUMN {column['name']} {column['type']}"
+                )
+
+        ids = json.dumps([r[0] for r in conn.execute("""
+            SELECT id FROM services
+            WHERE status = 'completed' AND completed_at < ?
+            ORDER BY completed_at
+            LIMIT ?
+        """, (before, batch))])
+        cols = ", ".join(column["name"] for column in columns)
+        moved = conn.execute(f"""
+            INSERT OR REPLACE INTO archive.services ({cols})
+            SELECT {cols} FROM main.services
+            WHERE id IN (SELECT value FROM json_each(?))
+        """, (ids,)).rowcount
+    # Only rows that are safely in the archive by now are deleted.
+    with transaction(path) as conn:
+        conn.execute("""
+            DELETE FROM main.services
+            WHERE id IN (SELECT value FROM json_each(?))
+              AND id IN (SELECT id FROM archive.services)
+        """, (ids,))
+    return moved
+
+
+def archive_stats(path):
+    conn = get_connection(path)
+    return {
+        "hot": conn.execute(
+            "SELECT COUNT(*) FROM services WHERE status = 'completed'"
+        ).fetchone()[0],
+        "archived": conn.execute("SELECT COUNT(*) FROM archive.services").fetchone()[0],
+    }
+
+
+# ============================================================
+# CALENDAR
+# ============================================================
+
+# Services scheduled in a day / week, by desired_ts. Fleet-wide it is one
+# range scan of idx_services_desired_ts, already in order; per mechanic one
+# range per status on idx_services_mechanic_status_desired_ts, and only
+# that day's rows get sorted. Rejected services are left out.
+CALENDAR_STATUSES = ("pending_admin", "approved", "completed")
+CALENDAR_LIMIT = 500
+
+CalendarItem = namedtuple(
+    "CalendarItem", "id desired_ts desired_at status mechanic_tg_id plate description"
+)
+
+
+def service_calendar(path, day_from, days=1, mechanic_tg_id=None, limit=CALENDAR_LIMIT):
+    # day_from: YYYY-MM-DD. Returns at most `limit` CalendarItems.
+    start = date.fromisoformat(day_from)
+    params = [start.isoformat(), (start + timedelta(days=days)).isoformat()]
+    sql = f"""
+        SELECT s.id, s.desired_ts, s.desired_at, s.status, s.mechanic_tg_id,
+               c.plate, s.description
+        FROM services s
+        JOIN cars c ON c.id = s.car_id
+        WHERE s.desired_ts >= ? AND s.desired_ts < ?
+          AND s.status IN ({", ".join("?" * len(CALENDAR_STATUSES))})
+    """
+    params += CALENDAR_STATUSES
+    if mechanic_tg_id is not None:
+        sql += " AND s.mechanic_tg_id = ?"
+        params.append(mechanic_tg_id)
+    sql += " ORDER BY s.desired_ts, s.id LIMIT ?"
+    params.append(limit)
+    return _fetch(get_reader(path), sql, params, CalendarItem)
+
+
+# ============================================================
+# SERVICE SEARCH
+# ============================================================
+
+# Every query word is matched as a prefix of at most SEARCH_STEM letters
+# ("тормозные колодки" -> тормоз* колодк*), which also catches other word
+# forms; services_fts keeps prefix indexes up to that length, so no prefix
+# needs a merge of many terms' postings.
+# Hits are ranked by services_fts itself over the whole match set: rank is
+# bm25 with the description weighted over comments (migration 12), newest
+# first among equals. Pages are offsets into that ranking, applied by the
+# same statement.
+SEARCH_STEM = 6
+
+SearchHit = namedtuple(
+    "SearchHit", "id plate vin status completed_at description comments"
+)
+
+_WORD = re.compile(r"\w+")
+_SEARCH_COLUMNS = "s.id, c.plate, c.vin, s.status, s.completed_at, s.description, s.comments"
+
+
+def _search_stems(text):
+    return [w[:SEARCH_STEM] for w in _WORD.findall(text.lower()) if len(w) >= 2]
+
+
+def search_services(path, query, car_id=None, offset=0, limit=PAGE_SIZE):
+    stems = _search_stems(query)
+    if not stems:
+        return Page([], None, None)
+    match = " ".join(f'"{s}"*' for s in stems)
+    conn = get_reader(path)
+    tables = ["main.services"] + (["archive.services"] if _archive_span(conn) else [])
+
+    if car_id is None:
+        # FTS5 ranks and cuts the page; only the page's ids are looked up.
+        arm = f"""
+            SELECT {_SEARCH_COLUMNS}, h.rank
+            FROM hits h
+            JOIN {{}} s ON s.id = h.id
+            JOIN cars c ON c.id = s.car_id
+        """
+        sql = f"""
+            WITH hits AS MATERIALIZED (
+                SELECT rowid AS id, rank FROM services_fts
+                WHERE services_fts MATCH ?
+                ORDER BY rank, rowid DESC
+                LIMIT ? OFFSET ?
+            )
+            SELECT * FROM ({" UNION ALL ".join(arm.format(t) for t in tables)})
+            ORDER BY rank, id DESC
+        """
+        params = [match, limit + 1, offset]
+    else:
+        # A car has few services: they drive the join (CROSS JOIN keeps that
+        # order) and each is checked against the index by rowid, instead of
+        # walking every match of a common word.
+        arm = f"""
+            SELECT {_SEARCH_COLUMNS}, f.rank
+            FROM {{}} s
+            CROSS JOIN services_fts f ON f.rowid = s.id
+            JOIN cars c ON c.id = s.car_id
+            WHERE s.car_id = ? AND services_fts MATCH ?
+        """
+        sql = f"""
+            SELECT * FROM ({" UNION ALL ".join(arm.format(t) for t in tables)})
+            ORDER BY rank, id DESC
+            LIMIT ? OFFSET ?
+        """
+        params = [car_id, match] * len(tables) + [limit + 1, offset]
+
+    cur = conn.cursor()
+    cur.row_factory = None
+    hits = [SearchHit._make(r[:-1]) for r in cur.execute(sql, params).fetchall()]
+    return Page(
+        hits[:limit],
+        max(0, offset - limit) if offset else None,
+        offset + limit if len(hits) > limit else None,
+    )
+
+
+# ============================================================
+# FSM STATE
+# ============================================================
+
+def load_fsm_record(path, key):
+    conn = get_connection(path)
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT state, data, updated_at FROM fsm_state WHERE key = ?", (key,)
+    )
+    return cur.fetchone()
+
+
+def save_fsm_records(path, upserts, deletes):
+    # upserts: (key, state, data_json, updated_at); deletes: keys
+    with transaction(path) as conn:
+        conn.executemany("""
+            INSERT INTO fsm_state (key, state, data, updated_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET
+                state = excluded.state,
+                data = excluded.data,
+                updated_at = excluded.updated_at
+        """, upserts)
+        conn.executemany(
+            "DELETE FROM fsm_state WHERE key = ?", [(k,) for k in deletes]
+        )
+
+
+def delete_expired_fsm(path, before):
+    with transaction(path) as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM fsm_state WHERE updated_at < ?", (before,))
+    return cur.rowcount
+
+
+# ============================================================
+# NOTIFICATIONS
+# ============================================================
+
+# Events waiting to go out in the next digest (see digest.py). Rows are
+# deleted once the digest carrying them has been delivered.
+
+def add_notifications(path, rows):
+    # rows: (chat_id, kind, text, created_at); returns their ids in order.
+    with transaction(path) as conn:
+        return [
+            conn.execute(
+                "INSERT INTO notifications (chat_id, kind, text, created_at) VALUES (?, ?, ?, ?)",
+                row
+            ).lastrowid
+            for row in rows
+        ]
+
+
+def list_notifications(path):
+    conn = get_connection(path)
+    return conn.execute(
+        "SELECT id, chat_id, kind, text, created_at FROM notifications ORDER BY id"
+    ).fetchall()
+
+
+def delete_notifications(path, ids):
+    with transaction(path) as conn:
+        conn.execute(
+            "DELETE FROM notifications WHERE id IN (SELECT value FROM json_each(?))",
+            (json.dumps(list(ids)),)
+        )
+
+
+# ============================================================
+# REPORTS
+# ============================================================
+
+# service_stats holds completed services pre-aggregated per
+# (period, bucket, car, owner company, mechanic), period being 'day'
+# (bucket YYYY-MM-DD) or 'month' (bucket YYYY-MM). set_service_result keeps
+# it current in its own transaction, so reports read O(buckets) rows instead
+# of scanning services. rebuild_service_stats recomputes it from scratch,
+# archived services included.
+STATS_PERIODS = (("day", 10), ("month", 7))
+STATS_GROUPS = ("owner_company", "car_id", "mechanic_tg_id", "bucket")
+
+
+def _bump_service_stats(conn, svc_id, sign):
+    row = conn.execute("""
+        SELECT s.car_id, s.mechanic_tg_id, s.cost_net, s.final_mileage,
+               s.completed_at, c.owner_company
+        FROM services s
+        LEFT JOIN cars c ON c.id = s.car_id
+        WHERE s.id = ? AND s.status = 'completed'
+          AND s.completed_at IS NOT NULL
+    """, (svc_id,)).fetchone()
+    if row is None:
+        return
+    for period, width in STATS_PERIODS:
+        conn.execute("""
+            INSERT INTO service_stats (
+                period, bucket, car_id, owner_company, mechanic_tg_id,
+                services, cost_net, max_mileage
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (period, bucket, car_id, owner_company, mechanic_tg_id)
+            DO UPDATE SET
+                services = services + excluded.services,
+                cost_net = cost_net + excluded.cost_net,
+                max_mileage = MAX(COALESCE(max_mileage, 0),
+                                  COALESCE(excluded.max_mileage, 0))
+        """, (
+            period, row["completed_at"][:width], row["car_id"],
+            row["owner_company"] or "", row["mechanic_tg_id"] or 0,
+            sign, sign * (row["cost_net"] or 0),
+            row["final_mileage"] if sign > 0 else None,
+        ))
+
+
+def _rebuild_service_stats(conn):
+    conn.execute("DELETE FROM service_stats")
+    for period, width in STATS_PERIODS:
+        conn.execute(f"""
+            INSERT INTO service_stats (
+                period, bucket, car_id, owner_company, mechanic_tg_id,
+                services, cost_net, max_mileage
+            )
+            SELECT ?, SUBSTR(s.completed_at, 1, {width}), s.car_id,
+                   COALESCE(c.owner_company, ''), COALESCE(s.mechanic_tg_id, 0),
+                   COUNT(*), COALESCE(SUM(s.cost_net), 0), MAX(s.final_mileage)
+            FROM (SELECT car_id, mechanic_tg_id, status, cost_net,
+                         final_mileage, completed_at FROM main.services
+                  UNION ALL
+                  SELECT car_id, mechanic_tg_id, status, cost_net,
+                         final_mileage, completed_at FROM archive.services) s
+            LEFT JOIN cars c ON c.id = s.car_id
+            WHERE s.status = 'completed' AND s.completed_at IS NOT NULL
+            GROUP BY 2, 3, 4, 5
+        """, (period,))
+
+
+def rebuild_service_stats(path):
+    with transaction(path) as conn:
+        _rebuild_service_stats(conn)
+        return conn.execute("SELECT COUNT(*) FROM service_stats").fetchone()[0]
+
+
+def service_stats(path, period, bucket_from, bucket_to, group_by,
+                  owner_company=None):
+    # Totals per `group_by` over buckets [bucket_from, bucket_to].
+    if period not in dict(STATS_PERIODS) or group_by not in STATS_GROUPS:
+        raise ValueError(f"bad report: {period} / {group_by}")
+    sql = f"""
+        SELECT {group_by} AS grp,
+               SUM(services) AS services,
+               SUM(cost_net) AS cost_net,
+               MAX(max_mileage) AS max_mileage
+        FROM service_stats
+        WHERE period = ? AND bucket BETWEEN ? AND ?
+    """
+    params = [period, bucket_from, bucket_to]
+    if owner_company is not None:
+        sql += " AND owner_company = ?"
+        params.append(owner_company)
+    sql += f" GROUP BY {group_by} HAVING SUM(services) > 0 ORDER BY cost_net DESC"
+    return get_reader(path).execute(sql, params).fetchall()
@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import time
+
+import adb
+from outbox import NOTIFICATION
+
+log = logging.getLogger(__name__)
+
+# ================= SETTINGS =================
+WINDOW = 300              # seconds events are collected before a digest goes out
+MAX_REFS = 15             # service numbers listed per line of a message
+
+# kind -> (single event text, digest line)
+KINDS = {
+    "created": ("🆕 Создан сервис {}, ожидает подтверждения",
+                "🆕 Новых сервисов ждут подтверждения: {}"),
+    "completed": ("✅ Сервис {} завершён",
+                  "✅ Завершено: {}"),
+}
+
+
+class _Event:
+    __slots__ = ("id", "kind", "ref")
+
+    def __init__(self, id, kind, ref):
+        self.id = id
+        self.kind = kind
+        self.ref = ref
+
+
+def list_refs(refs):
+    # "#1, #2, …": the first MAX_REFS of refs, in the order given. Also
+    # used by the bot's bulk action summaries.
+    refs = list(refs)
+    return ", ".join(refs[:MAX_REFS]) + (", …" if len(refs) > MAX_REFS else "")
+
+
+def render(events):
+    if len(events) == 1:
+        single, _ = KINDS[events[0].kind]
+        return single.format(events[0].ref)
+    lines = ["📬 Сводка"]
+    for kind, (_, line) in KINDS.items():
+        refs = [e.ref for e in events if e.kind == kind]
+        if not refs:
+            continue
+        lines.append(f"{line.format(len(refs))} ({list_refs(refs)})")
+    return "\n".join(lines)
+
+
+# Coalesces admin notifications. The first event for a recipient opens a
+# window; everything that arrives before it closes goes out as one digest
+# message (a lone event is sent as its usual text). Urgent events skip the
+# window. Buffered events are stored in the notifications table and only
+# deleted after delivery, so a restart sends them instead of losing them.
+class Notifier:
+    def __init__(self, outbox, path, window=WINDOW):
+        self.outbox = outbox
+        self.path = path
+        self.window = window
+        self.digests = 0
+        self._pending = {}        # chat_id -> [_Event]
+        self._timers = {}         # chat_id -> flush task
+
+    async def start(self):
+        # Re-arm what a previous run left behind, keeping original deadlines.
+        for row in await adb.list_notifications(self.path):
+            self._pending.setdefault(row["chat_id"], []).append(
+                _Event(row["id"], row["kind"], row["text"])
+            )
+            if row["chat_id"] not in self._timers:
+                delay = max(0.0, row["created_at"] + self.window - time.time())
+                self._arm(row["chat_id"], delay)
+
+    async def notify(self, chat_ids, kind, ref, urgent=False):
+        chat_ids = list(chat_ids)
+        if urgent or not self.window:
+            single, _ = KINDS[kind]
+            for chat_id in chat_ids:
+                self.outbox.send(chat_id, single.format(ref), priority=NOTIFICATION)
+            return
+        ids = await adb.add_notifications(
+            self.path, [(chat_id, kind, ref, time.time()) for chat_id in chat_ids]
+        )
+        for chat_id, event_id in zip(chat_ids, ids):
+            self._pending.setdefault(chat_id, []).append(_Event(event_id, kind, ref))
+            if chat_id not in self._timers:
+                self._arm(chat_id, self.window)
+
+    def _arm(self, chat_id, delay):
+        self._timers[chat_id] = asyncio.create_task(self._flush_later(chat_id, delay))
+
+    async def _flush_later(self, chat_id, delay):
+        await asyncio.sleep(delay)
+        self._timers.pop(chat_id, None)
+        await self.flush(chat_id)
+
+    async def flush(self, chat_id):
+        events = self._pending.pop(chat_id, None)
+        if not events:
+            return
+        result = await self.outbox.send(chat_id, render(events), priority=NOTIFICATION)
+        if result is None:
+            # Not delivered: keep them (still in the table) for the next window.
+            log.warning("digest to %s not delivered, retrying in %ss", chat_id, self.window)
+            self._pending[chat_id] = events + self._pending.get(chat_id, [])
+            if chat_id not in self._timers:
+                self._arm(chat_id, self.window)
+            return
+        self.digests += 1
+        await adb.delete_notifications(self.path, [e.id for e in events])
+
+    async def flush_all(self):
+        for task in self._timers.values():
+            task.cancel()
+        self._timers.clear()
+        await asyncio.gather(*(self.flush(chat_id) for chat_id in list(self._pending)))
+
+    async def close(self):
+        # Buffered events stay in the table for the next start().
+        for task in self._timers.values():
+            task.cancel()
+        self._timers.clear()
+        self._pending.clear()
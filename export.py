@@ -0,0 +1,78 @@
+import csv
+import os
+import sys
+
+from openpyxl import Workbook
+
+import db
+
+# Service history export. Rows go straight from db.iter_service_history into
+# the file writer, so memory stays flat however long the range is. Runs
+# synchronously in whatever thread calls it; the bot runs it on a reader
+# thread (adb.read), so the export reads through that thread's read-only
+# connection (WAL snapshot), never occupies the DB worker, and the
+# connection is closed with the others by adb.close.
+
+COLUMNS = (
+    ("id", "ID"),
+    ("completed_at", "Завершён"),
+    ("plate", "Номер"),
+    ("vin", "VIN"),
+    ("model", "Модель"),
+    ("owner_company", "Владелец"),
+    ("mechanic_tg_id", "Механик"),
+    ("description", "Работы"),
+    ("final_mileage", "Пробег"),
+    ("cost_net", "NETTO"),
+    ("comments", "Комментарий"),
+)
+
+FORMATS = ("csv", "xlsx")
+
+
+def _values(row):
+    return [row[key] for key, _ in COLUMNS]
+
+
+def _write_csv(rows, out_path):
+    count = 0
+    # utf-8-sig + ';' so Excel opens Cyrillic text and decimals correctly.
+    with open(out_path, "w", newline="", encoding="utf-8-sig") as f:
+        writer = csv.writer(f, delimiter=";")
+        writer.writerow([title for _, title in COLUMNS])
+        for row in rows:
+            writer.writerow(_values(row))
+            count += 1
+    return count
+
+
+def _write_xlsx(rows, out_path):
+    # write_only streams rows to disk instead of building the sheet in memory.
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("История")
+    ws.append([title for _, title in COLUMNS])
+    count = 0
+    for row in rows:
+        ws.append(_values(row))
+        count += 1
+    wb.save(out_path)
+    return count
+
+
+def export_history(path, fmt, out_path, **filters):
+    if fmt not in FORMATS:
+        raise ValueError(f"Неизвестный формат: {fmt}")
+    rows = db.iter_service_history(path, **filters)
+    writer = _write_xlsx if fmt == "xlsx" else _write_csv
+    return writer(rows, out_path)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (3, 5):
+        raise SystemExit(
+            "usage: python export.py <fleet.db> <out.csv|out.xlsx> [YYYY-MM-DD YYYY-MM-DD]"
+        )
+    out = sys.argv[2]
+    fmt = os.path.splitext(out)[1].lstrip(".").lower()
+    dates = dict(zip(("date_from", "date_to"), sys.argv[3:]))
+    print(f"{export_history(sys.argv[1], fmt, out, **dates)} rows -> {out}")
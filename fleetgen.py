@@ -0,0 +1,189 @@
+import argparse
+import random
+import string
+import time
+from datetime import datetime, timedelta
+
+import db
+
+# Synthetic fleet for benchmarks and load tests: cars with Polish-style
+# plates, mechanics and admins, and services in every status spread over
+# the last DAYS days. Everything is written with plain executemany in a few
+# big transactions, then the service_stats aggregates are rebuilt, so the
+# result looks exactly like a database the bot has been running on.
+#
+#   python fleetgen.py bench.db --cars 100000
+
+# ================= SETTINGS =================
+CARS = 10_000
+SERVICES_PER_CAR = 3
+MECHANICS = 50
+ADMINS = 3
+USERS = 200
+DAYS = 730
+BATCH = 20_000
+
+# tg_id ranges, so benchmarks can address people without looking them up.
+MECHANIC_BASE = 1
+ADMIN_BASE = 100_000
+USER_BASE = 200_000
+
+# (status, weight); completed dominates like in a real fleet.
+STATUSES = (
+    ("completed", 80),
+    ("approved", 10),
+    ("pending_admin", 6),
+    ("rejected", 4),
+)
+
+COMPANIES = (
+    "FleetPol", "TransLog", "Kurier24", "EkoCar", "MiastoRent",
+    "Baltic Cargo", "SpeedBox", "Nord Trans",
+)
+MODELS = (
+    "Skoda Octavia", "Toyota Corolla", "VW Golf", "VW Passat", "Ford Transit",
+    "Renault Master", "Fiat Ducato", "Opel Astra", "Kia Ceed", "Hyundai i30",
+)
+FUELS = ("benzyna", "diesel", "LPG", "hybryda", "EV")
+REGIONS = ("WA", "WE", "WI", "KR", "PO", "GD", "WR", "LU", "EL", "SK")
+WORKS = (
+    "Замена масла", "Тормозные колодки", "Замена шин", "Диагностика",
+    "Ремонт подвески", "Замена ремня ГРМ", "Кондиционер", "Замена фильтров",
+)
+
+VIN_CHARS = "".join(c for c in string.ascii_uppercase + string.digits if c not in "IOQ")
+
+
+def _vin(rng, n):
+    # Unique by construction (serial = car id): WMI + random middle + serial.
+    middle = "".join(rng.choice(VIN_CHARS) for _ in range(5))
+    return f"WVW{middle}{n:09d}"
+
+
+def _plate(n):
+    # Region + 5 digits: unique while n < 1_000_000.
+    return f"{REGIONS[n % len(REGIONS)]} {n // len(REGIONS):05d}"
+
+
+def _users(mechanics, admins, users):
+    rows = [(MECHANIC_BASE + i, f"Механик {i + 1}", "mechanic") for i in range(mechanics)]
+    rows += [(ADMIN_BASE + i, f"Админ {i + 1}", "admin") for i in range(admins)]
+    rows += [(USER_BASE + i, f"Пользователь {i + 1}", "user") for i in range(users)]
+    return rows
+
+
+def _cars(rng, first, count, now):
+    year = now.year
+    for n in range(first, first + count):
+        vin, plate = _vin(rng, n), _plate(n)
+        yield (
+            vin, rng.randint(5_000, 400_000), rng.randint(year - 12, year),
+            rng.choice(COMPANIES), rng.choice(MODELS), plate, rng.choice(FUELS),
+            db.normalize_ident(vin), db.normalize_ident(plate),
+        )
+
+
+def _services(rng, car_ids, per_car, mechanics, admins, days, now):
+    statuses, weights = zip(*STATUSES)
+    for car_id in car_ids:
+        mileage = rng.randint(5_000, 300_000)
+        for _ in range(rng.randint(max(0, per_car - 2), per_car + 2)):
+            created = now - timedelta(seconds=rng.randint(0, days * 86400))
+            status = rng.choices(statuses, weights)[0]
+            mechanic = None
+            admin = None
+            final_mileage = cost = comments = completed = None
+            if status != "pending_admin":
+                admin = ADMIN_BASE + rng.randrange(admins)
+            if status in ("approved", "completed"):
+                mechanic = MECHANIC_BASE + rng.randrange(mechanics)
+            if status == "completed":
+                mileage += rng.randint(500, 20_000)
+                final_mileage = mileage
+                cost = round(rng.uniform(80, 6000), 2)
+                comments = rng.choice(("", "ok", "клиент предупреждён", "гарантия"))
+                completed = (created + timedelta(hours=rng.randint(2, 240))).isoformat()
+            if rng.random() < 0.7:
+                creator, role = USER_BASE + rng.randrange(USERS), "user"
+            else:
+                creator, role = ADMIN_BASE + rng.randrange(admins), "admin"
+            desired = (created + timedelta(days=rng.randint(0, 14))).replace(second=0)
+            yield (
+                car_id, mechanic, admin, creator, role, rng.choice(WORKS),
+                desired.strftime("%d.%m %H:%M"), desired.strftime(db.DESIRED_TS_FORMAT),
+                status, final_mileage, cost,
+                comments, created.strftime("%Y-%m-%d %H:%M:%S"), completed,
+            )
+
+
+def _batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def generate(path, cars=CARS, services_per_car=SERVICES_PER_CAR,
+             mechanics=MECHANICS, admins=ADMINS, days=DAYS, seed=1, now=None):
+    # Builds the fleet in `path` (created / migrated first). Returns counts.
+    # Dates go back `days` from `now` (default: the current time); with a
+    # fixed now and seed the fleet is the same on every run.
+    rng = random.Random(seed)
+    now = now or datetime.now()
+    db.init_db(path)
+    with db.transaction(path) as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO users (tg_id, full_name, role) VALUES (?, ?, ?)",
+            _users(mechanics, admins, USERS),
+        )
+        first = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM cars").fetchone()[0]
+
+    for batch in _batches(_cars(rng, first, cars, now), BATCH):
+        with db.transaction(path) as conn:
+            conn.executemany("""
+                INSERT INTO cars (
+                    vin, mileage, year, owner_company, model, plate, fuel_type,
+                    vin_key, plate_key
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, batch)
+
+    services = 0
+    rows = _services(rng, range(first, first + cars), services_per_car,
+                     mechanics, admins, days, now)
+    for batch in _batches(rows, BATCH):
+        with db.transaction(path) as conn:
+            conn.executemany("""
+                INSERT INTO services (
+                    car_id, mechanic_tg_id, admin_tg_id,
+                    created_by_tg_id, created_by_role, description, desired_at,
+                    desired_ts, status, final_mileage, cost_net, comments,
+                    created_at, completed_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, batch)
+        services += len(batch)
+
+    db.rebuild_service_stats(path)
+    db.get_connection(path).execute("ANALYZE")
+    db.role_cache.invalidate()
+    return {"cars": cars, "services": services, "mechanics": mechanics}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="generate a synthetic fleet database")
+    parser.add_argument("db")
+    parser.add_argument("--cars", type=int, default=CARS)
+    parser.add_argument("--services-per-car", type=int, default=SERVICES_PER_CAR)
+    parser.add_argument("--mechanics", type=int, default=MECHANICS)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    counts = generate(args.db, args.cars, args.services_per_car,
+                      args.mechanics, seed=args.seed)
+    db.close_connection(args.db)
+    print(", ".join(f"{k}: {v}" for k, v in counts.items())
+          + f" ({time.perf_counter() - started:.1f}s)")
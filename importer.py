@@ -0,0 +1,226 @@
+import asyncio
+import csv
+import io
+import os
+import sys
+import time
+import zipfile
+from datetime import date
+
+from openpyxl import load_workbook
+from openpyxl.utils.exceptions import InvalidFileException
+
+import adb
+import db
+
+# ================= SETTINGS =================
+CHUNK_SIZE = 5000
+MAX_ERRORS = 20           # rejected rows listed in the summary
+
+# Header aliases -> cars column. Compared after lower() and strip().
+COLUMNS = {
+    "vin": "vin",
+    "mileage": "mileage", "пробег": "mileage", "przebieg": "mileage",
+    "year": "year", "год": "year", "rok": "year",
+    "owner_company": "owner_company", "owner": "owner_company",
+    "company": "owner_company", "владелец": "owner_company",
+    "компания": "owner_company", "właściciel": "owner_company",
+    "model": "model", "модель": "model",
+    "plate": "plate", "номер": "plate", "госномер": "plate",
+    "nr rej": "plate", "rejestracja": "plate",
+    "fuel_type": "fuel_type", "fuel": "fuel_type", "топливо": "fuel_type",
+    "paliwo": "fuel_type",
+}
+
+
+class ImportResult:
+    def __init__(self):
+        self.inserted = 0
+        self.updated = 0
+        self.rejected = 0
+        self.errors = []
+        self.failed = None        # why the file could not be read to the end
+        self.seconds = 0.0
+
+    def reject(self, line, reason):
+        self.rejected += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append((line, reason))
+
+    def summary(self):
+        text = f"Файл прочитан не полностью: {self.failed}\n" if self.failed else ""
+        text += (
+            f"Импорт завершён за {self.seconds:.1f} с\n"
+            f"Добавлено: {self.inserted}\n"
+            f"Обновлено: {self.updated}\n"
+            f"Отклонено: {self.rejected}"
+        )
+        if self.errors:
+            text += "\n\n" + "\n".join(f"строка {n}: {r}" for n, r in self.errors)
+            if self.rejected > len(self.errors):
+                text += "\n…"
+        return text
+
+
+# ================= PARSING =================
+# Both readers are streaming: rows are yielded one by one as
+# (line_number, {header: value}) and nothing is loaded in full. A file that
+# cannot be read raises ValueError, possibly after some rows were yielded.
+
+def _iter_csv(fileobj):
+    text = io.TextIOWrapper(fileobj, encoding="utf-8-sig", newline="")
+    sample = text.read(4096)
+    text.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.reader(text, dialect)
+    header = next(reader, None)
+    if header is None:
+        return
+    for n, values in enumerate(reader, start=2):
+        if any(v.strip() for v in values):
+            yield n, dict(zip(header, values))
+
+
+def _iter_xlsx(fileobj):
+    try:
+        wb = load_workbook(fileobj, read_only=True, data_only=True)
+    except (zipfile.BadZipFile, InvalidFileException, KeyError) as e:
+        raise ValueError(f"файл не читается как XLSX ({e})")
+    try:
+        rows = wb.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        header = ["" if h is None else str(h) for h in header]
+        for n, values in enumerate(rows, start=2):
+            if any(v not in (None, "") for v in values):
+                yield n, dict(zip(header, values))
+    except zipfile.BadZipFile as e:
+        raise ValueError(f"файл XLSX повреждён ({e})")
+    finally:
+        wb.close()
+
+
+def iter_rows(filename, fileobj):
+    ext = os.path.splitext(filename.lower())[1]
+    if ext in (".xlsx", ".xlsm"):
+        return _iter_xlsx(fileobj)
+    if ext in (".csv", ".txt", ""):
+        return _iter_csv(fileobj)
+    raise ValueError(f"Неподдерживаемый формат файла: {ext}")
+
+
+# ================= VALIDATION =================
+
+def _int(value, field, lo, hi, required):
+    if value is None or str(value).strip() == "":
+        if required:
+            raise ValueError(f"нет поля {field}")
+        return None
+    try:
+        number = int(float(str(value).replace(" ", "").replace(",", ".")))
+    except ValueError:
+        raise ValueError(f"{field}: не число ({value})")
+    if not lo <= number <= hi:
+        raise ValueError(f"{field}: вне диапазона ({number})")
+    return number
+
+
+def _text(value):
+    value = "" if value is None else str(value).strip()
+    return value or None
+
+
+def validate(raw):
+    row = {}
+    for header, value in raw.items():
+        column = COLUMNS.get(str(header or "").strip().lower())
+        if column:
+            row[column] = value
+
+    vin = db.normalize_ident(row.get("vin"))
+    if not 11 <= len(vin) <= 17:
+        raise ValueError(f"некорректный VIN ({row.get('vin')})")
+
+    return {
+        "vin": vin,
+        "mileage": _int(row.get("mileage"), "пробег", 0, 5_000_000, True),
+        "year": _int(row.get("year"), "год", 1950, date.today().year + 1, False),
+        "owner_company": _text(row.get("owner_company")),
+        "model": _text(row.get("model")),
+        "plate": db.normalize_ident(row.get("plate")) or None,
+        "fuel_type": _text(row.get("fuel_type")),
+    }
+
+
+def _chunks(rows, result, chunk_size):
+    chunk = []
+    for line, raw in rows:
+        try:
+            chunk.append((line, validate(raw)))
+        except ValueError as e:
+            result.reject(line, str(e))
+            continue
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _apply(result, outcome):
+    inserted, updated, rejected = outcome
+    result.inserted += inserted
+    result.updated += updated
+    for line, reason in rejected:
+        result.reject(line, reason)
+
+
+# ================= IMPORT =================
+
+def import_file(path, filename, fileobj, chunk_size=CHUNK_SIZE):
+    # Raises ValueError for an unsupported format. A file that breaks off
+    # halfway keeps the chunks already written and sets result.failed.
+    result = ImportResult()
+    started = time.perf_counter()
+    chunks = _chunks(iter_rows(filename, fileobj), result, chunk_size)
+    try:
+        for chunk in chunks:
+            _apply(result, db.upsert_cars(path, chunk))
+    except ValueError as e:
+        result.failed = str(e)
+    result.seconds = time.perf_counter() - started
+    return result
+
+
+async def import_file_async(path, filename, fileobj, chunk_size=CHUNK_SIZE):
+    # Parsing runs in a helper thread and every chunk is its own short
+    # transaction on the DB worker, so other handlers' queries interleave
+    # with a long import instead of waiting for all of it.
+    result = ImportResult()
+    started = time.perf_counter()
+    chunks = await asyncio.to_thread(
+        lambda: _chunks(iter_rows(filename, fileobj), result, chunk_size)
+    )
+    while True:
+        try:
+            chunk = await asyncio.to_thread(next, chunks, None)
+        except ValueError as e:
+            result.failed = str(e)
+            break
+        if chunk is None:
+            break
+        _apply(result, await adb.upsert_cars(path, chunk))
+    result.seconds = time.perf_counter() - started
+    return result
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        raise SystemExit("usage: python importer.py <fleet.db> <cars.csv|cars.xlsx>")
+    db.init_db(sys.argv[1])
+    with open(sys.argv[2], "rb") as f:
+        print(import_file(sys.argv[1], sys.argv[2], f).summary())
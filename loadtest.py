@@ -0,0 +1,415 @@
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import random
+import re
+import tempfile
+import time
+from collections import Counter, defaultdict, deque
+from datetime import datetime
+
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import SendMessage
+from aiogram.types import Chat, Message, Update
+
+import adb
+import db
+import fleetgen
+from bench import fmt_us, report
+
+# End-to-end load test: the real bot.dp with a stubbed Bot session (no
+# network), fed synthetic updates through Dispatcher.feed_update. Every
+# virtual user walks one service through its whole life:
+#
+#   user      /start -> 🔧 Сервисы -> service:new -> plate -> description -> date
+#   admin     service:pending -> service:assign:<id>:<mechanic>
+#   mechanic  service:finish:<id> -> mileage -> cost -> comment
+#
+# and the run reports updates/sec, per-handler latency, how long DB calls
+# queued for the single DB worker and how many services came out right.
+#
+# --dispatch picks how updates enter the dispatcher:
+#   scheduler  what bot.py does: concurrency.ChatScheduler, per-chat order
+#   tasks      aiogram's default polling: one unbounded task per update
+#   serial     polling with handle_as_tasks=False and no scheduler
+#
+#   python loadtest.py --users 2000 --cars 20000 --api-latency 0.03
+#   python loadtest.py --users 500 --think 0 --dispatch tasks
+
+# ================= SETTINGS =================
+USERS = 500
+CARS = 10_000
+THINK = 0.2              # max pause between a user's steps, seconds
+API_LATENCY = 0.0        # simulated Bot API round trip, seconds
+REPLY_TIMEOUT = 30
+SID_RE = re.compile(r"#(\d+)")
+DISPATCH = ("scheduler", "tasks", "serial")
+DESCRIPTION = "Замена масла, фильтры"
+DESIRED_AT = "завтра 10:00"
+COMMENT = "ok"
+
+
+# ================= FAKE TELEGRAM =================
+class StubSession(BaseSession):
+    # Answers every Bot API method locally. Sent texts are matched against
+    # expect() calls, so a virtual user can wait for the bot's reply.
+    def __init__(self, latency=API_LATENCY):
+        super().__init__()
+        self.latency = latency
+        self.calls = Counter()
+        self.messages_to = Counter()
+        self._waiters = defaultdict(list)                   # chat -> [(needle, future)]
+        self._unclaimed = defaultdict(lambda: deque(maxlen=100))
+        self._message_ids = itertools.count(1)
+        self.download = b""
+
+    async def make_request(self, bot, method, timeout=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.calls[type(method).__name__] += 1
+        if isinstance(method, SendMessage):
+            self.messages_to[method.chat_id] += 1
+            self._deliver(method.chat_id, method.text)
+            return Message(
+                message_id=next(self._message_ids),
+                date=datetime.now(),
+                chat=Chat(id=method.chat_id, type="private"),
+                text=method.text,
+            )
+        return True
+
+    def _deliver(self, chat_id, text):
+        waiters = self._waiters[chat_id]
+        for i, (needle, future) in enumerate(waiters):
+            if needle in text and not future.done():
+                del waiters[i]
+                future.set_result(text)
+                return
+        self._unclaimed[chat_id].append(text)
+
+    async def expect(self, chat_id, needle, timeout=REPLY_TIMEOUT):
+        # First message to chat_id containing needle, sent or still to come.
+        unclaimed = self._unclaimed[chat_id]
+        for text in unclaimed:
+            if needle in text:
+                unclaimed.remove(text)
+                return text
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[chat_id].append((needle, future))
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            if (needle, future) in self._waiters[chat_id]:
+                self._waiters[chat_id].remove((needle, future))
+
+    async def stream_content(self, url, headers=None, timeout=30,
+                             chunk_size=65536, raise_for_status=True):
+        # Every file "download" returns self.download (BaseSession requires
+        # this method; the flows here send no files).
+        for i in range(0, len(self.download), chunk_size):
+            yield self.download[i:i + chunk_size]
+
+    async def close(self):
+        pass
+
+
+class Telegram:
+    # Builds updates the way Telegram would send them and feeds them to dp.
+    def __init__(self, dp, bot, stats, dispatch):
+        self.dp = dp
+        self.bot = bot
+        self.stats = stats
+        self.dispatch = dispatch
+        self.tasks = set()
+        self._serial = asyncio.Lock()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def _user(self, tg_id):
+        return {"id": tg_id, "is_bot": False, "first_name": f"load {tg_id}"}
+
+    def _message(self, tg_id, text):
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": tg_id, "type": "private"},
+            "from": self._user(tg_id),
+            "text": text,
+        }
+
+    async def _process(self, update):
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception as e:
+            self.stats.errors[type(e).__name__] += 1
+
+    async def _feed(self, raw):
+        update = Update.model_validate(raw, context={"bot": self.bot})
+        t0 = self.stats.fed_at[update.update_id] = time.perf_counter()
+        if self.dispatch == "tasks":
+            task = asyncio.create_task(self._process(update))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        elif self.dispatch == "serial":
+            async with self._serial:
+                await self._process(update)
+        else:
+            await self._process(update)
+        self.stats.intake.append(time.perf_counter() - t0)
+
+    async def message(self, tg_id, text):
+        await self._feed({"update_id": next(self._update_ids),
+                          "message": self._message(tg_id, text)})
+
+    async def callback(self, tg_id, data):
+        await self._feed({
+            "update_id": next(self._update_ids),
+            "callback_query": {
+                "id": str(next(self._update_ids)),
+                "from": self._user(tg_id),
+                "chat_instance": str(tg_id),
+                "data": data,
+                "message": self._message(tg_id, "…"),
+            },
+        })
+
+
+# ================= MEASUREMENTS =================
+class Stats:
+    def __init__(self):
+        self.fed_at = {}
+        self.intake = []
+        self.updates = []
+        self.handlers = defaultdict(list)
+        self.db_wait = []
+        self.db_busy = []
+        self.replies = []
+        self.errors = Counter()
+        self.flows = 0
+
+    # Inner middleware: only runs when a handler matched, and knows which.
+    async def handler_timer(self, handler, event, data):
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            now = time.perf_counter()
+            name = data["handler"].callback.__name__
+            self.handlers[name].append(now - t0)
+            fed_at = self.fed_at.pop(data["event_update"].update_id, None)
+            if fed_at is not None:
+                self.updates.append(now - fed_at)
+
+    def instrument_db(self):
+        # Every adb wrapper goes through adb.run: time spent queued for the
+        # single DB worker (contention) vs spent executing.
+        run = adb.run
+
+        async def timed_run(fn, *args, **kwargs):
+            queued = time.perf_counter()
+
+            def job():
+                started = time.perf_counter()
+                self.db_wait.append(started - queued)
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.db_busy.append(time.perf_counter() - started)
+
+            job.__name__ = getattr(fn, "__name__", "call")
+            return await run(job)
+
+        adb.run = timed_run
+
+    def print(self, seconds, session, outbox, correct, admins):
+        print(f"{len(self.intake)} updates in {seconds:.1f}s: "
+              f"{len(self.intake) / seconds:.0f} updates/s, "
+              f"{self.flows} flows finished, {correct} services correct")
+        report("intake (feed_update returns)", self.intake)
+        report("update -> handler done", self.updates)
+        if self.replies:
+            report("update -> reply", self.replies)
+        print()
+        for name, samples in sorted(self.handlers.items()):
+            report(name, samples)
+        print()
+        if self.db_busy:
+            report("db queue wait", self.db_wait)
+            report("db execute", self.db_busy)
+            print(f"{'db worker utilisation':<32} {sum(self.db_busy) / seconds:.0%}"
+                  f"  max wait {fmt_us(max(self.db_wait))}")
+        print(f"{'bot api calls':<32} "
+              + ", ".join(f"{k} {v}" for k, v in session.calls.most_common()))
+        print(f"{'outbox':<32} sent {outbox.sent}, retried {outbox.retried}, "
+              f"failed {outbox.failed}")
+        print(f"{'admin notifications':<32} "
+              f"{sum(session.messages_to[a] for a in admins)} messages "
+              f"for {2 * self.flows} events")
+        if self.errors:
+            print(f"{'errors':<32} "
+                  + ", ".join(f"{k} {v}" for k, v in self.errors.items()))
+
+
+# ================= SCENARIO =================
+async def wait_reply(session, chat_id, needle, stats, sent_at):
+    text = await session.expect(chat_id, needle)
+    stats.replies.append(time.perf_counter() - sent_at)
+    return text
+
+
+async def service_flow(tg, session, stats, rng, user_id, plate, admins,
+                       mechanics, think):
+    async def pause():
+        if think:
+            await asyncio.sleep(rng.uniform(0, think))
+
+    await tg.message(user_id, "/start")
+    await pause()
+    await tg.message(user_id, "🔧 Сервисы")
+    await pause()
+    await tg.callback(user_id, "service:new")
+    await pause()
+    await tg.message(user_id, plate)
+    await pause()
+    await tg.message(user_id, DESCRIPTION)
+    await pause()
+    sent_at = time.perf_counter()
+    await tg.message(user_id, DESIRED_AT)
+    reply = await wait_reply(session, user_id, "создан", stats, sent_at)
+    sid = int(SID_RE.search(reply).group(1))
+
+    admin_id = rng.choice(admins)
+    mechanic_id, lock = rng.choice(mechanics)
+    await pause()
+    await tg.callback(admin_id, "service:pending")
+    await pause()
+    sent_at = time.perf_counter()
+    await tg.callback(admin_id, f"service:assign:{sid}:{mechanic_id}")
+    await wait_reply(session, mechanic_id, f"Вам назначен сервис #{sid}", stats, sent_at)
+
+    # A mechanic is one chat with one FSM: they finish one job, see the
+    # bot's confirmation, then take the next.
+    async with lock:
+        await pause()
+        await tg.callback(mechanic_id, f"service:finish:{sid}")
+        await pause()
+        await tg.message(mechanic_id, str(rng.randint(10_000, 300_000)))
+        await pause()
+        await tg.message(mechanic_id, f"{rng.uniform(100, 3000):.2f}")
+        await pause()
+        sent_at = time.perf_counter()
+        await tg.message(mechanic_id, COMMENT)
+        await wait_reply(session, mechanic_id, "Сервис завершён", stats, sent_at)
+    stats.flows += 1
+
+
+def count_correct(path):
+    # Services that went through every step with the right data; steps
+    # handled out of order show up as missing or mixed-up fields.
+    return db.get_connection(path).execute("""
+        SELECT COUNT(*) FROM services
+        WHERE created_by_tg_id >= ? AND status = 'completed'
+          AND description = ? AND desired_at = ? AND comments = ?
+    """, (fleetgen.USER_BASE, DESCRIPTION, DESIRED_AT, COMMENT)).fetchone()[0]
+
+
+async def run(args, path):
+    # bot.py reads its config at import time.
+    os.environ["BOT_TOKEN"] = "42:LOADTEST"
+    os.environ["DB_PATH"] = path
+    import outbox as outbox_module
+    if not args.telegram_limits:
+        # The stub is not Telegram: measure the bot, not the rate limiter.
+        outbox_module.GLOBAL_RATE = outbox_module.GLOBAL_BURST = 1e9
+        outbox_module.CHAT_RATE = outbox_module.CHAT_BURST = 1e9
+    import bot
+
+    if args.digest is not None:
+        bot.notifier.window = args.digest
+    if args.dispatch != "scheduler":
+        bot.dp.update.outer_middleware.unregister(bot.scheduler)
+
+    stats = Stats()
+    stats.instrument_db()
+    session = StubSession(args.api_latency)
+    bot.bot.session = session
+    bot.dp.message.middleware(stats.handler_timer)
+    bot.dp.callback_query.middleware(stats.handler_timer)
+
+    await adb.init_db(path)
+    await bot.assigner.start()
+    open_before = sum(map(bot.assigner.load, range(
+        fleetgen.MECHANIC_BASE, fleetgen.MECHANIC_BASE + args.mechanics)))
+    bot.outbox.start()
+    tg = Telegram(bot.dp, bot.bot, stats, args.dispatch)
+    rng = random.Random(args.seed)
+
+    conn_rows = await adb.run(lambda: db.get_connection(path).execute(
+        "SELECT plate FROM cars ORDER BY RANDOM() LIMIT ?", (args.users,)
+    ).fetchall())
+    plates = [r["plate"] for r in conn_rows]
+    admins = [fleetgen.ADMIN_BASE + i for i in range(fleetgen.ADMINS)]
+    mechanics = [(fleetgen.MECHANIC_BASE + i, asyncio.Lock())
+                 for i in range(args.mechanics)]
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(
+        service_flow(
+            tg, session, stats, random.Random(rng.random()),
+            fleetgen.USER_BASE + n, plates[n % len(plates)], admins,
+            mechanics, args.think,
+        )
+        for n in range(args.users)
+    ), return_exceptions=True)
+    await bot.scheduler.close()
+    await asyncio.gather(*tg.tasks)
+    seconds = time.perf_counter() - started
+    for r in results:
+        if isinstance(r, Exception):
+            stats.errors[f"flow {type(r).__name__}"] += 1
+
+    await bot.notifier.flush_all()
+    await bot.outbox.close()
+    await bot.dp.storage.close()
+    correct = await adb.run(count_correct, path)
+    stats.print(seconds, session, bot.outbox, correct, bot.ADMIN_IDS)
+    # Every flow finished its service: the mechanics' workload is back to
+    # what the generated fleet started with.
+    open_after = sum(bot.assigner.load(m) for m, _ in mechanics)
+    print(f"{'assigner open services':<32} {open_before} before, {open_after} after")
+    await adb.close(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="end-to-end load test of bot.dp")
+    parser.add_argument("--users", type=int, default=USERS,
+                        help="concurrent virtual users, one service each")
+    parser.add_argument("--cars", type=int, default=CARS)
+    parser.add_argument("--mechanics", type=int, default=fleetgen.MECHANICS)
+    parser.add_argument("--think", type=float, default=THINK,
+                        help="max random pause between steps, seconds")
+    parser.add_argument("--api-latency", type=float, default=API_LATENCY,
+                        help="simulated Bot API round trip, seconds")
+    parser.add_argument("--dispatch", choices=DISPATCH, default="scheduler",
+                        help="how updates enter the dispatcher (see top of file)")
+    parser.add_argument("--digest", type=float,
+                        help="admin digest window, seconds (0 = a message per event)")
+    parser.add_argument("--telegram-limits", action="store_true",
+                        help="keep the outbox's real Telegram rate limits")
+    parser.add_argument("--db", help="run on this database instead of a generated one")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.db or os.path.join(tmp, "load.db")
+        if not args.db:
+            fleetgen.generate(path, args.cars, mechanics=args.mechanics)
+            db.close_connection(path)
+        asyncio.run(run(args, path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+import time
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+
+# In-process metrics in the Prometheus text format, served on a local port
+# (GET /metrics). Everything is recorded from the event loop thread, so the
+# collectors need no locking: adb measures on the DB worker and records
+# after the await.
+
+# ================= BUCKETS =================
+SECONDS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ROWS = (0, 1, 5, 10, 50, 100, 500, 1000, 5000)
+
+REGISTRY = []
+
+
+def _labels(label, value):
+    return f'{label}="{value}"' if label else ""
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    def __init__(self, name, help, label=None, buckets=SECONDS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self._series = {}       # label value -> [bucket counts..., sum, count]
+        REGISTRY.append(self)
+
+    def observe(self, value, label_value=""):
+        series = self._series.get(label_value)
+        if series is None:
+            series = self._series[label_value] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for value, series in sorted(self._series.items()):
+            labels = _labels(self.label, value)
+            sep = "," if labels else ""
+            for bound, count in zip(self.buckets, series):
+                yield f'{self.name}_bucket{{{labels}{sep}le="{bound}"}} {count}'
+            yield f'{self.name}_bucket{{{labels}{sep}le="+Inf"}} {series[-1]}'
+            suffix = f"{{{labels}}}" if labels else ""
+            yield f"{self.name}_sum{suffix} {_number(series[-2])}"
+            yield f"{self.name}_count{suffix} {series[-1]}"
+
+
+class Counter:
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._values = {}
+        REGISTRY.append(self)
+
+    def inc(self, label_value="", amount=1):
+        self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for value, total in sorted(self._values.items()):
+            labels = _labels(self.label, value)
+            yield f"{self.name}{{{labels}}} {total}" if labels else f"{self.name} {total}"
+
+
+class Gauge:
+    # Read at scrape time: fn() returns a number, or {label value: number}.
+    def __init__(self, name, help, fn, label=None):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.label = label
+        REGISTRY.append(self)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        values = self.fn()
+        if not isinstance(values, dict):
+            yield f"{self.name} {_number(values)}"
+            return
+        for value, number in sorted(values.items()):
+            yield f"{self.name}{{{_labels(self.label, value)}}} {_number(number)}"
+
+
+def render():
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+# ================= METRICS =================
+handler_seconds = Histogram(
+    "bot_handler_seconds", "Handler run time.", "handler")
+handler_errors = Counter(
+    "bot_handler_errors_total", "Handlers that raised.", "handler")
+
+db_seconds = Histogram(
+    "bot_db_seconds", "db.py call run time on the DB worker.", "function")
+db_wait_seconds = Histogram(
+    "bot_db_wait_seconds", "Time a db.py call queued for the DB worker.", "function")
+db_rows = Histogram(
+    "bot_db_rows", "Rows returned by a db.py call.", "function", ROWS)
+db_busy_retries = Counter(
+    "bot_db_busy_retries_total", "db.py calls retried after SQLITE_BUSY.", "function")
+db_errors = Counter(
+    "bot_db_errors_total", "db.py calls that raised.", "function")
+db_slow = Counter(
+    "bot_db_slow_total", "db.py calls above the slow query threshold.", "function")
+
+
+# ================= HANDLERS =================
+# Inner middleware: only runs once a handler matched, and knows which one.
+class HandlerMetrics(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        name = data["handler"].callback.__name__
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors.inc(name)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - t0, name)
+
+
+def instrument(dp):
+    middleware = HandlerMetrics()
+    for observer in (dp.message, dp.callback_query):
+        observer.middleware(middleware)
+
+
+# ================= ENDPOINT =================
+async def serve(host, port):
+    async def scrape(request):
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", scrape)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
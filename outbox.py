@@ -0,0 +1,249 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+
+from aiogram.exceptions import TelegramRetryAfter
+
+log = logging.getLogger(__name__)
+
+# ================= PRIORITIES =================
+# Lower value goes first. Replies to the user who just pressed something
+# beat background notifications (admin broadcasts, assignment pings).
+INTERACTIVE = 0
+NOTIFICATION = 1
+
+# ================= LIMITS =================
+# https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+GLOBAL_RATE = 30          # messages / second for the whole bot
+GLOBAL_BURST = 30
+CHAT_RATE = 1             # messages / second in one private chat
+CHAT_BURST = 3
+GROUP_RATE = 20 / 60      # messages / second in one group
+GROUP_BURST = 3
+
+MAX_IN_FLIGHT = 16        # concurrent HTTP requests to the Bot API
+MAX_ATTEMPTS = 5
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        now = time.monotonic()
+        self._refill(now)
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def refill_time(self):
+        self.delay()
+        return max(0.0, self.paused_until - time.monotonic(),
+                   (self.burst - self.tokens) / self.rate)
+
+
+class _Job:
+    __slots__ = ("call", "priority", "seq", "future", "attempts")
+
+    def __init__(self, call, priority, seq, future):
+        self.call = call
+        self.priority = priority
+        self.seq = seq
+        self.future = future
+        self.attempts = 0
+
+
+class _Chat:
+    __slots__ = ("lanes", "bucket", "busy", "waiting")
+
+    def __init__(self, chat_id):
+        if isinstance(chat_id, int) and chat_id < 0:
+            self.bucket = TokenBucket(GROUP_RATE, GROUP_BURST)
+        else:
+            self.bucket = TokenBucket(CHAT_RATE, CHAT_BURST)
+        self.lanes = (deque(), deque())
+        self.busy = False       # a request for this chat is in flight
+        self.waiting = False    # parked until its bucket refills
+
+    def head(self):
+        for lane in self.lanes:
+            if lane:
+                return lane[0]
+        return None
+
+
+# Central rate-limited send queue for everything the bot sends.
+# Handlers call send() / edit() and return immediately; the dispatcher task
+# delivers messages respecting a global token bucket and one bucket per chat:
+# INTERACTIVE before NOTIFICATION, FIFO inside a lane of a chat, at most one
+# request in flight per chat. TelegramRetryAfter pauses the chat for the
+# requested time and puts the message back at the front of its lane.
+class Outbox:
+    def __init__(self, bot, max_in_flight=MAX_IN_FLIGHT):
+        self.bot = bot
+        self._global = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+        self._chats = {}
+        self._ready = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._tasks = set()
+        self._runner = None
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    # ---------- public API ----------
+    def submit(self, chat_id, call, priority=INTERACTIVE):
+        # call: zero-argument function returning a fresh awaitable; it is
+        # invoked again on retry.
+        future = asyncio.get_running_loop().create_future()
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _Chat(chat_id)
+        chat.lanes[priority].append(_Job(call, priority, next(self._seq), future))
+        self._schedule(chat_id)
+        return future
+
+    def send(self, chat_id, text, priority=INTERACTIVE, **kwargs):
+        return self.submit(
+            chat_id,
+            lambda: self.bot.send_message(chat_id, text, **kwargs),
+            priority,
+        )
+
+    def edit(self, chat_id, message_id, text, priority=INTERACTIVE, **kwargs):
+        return self.submit(
+            chat_id,
+            lambda: self.bot.edit_message_text(
+                text=text, chat_id=chat_id, message_id=message_id, **kwargs
+            ),
+            priority,
+        )
+
+    def pending(self):
+        return sum(len(lane) for c in self._chats.values() for lane in c.lanes)
+
+    def start(self):
+        if self._runner is None:
+            self._runner = asyncio.create_task(self._run())
+
+    async def close(self, timeout=10):
+        # Drain what is queued (bounded by timeout), then stop.
+        deadline = time.monotonic() + timeout
+        while (self.pending() or self._tasks) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._runner is not None:
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+            self._runner = None
+
+    # ---------- scheduling ----------
+    def _schedule(self, chat_id):
+        chat = self._chats.get(chat_id)
+        if chat is None or chat.busy or chat.waiting:
+            return
+        job = chat.head()
+        if job is None:
+            # Forget idle chats once their bucket is full again, so the
+            # dict only holds chats that were messaged recently.
+            refill = chat.bucket.refill_time()
+            if refill > 0:
+                asyncio.get_running_loop().call_later(refill, self._schedule, chat_id)
+            else:
+                del self._chats[chat_id]
+            return
+        heapq.heappush(self._ready, (job.priority, job.seq, chat_id))
+        self._wakeup.set()
+
+    def _wake(self, chat_id):
+        chat = self._chats.get(chat_id)
+        if chat is not None:
+            chat.waiting = False
+            self._schedule(chat_id)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            priority, seq, chat_id = heapq.heappop(self._ready)
+            chat = self._chats.get(chat_id)
+            # Entries can go stale: the chat got busy, parked, or a newer
+            # entry with a better priority was pushed for it.
+            if chat is None or chat.busy or chat.waiting:
+                continue
+            job = chat.head()
+            if job is None or job.seq != seq:
+                continue
+
+            delay = chat.bucket.delay()
+            if delay > 0:
+                chat.waiting = True
+                loop.call_later(delay, self._wake, chat_id)
+                continue
+
+            delay = self._global.delay()
+            if delay > 0:
+                heapq.heappush(self._ready, (priority, seq, chat_id))
+                await asyncio.sleep(delay)
+                continue
+
+            await self._slots.acquire()
+            self._global.consume()
+            chat.bucket.consume()
+            chat.lanes[job.priority].popleft()
+            chat.busy = True
+            task = asyncio.create_task(self._deliver(chat_id, chat, job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _deliver(self, chat_id, chat, job):
+        try:
+            result = await job.call()
+        except TelegramRetryAfter as e:
+            job.attempts += 1
+            if job.attempts < MAX_ATTEMPTS:
+                self.retried += 1
+                chat.bucket.pause(e.retry_after)
+                chat.lanes[job.priority].appendleft(job)
+            else:
+                self.failed += 1
+                log.warning("giving up on chat %s after %s attempts", chat_id, job.attempts)
+                job.future.set_result(None)
+        except Exception:
+            self.failed += 1
+            log.exception("send to chat %s failed", chat_id)
+            job.future.set_result(None)
+        else:
+            self.sent += 1
+            job.future.set_result(result)
+        finally:
+            chat.busy = False
+            self._slots.release()
+            self._schedule(chat_id)
@@ -0,0 +1,70 @@
+import sys
+from datetime import date
+
+import db
+
+# Text reports for admins, built from db.service_stats. Everything here is
+# synchronous, read-only and meant to run on a reader thread (adb.read), so
+# one report is one hop regardless of how many queries it makes.
+
+
+def current_month():
+    return date.today().strftime("%Y-%m")
+
+
+def _money(value):
+    return f"{value or 0:,.2f}".replace(",", " ")
+
+
+def month_report(path, month):
+    by_company = db.service_stats(path, "month", month, month, "owner_company")
+    by_mechanic = db.service_stats(path, "month", month, month, "mechanic_tg_id")
+    if not by_company:
+        return f"За {month} завершённых сервисов нет"
+
+    names = {
+        r["tg_id"]: r["full_name"]
+        for r in db.list_users_by_role(path, "mechanic")
+    }
+    total = sum(r["cost_net"] for r in by_company)
+    count = sum(r["services"] for r in by_company)
+
+    lines = [f"📊 Отчёт за {month}", f"Сервисов: {count}, NETTO: {_money(total)}", ""]
+    lines.append("По компаниям:")
+    for r in by_company:
+        lines.append(f"• {r['grp'] or '—'}: {r['services']} шт, {_money(r['cost_net'])}")
+    lines.append("")
+    lines.append("По механикам:")
+    for r in by_mechanic:
+        name = names.get(r["grp"]) or (str(r["grp"]) if r["grp"] else "без механика")
+        lines.append(f"• {name}: {r['services']} шт, {_money(r['cost_net'])}")
+    return "\n".join(lines)
+
+
+def invoice_report(path, company, month):
+    rows = db.service_stats(
+        path, "month", month, month, "car_id", owner_company=company
+    )
+    if not rows:
+        return f"{company}: за {month} завершённых сервисов нет"
+
+    conn = db.get_reader(path)
+    lines = [f"🧾 {company}, {month}"]
+    for r in rows:
+        car = conn.execute(
+            "SELECT plate, vin, model FROM cars WHERE id = ?", (r["grp"],)
+        ).fetchone()
+        label = f"{car['plate'] or car['vin']} {car['model'] or ''}".strip() if car else f"#{r['grp']}"
+        lines.append(
+            f"• {label}: {r['services']} шт, {_money(r['cost_net'])}"
+            f", пробег {r['max_mileage'] or '—'}"
+        )
+    lines.append(f"Итого NETTO: {_money(sum(r['cost_net'] for r in rows))}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != "rebuild":
+        raise SystemExit("usage: python reports.py rebuild <fleet.db>")
+    db.init_db(sys.argv[2])
+    print(f"service_stats rebuilt: {db.rebuild_service_stats(sys.argv[2])} rows")
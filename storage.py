@@ -0,0 +1,168 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+
+import adb
+
+log = logging.getLogger(__name__)
+
+# ================= SETTINGS =================
+FLUSH_INTERVAL = 1.0        # seconds between write-behind batches
+CACHE_SIZE = 10000          # clean records kept in memory
+TTL = 2 * 24 * 3600         # conversations untouched this long are dropped
+SWEEP_INTERVAL = 600        # seconds between expiry sweeps
+
+
+class _Record:
+    __slots__ = ("state", "data", "updated_at")
+
+    def __init__(self, state=None, data=None, updated_at=0.0):
+        self.state = state
+        self.data = data or {}
+        self.updated_at = updated_at
+
+    def empty(self):
+        return self.state is None and not self.data
+
+
+# FSM storage in the bot's SQLite database (table fsm_state).
+# Reads are served from an LRU of hot keys; writes only touch memory and mark
+# the key dirty, a background task flushes dirty keys in one transaction
+# every FLUSH_INTERVAL. Finished conversations (no state, no data) are
+# deleted, abandoned ones expire after TTL. close() flushes what is left.
+class SQLiteStorage(BaseStorage):
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL,
+                 cache_size=CACHE_SIZE, ttl=TTL, sweep_interval=SWEEP_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._cache = OrderedDict()
+        self._dirty = set()
+        self._task = None
+        self._last_sweep = time.monotonic()
+
+    # ---------- BaseStorage ----------
+    async def set_state(self, key, state=None):
+        record = await self._record(key)
+        record.state = state.state if isinstance(state, State) else state
+        self._touch(key, record)
+
+    async def get_state(self, key):
+        record = await self._record(key)
+        return record.state
+
+    async def set_data(self, key, data):
+        record = await self._record(key)
+        record.data = data.copy()
+        self._touch(key, record)
+
+    async def get_data(self, key):
+        record = await self._record(key)
+        return record.data.copy()
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    # ---------- cache ----------
+    async def _record(self, key):
+        k = self.key_builder.build(key)
+        record = self._cache.get(k)
+        if record is not None:
+            self._cache.move_to_end(k)
+            return record
+
+        row = await adb.load_fsm_record(self.path, k)
+        if row is not None and row["updated_at"] >= time.time() - self.ttl:
+            loaded = _Record(row["state"], json.loads(row["data"]), row["updated_at"])
+        else:
+            loaded = _Record()
+        # Another coroutine may have loaded or written this key meanwhile.
+        record = self._cache.setdefault(k, loaded)
+        self._evict()
+        return record
+
+    def _touch(self, key, record):
+        k = self.key_builder.build(key)
+        record.updated_at = time.time()
+        self._cache[k] = record
+        self._cache.move_to_end(k)
+        self._dirty.add(k)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def _evict(self):
+        # Only clean records can go; dirty ones wait for the next flush.
+        if len(self._cache) <= self.cache_size:
+            return
+        for k in list(self._cache):
+            if len(self._cache) <= self.cache_size:
+                break
+            if k not in self._dirty:
+                del self._cache[k]
+
+    # ---------- write-behind ----------
+    async def flush(self):
+        if not self._dirty:
+            return 0
+        keys, self._dirty = self._dirty, set()
+        upserts, deletes, broken = [], [], set()
+        try:
+            for k in keys:
+                record = self._cache.get(k)
+                if record is None or record.empty():
+                    deletes.append(k)
+                    self._cache.pop(k, None)
+                    continue
+                try:
+                    data = json.dumps(record.data)
+                except (TypeError, ValueError):
+                    # Not JSON (a date, an object...): keep it dirty and
+                    # save the rest, so one bad record does not block all.
+                    log.exception("fsm data for %s is not JSON serializable", k)
+                    broken.add(k)
+                    continue
+                upserts.append((k, record.state, data, record.updated_at))
+            await adb.save_fsm_records(self.path, upserts, deletes)
+        except Exception:
+            log.exception("fsm flush failed, will retry")
+            self._dirty |= keys
+            return 0
+        self._dirty |= broken
+        self._evict()
+        return len(keys) - len(broken)
+
+    async def expire(self):
+        before = time.time() - self.ttl
+        for k, record in list(self._cache.items()):
+            if record.updated_at < before and k not in self._dirty:
+                del self._cache[k]
+        return await adb.delete_expired_fsm(self.path, before)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                log.exception("fsm flush failed")
+            if time.monotonic() - self._last_sweep >= self.sweep_interval:
+                self._last_sweep = time.monotonic()
+                try:
+                    await self.expire()
+                except Exception:
+                    log.exception("fsm expiry sweep failed")
@@ -0,0 +1,73 @@
+import sqlite3
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import db
+
+
+def _cars_before_unique_keys(path):
+    # Cars as migration 9 left them: the key indexes did not stop two rows
+    # from normalizing to the same VIN or plate.
+    db.init_db(path)
+    conn = db.get_connection(path)
+    conn.executescript("""
+        DROP INDEX idx_cars_vin_key;
+        DROP INDEX idx_cars_plate_key;
+        CREATE INDEX idx_cars_vin_key ON cars (vin_key);
+        CREATE INDEX idx_cars_plate_key ON cars (plate_key);
+        DELETE FROM schema_version WHERE version >= 10;
+    """)
+    conn.executemany(
+        "INSERT INTO cars (vin, mileage, plate, vin_key, plate_key) VALUES (?, ?, ?, ?, ?)",
+        [
+            ("WVWZZZ1KZ0001", 1000, "WA 1", "WVWZZZ1KZ0001", "WA1"),
+            ("wvw-zzz1kz0001", 2000, "KR 5", "WVWZZZ1KZ0001", "KR5"),
+            ("TMBZZZ1Z0002", 3000, "WA1", "TMBZZZ1Z0002", "WA1"),
+        ]
+    )
+    conn.execute("""
+        INSERT INTO services (
+            car_id, created_by_tg_id, created_by_role, description, desired_at,
+            status, created_at
+        ) VALUES (2, 1, 'admin', 'Колодки', '2025-01-10 09:00', 'done', '2025-01-01 10:00:00')
+    """)
+    conn.commit()
+    db.close_connection(path)
+
+
+def test_migration_merges_duplicate_car_keys(tmp_path):
+    path = str(tmp_path / "fleet.db")
+    _cars_before_unique_keys(path)
+    db.init_db(path)
+    try:
+        conn = db.get_connection(path)
+        cars = conn.execute("SELECT id, vin_key, plate_key FROM cars ORDER BY id").fetchall()
+        assert [tuple(c) for c in cars] == [
+            (1, "WVWZZZ1KZ0001", None),
+            (3, "TMBZZZ1Z0002", "WA1"),
+        ]
+        assert conn.execute("SELECT car_id FROM services").fetchone()[0] == 1
+        with pytest.raises(sqlite3.IntegrityError):
+            conn.execute("UPDATE cars SET vin_key = 'TMBZZZ1Z0002' WHERE id = 1")
+    finally:
+        db.close_connection(path)
+
+
+def test_add_car_rejects_normalized_duplicates(tmp_path):
+    path = str(tmp_path / "fleet.db")
+    db.init_db(path)
+    try:
+        car_id = db.add_car(path, "WVWZZZ1KZ0001", 1000, 2015, "ООО Парк", "Golf", "WA 12345", "diesel")
+        with pytest.raises(db.DuplicateCarError) as e:
+            db.add_car(path, "wvw-zzz1kz0001", 1000, 2015, "ООО Парк", "Golf", "KR 1", "diesel")
+        assert (e.value.field, e.value.car_id) == ("vin", car_id)
+        with pytest.raises(db.DuplicateCarError) as e:
+            db.add_car(path, "TMBZZZ1Z0002", 1000, 2015, "ООО Парк", "Octavia", "wa12345", "diesel")
+        assert e.value.field == "plate"
+        assert db.get_connection(path).execute("SELECT COUNT(*) FROM cars").fetchone()[0] == 1
+    finally:
+        db.close_connection(path)
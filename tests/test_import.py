@@ -0,0 +1,39 @@
+import io
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import db
+import importer
+
+HEADER = "vin;mileage;plate\n"
+
+
+def test_conflicting_row_is_rejected_alone(tmp_path):
+    path = str(tmp_path / "fleet.db")
+    db.init_db(path)
+    try:
+        db.add_car(path, "WVWZZZ1KZ0001", 1000, None, None, None, "WA 1", None)
+        # A key that no longer matches the raw VIN: the row passes the key
+        # checks and only cars.vin UNIQUE stops it.
+        db.get_connection(path).execute("UPDATE cars SET vin_key = 'STALE'")
+        db.get_connection(path).commit()
+        data = HEADER + "WVWZZZ1KZ0001;2000;KR 1\nTMBZZZ1Z0002;3000;KR 2\n"
+        result = importer.import_file(path, "cars.csv", io.BytesIO(data.encode()))
+        assert (result.inserted, result.updated, result.rejected) == (1, 0, 1)
+        assert result.errors[0][0] == 2
+        assert db.find_car_by_identifier(path, "TMBZZZ1Z0002") is not None
+    finally:
+        db.close_connection(path)
+
+
+def test_broken_xlsx_is_reported(tmp_path):
+    path = str(tmp_path / "fleet.db")
+    db.init_db(path)
+    try:
+        result = importer.import_file(path, "cars.xlsx", io.BytesIO(b"not a zip"))
+        assert result.failed and result.inserted == 0
+        assert "XLSX" in result.summary()
+    finally:
+        db.close_connection(path)
@@ -0,0 +1,75 @@
+import sqlite3
+import sys
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import db
+
+
+def _legacy_db(path):
+    # services as the first version of the bot created it: no creator /
+    # completion columns, and nothing stops created_at from being NULL.
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE cars (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            vin TEXT UNIQUE NOT NULL,
+            mileage INTEGER NOT NULL,
+            year INTEGER,
+            owner_company TEXT,
+            plate TEXT,
+            model TEXT,
+            fuel_type TEXT
+        );
+        CREATE TABLE services (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            car_id INTEGER NOT NULL,
+            mechanic_tg_id INTEGER,
+            admin_tg_id INTEGER,
+            description TEXT NOT NULL,
+            desired_at TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending_admin',
+            final_mileage INTEGER,
+            cost_net REAL,
+            comments TEXT,
+            created_at TEXT
+        );
+        INSERT INTO cars (vin, mileage, plate) VALUES ('WVWZZZ1KZ0001', 1000, 'WA 1');
+        INSERT INTO services (car_id, description, desired_at, created_at)
+        VALUES (1, 'Замена масла', '21.10 14:30', NULL),
+               (1, 'Колодки', 'как можно скорее', NULL),
+               (1, 'Шины', '2024-03-01 09:00', '2024-02-20 10:00:00');
+    """)
+    conn.close()
+
+
+def test_desired_ts_migration_handles_null_created_at(tmp_path):
+    path = str(tmp_path / "legacy.db")
+    _legacy_db(path)
+    db.init_db(path)
+    try:
+        assert db.get_schema_version(path) == db.MIGRATIONS[-1][0]
+        rows = {
+            r["description"]: r["desired_ts"]
+            for r in db.get_connection(path).execute(
+                "SELECT description, desired_ts FROM services"
+            )
+        }
+        assert rows["Шины"] == "2024-03-01 09:00:00"
+        # No created_at: dates are read relative to today, and text that is
+        # not a date gets today's time.
+        assert rows["Замена масла"].endswith("-10-21 14:30:00")
+        assert rows["Колодки"][:10] == datetime.now().strftime("%Y-%m-%d")
+    finally:
+        db.close_connection(path)
+
+
+def test_init_db_refuses_old_sqlite(tmp_path, monkeypatch):
+    monkeypatch.setattr(sqlite3, "sqlite_version_info", (3, 31, 1))
+    with pytest.raises(RuntimeError, match="3.35"):
+        db.init_db(str(tmp_path / "fleet.db"))
+    assert not (tmp_path / "fleet.db").exists()
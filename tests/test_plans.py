@@ -0,0 +1,34 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import bench
+import db
+
+# The same check as `python bench.py plans`: every SELECT a hot db.py
+# function issues must reach services / cars through an index.
+
+
+@pytest.fixture(scope="module")
+def path(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("plans") / "plans.db")
+    db.init_db(path)
+    yield path
+    db.close_connection(path)
+
+
+@pytest.mark.parametrize(
+    "fn", [fn for _, fn in bench.HOT_QUERIES], ids=[name for name, _ in bench.HOT_QUERIES]
+)
+def test_hot_query_does_not_scan(path, fn):
+    statements = bench.capture_sql(path, fn)
+    assert statements
+    for sql in statements:
+        assert bench.table_scans(path, sql) == [], sql
+
+
+def test_full_scan_is_detected(path):
+    assert bench.table_scans(path, "SELECT id FROM services WHERE comments = 'x'")
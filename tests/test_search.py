@@ -0,0 +1,55 @@
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import db
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = str(tmp_path / "fleet.db")
+    db.init_db(path)
+    yield path
+    db.close_connection(path)
+
+
+def _service(path, car_id, description, comments=None):
+    sid = db.create_service(path, car_id, 1, "admin", description, "01.01 10:00")
+    if comments:
+        db.set_service_result(path, sid, 1000, 100.0, comments)
+    return sid
+
+
+def test_search_ranks_all_matches_and_pages(path):
+    car = db.add_car(path, "WVWZZZ1KZ0001", 1000, None, None, None, "WA 1", None)
+    other = db.add_car(path, "TMBZZZ1Z0002", 1000, None, None, None, "WA 2", None)
+    best = _service(path, car, "Тормозные колодки")
+    in_comments = _service(path, car, "Осмотр", "поменяли колодки")
+    for _ in range(25):
+        _service(path, other, "Замена масла")
+
+    page = db.search_services(path, "колодки")
+    assert [h.id for h in page.rows] == [best, in_comments]
+
+    # The oldest match is still found when newer ones fill several pages.
+    assert db.search_services(path, "тормозные колодки").rows[0].id == best
+    first = db.search_services(path, "замена масла")
+    second = db.search_services(path, "замена масла", offset=first.next_cursor)
+    assert len(first.rows) == db.PAGE_SIZE and second.prev_cursor == 0
+    assert not {h.id for h in first.rows} & {h.id for h in second.rows}
+
+    assert db.search_services(path, "замена масла", car_id=car).rows == []
+    assert [h.id for h in db.search_services(path, "колодки", car_id=car).rows] == [best, in_comments]
+
+
+def test_search_finds_archived_services(path):
+    car = db.add_car(path, "WVWZZZ1KZ0001", 1000, None, None, None, "WA 1", None)
+    sid = _service(path, car, "Тормозные колодки", "готово")
+    moved = db.archive_services(path, (datetime.now() + timedelta(days=1)).isoformat())
+    assert moved == 1
+    assert [h.id for h in db.search_services(path, "колодки").rows] == [sid]
+    assert [h.id for h in db.search_services(path, "колодки", car_id=car).rows] == [sid]
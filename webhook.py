@@ -0,0 +1,130 @@
+import asyncio
+import json
+import logging
+import signal
+import sys
+import time
+
+from aiohttp import ClientSession, web
+from aiogram import BaseMiddleware
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+log = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+DRAIN_TIMEOUT = 30
+
+
+# Outer update middleware counting updates being processed, so shutdown can
+# wait until every accepted update has been handled.
+class InFlight(BaseMiddleware):
+    def __init__(self):
+        self.count = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    async def __call__(self, handler, event, data):
+        self.count += 1
+        self._idle.clear()
+        try:
+            return await handler(event, data)
+        finally:
+            self.count -= 1
+            if not self.count:
+                self._idle.set()
+
+    async def wait_idle(self, timeout):
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+async def serve(dp, bot, *, host, port, path, secret=None, url=None,
+                drain_timeout=DRAIN_TIMEOUT, background=True):
+    # Runs until SIGINT / SIGTERM. With background=True updates are
+    # acknowledged immediately and handled in tasks; pass False when the
+    # dispatcher queues updates itself (concurrency.ChatScheduler), so a
+    # full queue delays the answer to Telegram. On shutdown: stop
+    # accepting, wait for the in-flight updates, then dispatcher shutdown
+    # hooks (FSM flush, outbox drain), and only then is the bot session
+    # closed.
+    in_flight = InFlight()
+    dp.update.outer_middleware(in_flight)
+
+    async def health(request):
+        return web.json_response({"status": "ok", "in_flight": in_flight.count})
+
+    async def drain(app):
+        if not await in_flight.wait_idle(drain_timeout):
+            log.warning("shutdown: %s updates still running after %ss",
+                        in_flight.count, drain_timeout)
+
+    app = web.Application()
+    app.router.add_get("/healthz", health)
+    # on_shutdown runs in order: drain, dispatcher shutdown, session close.
+    app.on_shutdown.append(drain)
+    setup_application(app, dp, bot=bot)
+    SimpleRequestHandler(
+        dispatcher=dp, bot=bot, secret_token=secret, handle_in_background=background
+    ).register(app, path=path)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log.info("webhook listening on %s:%s%s", host, port, path)
+
+    if url:
+        await bot.set_webhook(
+            url.rstrip("/") + path,
+            secret_token=secret,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(sig)
+        await runner.cleanup()
+
+
+# ================= LOCAL REPLAY =================
+# python webhook.py replay updates.jsonl [http://127.0.0.1:8080/webhook] [secret]
+# POSTs recorded updates (one JSON object per line) and reports ack latency.
+
+async def replay(file, url, secret=None):
+    headers = {SECRET_HEADER: secret} if secret else {}
+    samples = []
+    async with ClientSession() as session:
+        with open(file, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                update = json.loads(line)
+                t0 = time.perf_counter()
+                async with session.post(url, json=update, headers=headers) as resp:
+                    await resp.read()
+                    if resp.status != 200:
+                        print(f"update {update.get('update_id')}: HTTP {resp.status}")
+                samples.append(time.perf_counter() - t0)
+    if samples:
+        samples.sort()
+        p50 = samples[len(samples) // 2]
+        p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+        print(f"{len(samples)} updates, ack p50 {p50 * 1e3:.1f}ms p99 {p99 * 1e3:.1f}ms")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] != "replay":
+        raise SystemExit("usage: python webhook.py replay <updates.jsonl> [url] [secret]")
+    asyncio.run(replay(
+        sys.argv[2],
+        sys.argv[3] if len(sys.argv) > 3 else "http://127.0.0.1:8080/webhook",
+        sys.argv[4] if len(sys.argv) > 4 else None,
+    ))